@@ -0,0 +1,142 @@
+# Compares nginx config test and reload times for the per-site files layout and the
+# consolidated map layout. A reload is timed until nginx serves the new config, not
+# just until the signal is sent. Run from the repository root:
+#
+#     python -m benchmarks.proxy_layout [--sites 10 100 1000]
+
+from argparse import ArgumentParser
+import time
+
+from environment import ContainerEnvironment, Images
+from steps import (
+    BuildNginxProxyMapConfig,
+    BuildNginxReverseProxyConfig,
+    ProxyLayouts,
+    TestNginxConfig,
+)
+
+BENCHMARK_CONTAINER_NAME = "nexus-benchmark-proxy"
+BENCHMARK_CERTIFICATE_NAME = "nexus-benchmark"
+DEFAULT_SITE_COUNTS = [10, 100, 1000]
+VERSION_CONFIG = "/etc/nginx/http.d/zz-benchmark-version.conf"
+VERSION_PORT = 8081
+POLL_SECONDS = 0.01
+MAX_POLLS = 3000
+
+
+def setup() -> ContainerEnvironment:
+    environment = ContainerEnvironment(
+        container_name=BENCHMARK_CONTAINER_NAME,
+        container_image=Images.REVERSE_PROXY,
+        container_network="",
+    )
+    certificate_path = f"/etc/letsencrypt/live/{BENCHMARK_CERTIFICATE_NAME}"
+    exit_code, output = environment.run_commands(
+        [
+            "apk add --no-cache openssl",
+            f"mkdir -p {certificate_path}",
+            "openssl req -x509 -nodes -newkey rsa:2048 -days 1 -subj /CN=benchmark "
+            f"-keyout {certificate_path}/privkey.pem "
+            f"-out {certificate_path}/fullchain.pem",
+        ]
+    )
+    if 0 != exit_code:
+        environment.teardown()
+        raise RuntimeError(f"Benchmark setup failed: {output}")
+    return environment
+
+
+def get_sites(count: int) -> list[BuildNginxReverseProxyConfig]:
+    # Upstreams are addresses so nginx does not resolve thousands of host names
+    return [
+        BuildNginxReverseProxyConfig(
+            f"site-{index}.example.com",
+            f"127.0.0.1:{10000 + index}",
+            certificate_name=BENCHMARK_CERTIFICATE_NAME,
+        )
+        for index in range(count)
+    ]
+
+
+def timed(environment: ContainerEnvironment, step) -> float:
+    start = time.perf_counter()
+    exit_code, output = step.run_action(environment)
+    elapsed = time.perf_counter() - start
+    if 0 != exit_code:
+        raise RuntimeError(f"{step.name} failed: {output}")
+    return elapsed
+
+
+def write_version(environment: ContainerEnvironment, version: str) -> None:
+    exit_code, output = environment.write_file(
+        VERSION_CONFIG,
+        f'server {{\n\tlisten {VERSION_PORT};\n\treturn 200 "{version}";\n}}\n',
+    )
+    if 0 != exit_code:
+        raise RuntimeError(f"Failed to write version config: {output}")
+
+
+def timed_reload(environment: ContainerEnvironment, version: str) -> float:
+    # The reload signal returns at once, the new config is live once its workers answer
+    script = (
+        "nginx -s reload && i=0 && "
+        f'until [ "$(wget -qO- http://127.0.0.1:{VERSION_PORT}/)" = "{version}" ]; do '
+        f"i=$((i + 1)); [ $i -lt {MAX_POLLS} ] || exit 1; sleep {POLL_SECONDS}; done"
+    )
+    start = time.perf_counter()
+    exit_code, output = environment.run_command(f"sh -c '{script}'")
+    elapsed = time.perf_counter() - start
+    if 0 != exit_code:
+        raise RuntimeError(f"Reload to {version} failed: {output}")
+    return elapsed
+
+
+def run(environment: ContainerEnvironment, layout: str, count: int) -> dict:
+    environment.run_command("sh -c 'rm -f /etc/nginx/http.d/*.conf'")
+    sites = get_sites(count)
+    write = 0.0
+    if ProxyLayouts.MAP == layout:
+        write = timed(
+            environment,
+            BuildNginxProxyMapConfig(sites, certificate_name=BENCHMARK_CERTIFICATE_NAME),
+        )
+    else:
+        for site in sites:
+            write += timed(environment, site)
+    version = f"{layout}-{count}-{time.time_ns()}"
+    write_version(environment, version)
+    return {
+        "layout": layout,
+        "sites": count,
+        "write": write,
+        "test": timed(environment, TestNginxConfig()),
+        "reload": timed_reload(environment, version),
+    }
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Benchmark reverse proxy config layouts")
+    parser.add_argument("--sites", type=int, nargs="+", default=DEFAULT_SITE_COUNTS)
+    arguments = parser.parse_args()
+
+    environment = setup()
+    results = []
+    try:
+        for count in arguments.sites:
+            for layout in ProxyLayouts:
+                results.append(run(environment, layout, count))
+    finally:
+        environment.teardown()
+
+    print(f"{'layout':<8}{'sites':>8}{'write (s)':>12}{'test (s)':>12}{'reload (s)':>12}")
+    for result in results:
+        print(
+            f"{result['layout']:<8}{result['sites']:>8}"
+            f"{result['write']:>12.3f}{result['test']:>12.3f}{result['reload']:>12.3f}"
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    main()
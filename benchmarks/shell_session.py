@@ -0,0 +1,73 @@
+# Measures per-command overhead of a Docker exec per command against a persistent
+# shell session. Run from the repository root:
+#
+#     python -m benchmarks.shell_session [--iterations 200]
+
+from argparse import ArgumentParser
+from statistics import mean, quantiles
+import time
+
+from environment import ContainerEnvironment, Images
+from shell import ShellSession
+
+BENCHMARK_CONTAINER_NAME = "nexus-benchmark-shell"
+DEFAULT_ITERATIONS = 200
+COMMANDS = [
+    "true",
+    "sh -c 'cat /etc/hostname'",
+    "sh -c 'echo benchmark > /tmp/benchmark.txt'",
+    "nginx -t",
+]
+
+
+def measure(environment: ContainerEnvironment, command: str, iterations: int) -> list[float]:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        exit_code, output = environment.run_command(command)
+        timings.append(time.perf_counter() - start)
+        if 0 != exit_code:
+            raise RuntimeError(f"{command} failed: {output}")
+    return timings
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Benchmark exec per command against a shell session")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    arguments = parser.parse_args()
+
+    environment = ContainerEnvironment(
+        container_name=BENCHMARK_CONTAINER_NAME,
+        container_image=Images.STATIC_HOST,
+        container_network="",
+        persistent_shell=False,
+    )
+    results = []
+    try:
+        for command in COMMANDS:
+            environment.session = None
+            exec_timings = measure(environment, command, arguments.iterations)
+            environment.session = ShellSession(
+                environment.get_host().get_client(), environment.container.id
+            )
+            session_timings = measure(environment, command, arguments.iterations)
+            environment.session.close()
+            results.append((command, exec_timings, session_timings))
+    finally:
+        environment.session = None
+        environment.teardown()
+
+    print(f"{'command':<48}{'path':<10}{'mean (ms)':>12}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    for command, exec_timings, session_timings in results:
+        for path, timings in (("exec", exec_timings), ("session", session_timings)):
+            percentiles = quantiles(timings, n=20)
+            print(
+                f"{command:<48}{path:<10}{mean(timings) * 1000:>12.2f}"
+                f"{percentiles[9] * 1000:>12.2f}{percentiles[18] * 1000:>12.2f}"
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    main()
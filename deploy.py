@@ -1,10 +1,32 @@
 from collections import deque
+from datetime import datetime, timezone
+from enum import StrEnum, auto
+from hashlib import sha256
 import sqlite3
+import time
 
 from environment import Environment, ContainerEnvironment
+from hosts import HOSTS
+from logstore import LogEntry, save_logs
+from profiling import profile_run, profile_step
 from steps import Step, Properties
+from tracing import start_span
 
 DATABASE_NAME = "nexus.db"
+HISTORY_LIMIT = 100000
+
+
+class Roles(StrEnum):
+    SITE = auto()
+    PROXY = auto()
+
+
+def add_missing_columns(cursor: sqlite3.Cursor, table: str, columns: dict) -> None:
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing_columns = [row[1] for row in cursor.fetchall()]
+    for column, column_type in columns.items():
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
 
 
 def create_deployment_database(cursor: sqlite3.Cursor) -> None:
@@ -15,18 +37,90 @@ def create_deployment_database(cursor: sqlite3.Cursor) -> None:
                 {Properties.NAME} TEXT UNIQUE,
                 {Properties.DOMAIN} TEXT UNIQUE,
                 {Properties.EMAIL} TEXT,
-                environment TEXT
+                environment TEXT,
+                {Properties.UPSTREAM} TEXT,
+                {Properties.REPOSITORY} TEXT,
+                {Properties.SNAPSHOT} TEXT,
+                {Properties.COMMIT_SHA} TEXT,
+                {Properties.BUILT_AT} TEXT,
+                {Properties.PROXY_KEEPALIVE} INTEGER,
+                {Properties.PROXY_HTTP2} INTEGER,
+                {Properties.PROXY_CACHE_TTL} TEXT,
+                {Properties.PROXY_BUFFER_SIZE} TEXT,
+                {Properties.CONFIG} TEXT,
+                {Properties.IMAGE} TEXT
             )
         """
     )
+    add_missing_columns(
+        cursor,
+        "deployments",
+        {
+            Properties.UPSTREAM: "TEXT",
+            Properties.REPOSITORY: "TEXT",
+            Properties.SNAPSHOT: "TEXT",
+            Properties.COMMIT_SHA: "TEXT",
+            Properties.BUILT_AT: "TEXT",
+            Properties.PROXY_KEEPALIVE: "INTEGER",
+            Properties.PROXY_HTTP2: "INTEGER",
+            Properties.PROXY_CACHE_TTL: "TEXT",
+            Properties.PROXY_BUFFER_SIZE: "TEXT",
+            Properties.CONFIG: "TEXT",
+            Properties.IMAGE: "TEXT",
+        },
+    )
     cursor.execute(
         f"""
             CREATE TABLE IF NOT EXISTS environments (
                 name TEXT PRIMARY KEY UNIQUE,
-                working_directory TEXT
+                working_directory TEXT,
+                host TEXT
+            )
+        """
+    )
+    add_missing_columns(cursor, "environments", {"host": "TEXT"})
+    cursor.execute(
+        f"""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                deployment TEXT,
+                path TEXT,
+                {Properties.COMMIT_SHA} TEXT,
+                {Properties.BUILT_AT} TEXT,
+                UNIQUE (deployment, path)
             )
         """
     )
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS step_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                subject TEXT,
+                role TEXT,
+                step TEXT,
+                fingerprint TEXT,
+                duration REAL,
+                exit_code INTEGER,
+                finished_at TEXT
+            )
+        """
+    )
+    cursor.execute(
+        """
+            CREATE INDEX IF NOT EXISTS step_history_subject
+            ON step_history (subject, role, step)
+        """
+    )
+
+
+def chain_fingerprints(seed: str, steps: list[Step]) -> list[str]:
+    # Each fingerprint covers every step before it, so a change invalidates the rest of the run
+    fingerprints = []
+    fingerprint = seed
+    for step in steps:
+        fingerprint = sha256((fingerprint + step.get_fingerprint()).encode()).hexdigest()
+        fingerprints.append(fingerprint)
+    return fingerprints
 
 
 class Deployment:
@@ -36,6 +130,11 @@ class Deployment:
         self.environment.set_name(name)
         self.properties = {}
         self.id = None
+        self.span = None
+        self.links = []
+        self.subject = None
+        self.role = Roles.SITE
+        self.executed = []
 
     def get_property(self, property: str) -> str | None:
         value = None
@@ -56,10 +155,11 @@ class Deployment:
             create_deployment_database(cursor)
             if self.id is None:
                 cursor.execute(
-                    "INSERT INTO environments (name, working_directory) VALUES (?, ?)",
+                    "INSERT INTO environments (name, working_directory, host) VALUES (?, ?, ?)",
                     (
                         self.get_property(Properties.NAME),
                         self.environment.get_working_directory(),
+                        self.environment.get_host_name(),
                     ),
                 )
                 cursor.execute("INSERT INTO deployments DEFAULT VALUES")
@@ -88,19 +188,35 @@ class Deployment:
             cursor.execute(
                 f"""
                     UPDATE environments
-                    SET working_directory = ?
+                    SET working_directory = ?, host = ?
                     WHERE name = ?
                 """,
                 (
-                    self.get_property(Properties.NAME),
                     self.environment.get_working_directory(),
+                    self.environment.get_host_name(),
+                    self.get_property(Properties.NAME),
                 ),
             )
+            if self.get_property(Properties.SNAPSHOT) is not None:
+                cursor.execute(
+                    f"""
+                        INSERT OR IGNORE INTO snapshots
+                        (deployment, path, {Properties.COMMIT_SHA}, {Properties.BUILT_AT})
+                        VALUES (?, ?, ?, ?)
+                    """,
+                    (
+                        self.get_property(Properties.NAME),
+                        self.get_property(Properties.SNAPSHOT),
+                        self.get_property(Properties.COMMIT_SHA),
+                        self.get_property(Properties.BUILT_AT),
+                    ),
+                )
             database.commit()
 
     def delete(self) -> None:
         with sqlite3.connect(DATABASE_NAME) as database:
             cursor = database.cursor()
+            create_deployment_database(cursor)
             cursor.execute(
                 f"""
                     DELETE FROM deployments
@@ -115,6 +231,66 @@ class Deployment:
                 """,
                 (self.get_property(Properties.NAME),),
             )
+            cursor.execute(
+                f"""
+                    DELETE FROM snapshots
+                    WHERE deployment = ?
+                """,
+                (self.get_property(Properties.NAME),),
+            )
+            database.commit()
+
+    def link(self, deployment: "Deployment") -> None:
+        self.links.append(deployment.span)
+
+    def set_subject(self, subject: str, role: Roles = Roles.SITE) -> None:
+        # History and logs are filed under the subject, e.g. proxy runs under their site
+        self.subject = subject
+        self.role = role
+
+    def get_subject(self) -> str:
+        subject = self.subject
+        if subject is None:
+            subject = self.get_property(Properties.NAME)
+        return subject
+
+    def get_fingerprint_seed(self) -> str:
+        # Site steps depend on the revision they build
+        seed = ""
+        if Roles.SITE == self.role:
+            seed = self.get_property(Properties.COMMIT_SHA) or ""
+        return seed
+
+    def save_history(self) -> None:
+        steps = [step for step, _, _ in self.executed]
+        fingerprints = chain_fingerprints(self.get_fingerprint_seed(), steps)
+        finished_at = datetime.now(timezone.utc).isoformat()
+        with sqlite3.connect(DATABASE_NAME) as database:
+            cursor = database.cursor()
+            create_deployment_database(cursor)
+            cursor.executemany(
+                """
+                    INSERT INTO step_history
+                    (subject, role, step, fingerprint, duration, exit_code, finished_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        self.get_subject(),
+                        self.role,
+                        step.name,
+                        fingerprint,
+                        duration,
+                        step.exit_code,
+                        finished_at,
+                    )
+                    for (step, duration, _), fingerprint in zip(self.executed, fingerprints)
+                ],
+            )
+            cursor.execute(
+                "DELETE FROM step_history WHERE id <= (SELECT MAX(id) FROM step_history) - ?",
+                (HISTORY_LIMIT,),
+            )
             database.commit()
 
     def add_step(self, step: Step) -> None:
@@ -125,7 +301,14 @@ class Deployment:
 
     def run_next_step(self) -> tuple[int, str]:
         step = self.steps.pop()
-        exit_code, output = step.run(self.environment)
+        name = str(self.get_property(Properties.NAME))
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        with profile_step(name, step.name), start_span(step.name) as span:
+            exit_code, output = step.run(self.environment)
+            span.set_exit_code(exit_code)
+            span.set_attributes({"output.size": len(output)})
+        self.executed.append((step, time.perf_counter() - start, started_at))
         self.add_steps(step.get_next_steps())
         self.set_properties(step.get_properties())
         return exit_code, output
@@ -133,42 +316,95 @@ class Deployment:
     def run_all_steps(self) -> tuple[int, str]:
         exit_code = 0
         output = ""
-        while self.steps:
-            exit_code, output = self.run_next_step()
-            if 0 != exit_code:
-                break
+        with profile_run("steps"), start_span("deployment") as span:
+            # Proxy runs link back to the site deployment they route to
+            for link in self.links:
+                span.add_link(link)
+            self.links = []
+            self.executed = []
+            while self.steps:
+                exit_code, output = self.run_next_step()
+                if 0 != exit_code:
+                    # A reused deployment must not run the leftovers of a failed run
+                    self.steps.clear()
+                    break
+            span.set_exit_code(exit_code)
+            span.set_attributes(
+                {
+                    "deployment.name": self.get_property(Properties.NAME),
+                    "deployment.domain": self.get_property(Properties.DOMAIN),
+                    "host.name": self.environment.get_host_name(),
+                }
+            )
+            self.span = span
+        if 0 != len(self.executed):
+            self.save_history()
+            save_logs(
+                self.span.trace_id,
+                self.get_subject(),
+                self.role,
+                [
+                    LogEntry(step.name, step.exit_code, step.output, started_at, duration)
+                    for step, duration, started_at in self.executed
+                ],
+            )
         return exit_code, output
 
 
+def get_deployment_records() -> list[dict]:
+    records = []
+    with sqlite3.connect(DATABASE_NAME) as database:
+        database.row_factory = sqlite3.Row
+        cursor = database.cursor()
+        create_deployment_database(cursor)
+        cursor.execute(
+            """
+                SELECT deployments.*, environments.working_directory, environments.host
+                FROM deployments
+                LEFT JOIN environments ON deployments.name = environments.name
+            """
+        )
+        for row in cursor.fetchall():
+            records.append({key: row[key] for key in row.keys()})
+    return records
+
+
 def get_deployments() -> list[Deployment]:
     deployments = []
     with sqlite3.connect(DATABASE_NAME) as database:
+        database.row_factory = sqlite3.Row
         cursor = database.cursor()
         create_deployment_database(cursor)
         cursor.execute("SELECT * FROM deployments")
         for row in cursor.fetchall():
-            environment_type = row[4]
+            cursor.execute(
+                f"""
+                    SELECT *
+                    FROM environments
+                    WHERE name = ?
+                """,
+                (row[Properties.NAME],),
+            )
+            environment_data = cursor.fetchone()
             environment = None
-            if ContainerEnvironment.__name__ == environment_type:
-                environment = ContainerEnvironment(container_name=row[1])
-            if environment is not None:
-                cursor.execute(
-                    f"""
-                        SELECT *
-                        FROM environments
-                        WHERE name = ?
-                    """,
-                    (environment.get_name(),),
+            if ContainerEnvironment.__name__ == row["environment"]:
+                environment = ContainerEnvironment(
+                    container_name=row[Properties.NAME],
+                    host=HOSTS.get(environment_data["host"] if environment_data else None),
                 )
-                environment_data = cursor.fetchone()
+            if environment is not None:
                 if environment_data:
                     environment.set_working_directory(
-                        environment_data[1]
-                    )  # TODO get properties by name from row instead of by index
+                        environment_data["working_directory"]
+                    )
                 deployment = Deployment(environment)
-                deployment.id = row[0]
+                deployment.id = row["id"]
                 deployment.set_properties(
-                    {Properties.DOMAIN: row[2], Properties.EMAIL: row[3]}
-                )  # TODO get properties by name from row instead of by index
+                    {
+                        property: row[property]
+                        for property in Properties
+                        if property != Properties.NAME and property in row.keys()
+                    }
+                )
                 deployments.append(deployment)
     return deployments
@@ -1,12 +1,24 @@
 from abc import ABC, abstractmethod
 from enum import StrEnum
+from io import BytesIO
+import os
+import tarfile
+import time
 from typing import Any
 
-from docker import from_env, errors
+from docker import errors
+
+from hosts import HOSTS, Host
+from settings import get_setting
+from shell import ShellSession
+from tracing import start_span
 
-CLIENT = from_env()
 BASE_DIRECTORY = "/tmp"
 DEFAULT_CONTAINER_NETWORK = "nexus-net"
+DEFAULT_UPSTREAM_PORT = 80
+MANAGED_LABEL = "nexus.managed"
+MANAGED_LABELS = {MANAGED_LABEL: "true"}
+PERSISTENT_SHELL = get_setting("shell", "persistent", False)
 
 
 class Images(StrEnum):
@@ -34,12 +46,30 @@ class Environment(ABC):
     def teardown(self) -> tuple[int, str]:
         return -1, ""
 
+    @abstractmethod
+    def write_file(self, path: str, content: str) -> tuple[int, str]:
+        return -1, ""
+
+    @abstractmethod
+    def copy_directory(self, path: str, destination: "Environment") -> tuple[int, str]:
+        return -1, ""
+
+    @abstractmethod
+    def commit_image(self, repository: str, tag: str) -> tuple[int, str]:
+        return -1, ""
+
     def set_name(self, name: str) -> None:
         self.name = name
 
     def get_name(self) -> str | None:
         return self.name
 
+    def get_host_name(self) -> str:
+        return ""
+
+    def get_upstream(self) -> str:
+        return f"{self.get_name()}:{DEFAULT_UPSTREAM_PORT}"
+
     def set_working_directory(self, working_directory: str) -> None:
         self.working_directory = working_directory
 
@@ -72,24 +102,42 @@ class ContainerEnvironment(Environment):
         container_ports: dict = {},
         working_directory: str = BASE_DIRECTORY,
         variables: dict = {},
+        host: Host | None = None,
+        persistent_shell: bool = PERSISTENT_SHELL,
+        restart_policy: dict = {},
     ) -> None:
         super().__init__(working_directory=working_directory, variables=variables)
+        self.host = host if host is not None else HOSTS.get_default()
+        self.session = None
+        client = self.host.get_client()
         try:
-            self.container = CLIENT.containers.get(container_name)
+            self.container = client.containers.get(container_name)
         except (errors.NotFound, errors.NullResource):
-            self.container = CLIENT.containers.run(
-                container_image, ports=container_ports, detach=True
+            if not self.is_on_default_host() and 0 == len(container_ports):
+                # Remote hosts are reached by the reverse proxy through a published port,
+                # bound to the private address so sites are not exposed past the proxy
+                container_ports = {
+                    f"{DEFAULT_UPSTREAM_PORT}/tcp": (self.host.get_address(), None)
+                }
+            self.container = client.containers.run(
+                container_image,
+                ports=container_ports,
+                labels=MANAGED_LABELS,
+                restart_policy=restart_policy,
+                detach=True,
             )
         self.set_name(container_name)
         if len(container_network) > 0:
-            networks = CLIENT.networks.list(names=[container_network])
+            networks = client.networks.list(names=[container_network])
             if 0 == len(networks):
-                network = CLIENT.networks.create(container_network)
+                network = client.networks.create(container_network, labels=MANAGED_LABELS)
             else:
                 network = networks[0]
             network.reload()
             if self.container not in network.containers:
                 network.connect(self.container)
+        if persistent_shell:
+            self.session = ShellSession(client, self.container.id)
 
     def set_name(self, name: str) -> None:
         if "" != name and self.container.name != name:
@@ -101,9 +149,42 @@ class ContainerEnvironment(Environment):
     def get_name(self) -> str | None:
         return self.container.name
 
+    def get_host(self) -> Host:
+        return self.host
+
+    def get_host_name(self) -> str:
+        return self.host.get_name()
+
+    def is_on_default_host(self) -> bool:
+        return self.host is HOSTS.get_default()
+
+    def get_upstream(self) -> str:
+        upstream = super().get_upstream()
+        if not self.is_on_default_host():
+            self.container.reload()
+            bindings = self.container.ports.get(f"{DEFAULT_UPSTREAM_PORT}/tcp")
+            if bindings:
+                upstream = f"{self.host.get_address()}:{bindings[0]['HostPort']}"
+        return upstream
+
+    def start(self) -> tuple[int, str]:
+        exit_code = 0
+        output = ""
+        try:
+            self.container.reload()
+            if "running" != self.container.status:
+                self.container.start()
+                output = f"Started {self.get_name()}"
+        except errors.APIError as error:
+            exit_code = -1
+            output = f"Failed to start {self.get_name()}: {error}"
+        return exit_code, output
+
     def teardown(self) -> tuple[int, str]:
         exit_code = 0
         output = ""
+        if self.session is not None:
+            self.session.close()
         try:
             self.container.remove(force=True)
         except:
@@ -111,17 +192,97 @@ class ContainerEnvironment(Environment):
             output = f"Failed to remove container {self.get_name()}"
         return exit_code, output
 
+    def write_file(self, path: str, content: str) -> tuple[int, str]:
+        directory, name = os.path.split(path)
+        temporary_name = f".{name}.tmp"
+        data = content.encode()
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode="w") as tar:
+            info = tarfile.TarInfo(temporary_name)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            tar.addfile(info, BytesIO(data))
+
+        exit_code = 0
+        output = ""
+        try:
+            with start_span("put_archive", {"path": path, "size": len(data)}):
+                self.container.put_archive(directory, archive.getvalue())
+        except errors.APIError as error:
+            exit_code = -1
+            output = f"Failed to write {path}: {error}"
+        if 0 == exit_code:
+            # Rename within the directory so readers never see a partial file
+            exit_code, output = self.run_command(
+                f"mv -f {directory}/{temporary_name} {path}"
+            )
+        return exit_code, output
+
+    def copy_directory(self, path: str, destination: Environment) -> tuple[int, str]:
+        exit_code = 0
+        output = ""
+        if not isinstance(destination, ContainerEnvironment):
+            exit_code = -1
+            output = f"Cannot copy {path} to {type(destination).__name__}"
+        else:
+            try:
+                with start_span("copy_directory", {"path": path}):
+                    archive, _ = self.container.get_archive(path)
+                exit_code, output = destination.run_command(
+                    f"mkdir -p {os.path.dirname(path)}"
+                )
+                if 0 == exit_code:
+                    with start_span("put_archive", {"path": path}):
+                        destination.container.put_archive(os.path.dirname(path), archive)
+            except errors.NotFound:
+                # Nothing to copy
+                pass
+            except errors.APIError as error:
+                exit_code = -1
+                output = f"Failed to copy {path}: {error}"
+        return exit_code, output
+
+    def commit_image(self, repository: str, tag: str) -> tuple[int, str]:
+        exit_code = 0
+        output = f"{repository}:{tag}"
+        try:
+            with start_span("commit", {"image": output, "container.name": self.get_name()}):
+                # Pausing would stop the site serving while its filesystem is copied
+                self.container.commit(repository, tag, pause=False)
+        except errors.APIError as error:
+            exit_code = -1
+            output = f"Failed to commit {self.get_name()}: {error}"
+        return exit_code, output
+
     def run_commands(self, commands: list[str]) -> tuple[int, str]:
         exit_code = 0
         output = b""
+        working_directory = (
+            self.working_directory if len(self.working_directory) > 0 else None
+        )
         for command in commands:
-            exit_code, output = self.container.exec_run(
-                command,
-                workdir=(
-                    self.working_directory if len(self.working_directory) > 0 else None
-                ),
-                environment=self.variables,
-            )
+            with start_span(
+                "exec",
+                {
+                    "command": command,
+                    "container.name": self.get_name(),
+                    "host.name": self.get_host_name(),
+                },
+            ) as span:
+                if self.session is not None:
+                    exit_code, output = self.session.run(
+                        command, working_directory, self.variables
+                    )
+                else:
+                    # Run through a shell like the session does, exec_run would split it
+                    exit_code, output = self.container.exec_run(
+                        ["sh", "-c", command],
+                        workdir=working_directory,
+                        environment=self.variables,
+                    )
+                span.set_exit_code(exit_code)
+                span.set_attributes({"output.size": len(output)})
             if 0 != exit_code:
                 break
         return exit_code, output.decode()
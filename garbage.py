@@ -0,0 +1,256 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from deploy import Deployment, get_deployment_records
+from docker import errors
+from enum import StrEnum, auto
+from environment import Images, MANAGED_LABEL
+from hosts import HOSTS, Host
+import logging
+from pipelines import PROXY_LAYOUT, REVERSR_PROXY_NAME, get_reverse_proxy
+from profiling import profiled
+from requests import RequestException
+from settings import get_setting
+from snapshots import IMAGE_REPOSITORY
+from tracing import bind, traced
+from steps import (
+    PROXY_CACHE_CONFIG,
+    PROXY_CONFIG_DIRECTORY,
+    PROXY_MAP_CONFIG,
+    Properties,
+    ProxyLayouts,
+    ReloadNginx,
+    TestNginxConfig,
+)
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_GRACE_MINUTES = 30
+DEFAULT_WORKERS = 8
+GRACE_PERIOD = timedelta(minutes=get_setting("gc", "grace_minutes", DEFAULT_GRACE_MINUTES))
+WORKERS = get_setting("gc", "workers", DEFAULT_WORKERS)
+MEBIBYTE = 1024 * 1024
+
+
+class ResourceKinds(StrEnum):
+    CONTAINER = auto()
+    IMAGE = auto()
+    CONFIG = auto()
+
+
+class Orphan:
+    def __init__(
+        self, kind: ResourceKinds, host: Host, name: str, disk: int = 0, running: bool = False
+    ) -> None:
+        self.kind = kind
+        self.host = host
+        self.name = name
+        self.disk = disk
+        self.running = running
+        self.memory = 0
+
+    def measure(self) -> None:
+        if self.running:
+            stats = self.host.get_client().api.stats(self.name, stream=False)
+            self.memory = stats.get("memory_stats", {}).get("usage", 0)
+
+    def reclaim(self) -> tuple[int, str]:
+        client = self.host.get_client()
+        if ResourceKinds.CONTAINER == self.kind:
+            # Anonymous volumes go with the container
+            client.api.remove_container(self.name, v=True, force=True)
+        elif ResourceKinds.IMAGE == self.kind:
+            client.api.remove_image(self.name, noprune=False)
+        return 0, f"Removed {self.kind} {self.name} on {self.host.get_name()}"
+
+
+def is_managed(summary: dict) -> bool:
+    # Containers created before labelling are recognised by their image
+    labels = summary.get("Labels") or {}
+    return MANAGED_LABEL in labels or any(
+        summary.get("Image", "").startswith(image) for image in Images
+    )
+
+
+def get_age(summary: dict) -> timedelta:
+    return datetime.now(timezone.utc) - datetime.fromtimestamp(summary["Created"], timezone.utc)
+
+
+def is_orphan_container(name: str, summary: dict, names: set) -> bool:
+    # Containers younger than the grace period may belong to a deployment in progress
+    return (
+        is_managed(summary)
+        and name not in names
+        and name != REVERSR_PROXY_NAME
+        and get_age(summary) > GRACE_PERIOD
+    )
+
+
+def is_orphan_site_image(summary: dict, images: set, in_use: set) -> bool:
+    # Images are committed before the deployment recording them is saved
+    return (
+        summary["Id"] not in in_use
+        and not set(summary.get("RepoTags") or []) & images
+        and get_age(summary) > GRACE_PERIOD
+    )
+
+
+def is_orphan_image(summary: dict) -> bool:
+    # Replaced Nexus images lose their tag but keep the digest of the repository they came from
+    labels = summary.get("Labels") or {}
+    return MANAGED_LABEL in labels or any(
+        digest.startswith(f"{image}@")
+        for digest in summary.get("RepoDigests") or []
+        for image in Images
+    )
+
+
+def find_host_orphans(host: Host, names: set, images: set) -> list[Orphan] | None:
+    orphans = None
+    try:
+        orphans = list_host_orphans(host, names, images)
+    except (errors.DockerException, RequestException) as error:
+        LOGGER.warning(f"Skipping unreachable host {host.get_name()}: {error}")
+    return orphans
+
+
+def list_host_orphans(host: Host, names: set, images: set) -> list[Orphan]:
+    api = host.get_client().api
+    orphans = []
+    containers = api.containers(all=True, size=True)
+    for summary in containers:
+        name = summary["Names"][0].lstrip("/")
+        if is_orphan_container(name, summary, names):
+            orphans.append(
+                Orphan(
+                    ResourceKinds.CONTAINER,
+                    host,
+                    name,
+                    summary.get("SizeRw", 0),
+                    "running" == summary["State"],
+                )
+            )
+    # Restored containers keep running from images whose tag has moved on
+    in_use = set(summary.get("ImageID") for summary in containers)
+    for summary in api.images(filters={"dangling": True}):
+        if is_orphan_image(summary) and summary["Id"] not in in_use:
+            orphans.append(Orphan(ResourceKinds.IMAGE, host, summary["Id"], summary["Size"]))
+    for summary in api.images(filters={"reference": f"{IMAGE_REPOSITORY}/*"}):
+        if is_orphan_site_image(summary, images, in_use):
+            orphans.append(Orphan(ResourceKinds.IMAGE, host, summary["Id"], summary["Size"]))
+    return orphans
+
+
+def find_config_orphans(reverse_proxy_deployment: Deployment, records: list[dict]) -> list[Orphan]:
+    exit_code, output = reverse_proxy_deployment.environment.run_command(
+        f"sh -c 'find {PROXY_CONFIG_DIRECTORY} -maxdepth 1 -type f -exec wc -c {{}} \\;'"
+    )
+    if 0 != exit_code:
+        raise RuntimeError(f"Failed to list reverse proxy configs: {output}")
+    sizes = {}
+    for line in output.splitlines():
+        size, path = line.split()
+        sizes[path] = int(size)
+
+    # Per-site files still route traffic until the map config has been written
+    referenced = {PROXY_CACHE_CONFIG, PROXY_MAP_CONFIG}
+    if ProxyLayouts.FILES == PROXY_LAYOUT or PROXY_MAP_CONFIG not in sizes:
+        referenced.update(
+            f"{PROXY_CONFIG_DIRECTORY}/{record[Properties.DOMAIN]}.conf"
+            for record in records
+            if record[Properties.DOMAIN]
+        )
+    return [
+        Orphan(ResourceKinds.CONFIG, HOSTS.get_default(), path, size)
+        for path, size in sizes.items()
+        if path not in referenced
+    ]
+
+
+def find_orphans(reverse_proxy_deployment: Deployment) -> tuple[list[Orphan], list[str]]:
+    records = get_deployment_records()
+    names = set(record[Properties.NAME] for record in records)
+    images = set(record[Properties.IMAGE] for record in records) - {None}
+    hosts = HOSTS.get_hosts()
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        results = list(executor.map(lambda host: find_host_orphans(host, names, images), hosts))
+    orphans = [orphan for host_orphans in results if host_orphans for orphan in host_orphans]
+    unreachable = [host.get_name() for host, result in zip(hosts, results) if result is None]
+    return orphans + find_config_orphans(reverse_proxy_deployment, records), unreachable
+
+
+def run(orphan: Orphan, dry_run: bool) -> tuple[int, str]:
+    exit_code = 0
+    output = f"Would remove {orphan.kind} {orphan.name} on {orphan.host.get_name()}"
+    try:
+        orphan.measure()
+        if not dry_run:
+            exit_code, output = orphan.reclaim()
+    except Exception as error:
+        exit_code = -1
+        output = f"Failed to remove {orphan.kind} {orphan.name}: {error}"
+    if 0 != exit_code:
+        LOGGER.error(output)
+    else:
+        LOGGER.info(output)
+    return exit_code, output
+
+
+def collect_orphans(dry_run: bool) -> tuple[int, str]:
+    reverse_proxy_deployment = get_reverse_proxy()
+    orphans, unreachable = find_orphans(reverse_proxy_deployment)
+    resources = [orphan for orphan in orphans if ResourceKinds.CONFIG != orphan.kind]
+    configs = [orphan for orphan in orphans if ResourceKinds.CONFIG == orphan.kind]
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        results = list(
+            executor.map(bind(lambda orphan: run(orphan, dry_run)), resources)
+        )
+    reclaimed = [orphan for orphan, result in zip(resources, results) if 0 == result[0]]
+    failures = len(resources) - len(reclaimed)
+
+    # Configs share the reverse proxy, so they are removed together with one reload
+    if 0 != len(configs):
+        paths = " ".join(orphan.name for orphan in configs)
+        LOGGER.info(f"{'Would remove' if dry_run else 'Removing'} proxy configs {paths}")
+        exit_code = 0
+        output = ""
+        if not dry_run:
+            exit_code, output = reverse_proxy_deployment.environment.run_command(
+                f"rm -f {paths}"
+            )
+        if not dry_run and 0 == exit_code:
+            reverse_proxy_deployment.add_step(TestNginxConfig())
+            reverse_proxy_deployment.add_step(ReloadNginx())
+            exit_code, output = reverse_proxy_deployment.run_all_steps()
+        if 0 == exit_code:
+            reclaimed += configs
+        else:
+            failures += len(configs)
+            LOGGER.error(f"Failed to remove proxy configs: {output}")
+
+    counts = ", ".join(
+        f"{sum(1 for orphan in reclaimed if kind == orphan.kind)} {kind}s"
+        for kind in ResourceKinds
+    )
+    memory = sum(orphan.memory for orphan in reclaimed) / MEBIBYTE
+    disk = sum(orphan.disk for orphan in reclaimed) / MEBIBYTE
+    output = (
+        f"{'Would remove' if dry_run else 'Removed'} {counts}; "
+        f"{'would free' if dry_run else 'freed'} {memory:.1f} MiB memory, "
+        f"{disk:.1f} MiB disk; {failures} failed"
+    )
+    if 0 != len(unreachable):
+        output += f"; skipped unreachable hosts {', '.join(unreachable)}"
+    LOGGER.info(output)
+    return (0 if 0 == failures + len(unreachable) else -1), output
+
+
+@traced
+@profiled("gc")
+def collect(dry_run: bool = False) -> tuple[int, str]:
+    try:
+        exit_code, output = collect_orphans(dry_run)
+    except (errors.DockerException, RequestException, RuntimeError) as error:
+        exit_code = -1
+        output = f"Garbage collection failed: {error}"
+        LOGGER.error(output)
+    return exit_code, output
@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+from enum import StrEnum, auto
+import logging
+from urllib.parse import urlparse
+
+from docker import DockerClient, from_env, errors
+
+from profiling import instrument
+from settings import check_value, get_section
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_HOST_NAME = "local"
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_CONTAINERS = 50
+
+
+class HostSettingsFields(StrEnum):
+    BASE_URL = auto()
+    ADDRESS = auto()
+    POOL_SIZE = auto()
+    MAX_CONTAINERS = auto()
+
+
+class Host:
+    def __init__(
+        self,
+        name: str,
+        base_url: str = "",
+        address: str = "",
+        pool_size: int = DEFAULT_POOL_SIZE,
+        max_containers: int = DEFAULT_MAX_CONTAINERS,
+        client: DockerClient | None = None,
+    ) -> None:
+        self.name = name
+        self.base_url = base_url
+        self.address = address
+        self.pool_size = pool_size
+        self.max_containers = max_containers
+        self.client = client
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get_address(self) -> str:
+        address = self.address
+        if 0 == len(address):
+            address = urlparse(self.base_url).hostname or "127.0.0.1"
+        return address
+
+    def get_client(self) -> DockerClient:
+        if self.client is None:
+            if 0 == len(self.base_url):
+                self.client = from_env(max_pool_size=self.pool_size)
+            else:
+                self.client = DockerClient(
+                    base_url=self.base_url, max_pool_size=self.pool_size
+                )
+            instrument(self.client)
+        return self.client
+
+    def get_load(self) -> float:
+        client = self.get_client()
+        containers = client.containers.list()
+        memory_total = client.info().get("MemTotal", 0)
+        memory_used = 0
+        for container in containers:
+            stats = container.stats(stream=False, one_shot=True)
+            memory_used += stats.get("memory_stats", {}).get("usage", 0)
+        memory_load = memory_used / memory_total if memory_total > 0 else 0.0
+        container_load = len(containers) / max(self.max_containers, 1)
+        return max(memory_load, container_load)
+
+
+class HostRegistry:
+    def __init__(self, hosts: list[Host]) -> None:
+        self.hosts = {}
+        for host in hosts:
+            self.add_host(host)
+
+    def add_host(self, host: Host) -> None:
+        self.hosts[host.get_name()] = host
+
+    def get_hosts(self) -> list[Host]:
+        return list(self.hosts.values())
+
+    def get_default(self) -> Host:
+        return next(iter(self.hosts.values()))
+
+    def get(self, name: str | None) -> Host:
+        host = self.get_default()
+        if name in self.hosts:
+            host = self.hosts[name]
+        elif name:
+            LOGGER.error(f"Unknown host {name}, using {host.get_name()}")
+        return host
+
+    def get_least_loaded(self) -> Host:
+        hosts = self.get_hosts()
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            futures = [executor.submit(host.get_load) for host in hosts]
+        least_loaded = None
+        least_load = None
+        for host, future in zip(hosts, futures):
+            try:
+                load = future.result()
+            except errors.DockerException as error:
+                LOGGER.error(f"Host {host.get_name()} unavailable: {error}")
+                continue
+            LOGGER.info(f"Host {host.get_name()} load: {load:.2f}")
+            if least_load is None or load < least_load:
+                least_loaded = host
+                least_load = load
+        if least_loaded is None:
+            least_loaded = self.get_default()
+        return least_loaded
+
+
+def read_hosts() -> HostRegistry:
+    hosts = []
+    for name, fields in get_section("hosts").items():
+        section = f"hosts.{name}"
+
+        def get(field: str, default):
+            return check_value(section, field, fields.get(field, default), default)
+
+        hosts.append(
+            Host(
+                name,
+                base_url=get(HostSettingsFields.BASE_URL, ""),
+                address=get(HostSettingsFields.ADDRESS, ""),
+                pool_size=get(HostSettingsFields.POOL_SIZE, DEFAULT_POOL_SIZE),
+                max_containers=get(HostSettingsFields.MAX_CONTAINERS, DEFAULT_MAX_CONTAINERS),
+            )
+        )
+    if 0 == len(hosts):
+        hosts.append(Host(DEFAULT_HOST_NAME))
+    return HostRegistry(hosts)
+
+
+HOSTS = read_hosts()
@@ -0,0 +1,71 @@
+# Lists, searches and prints step output saved by logstore.py.
+# Run from the directory Nexus runs in:
+#
+#     python logs.py [--deployment NAME] [--step STEP] [--since TIME] [--until TIME]
+#                    [--failed] [--grep PATTERN | --show | --id ID]
+
+from argparse import ArgumentParser
+from datetime import datetime
+import re
+import sys
+
+from logstore import find_logs, read_log
+
+
+def format_log(log: dict) -> str:
+    truncated = f"  ({log['truncated']} bytes dropped)" if log["truncated"] else ""
+    return (
+        f"{log['id']:>8}  {log['started_at'][:19]:<21}{(log['deployment'] or '')[:27]:<28}"
+        f"{log['step'][:35]:<36}{log['exit_code']:>5}{log['size']:>12}{truncated}"
+    )
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Search the step output of past Nexus runs")
+    parser.add_argument("--deployment", help="site name, proxy runs are listed under their site")
+    parser.add_argument("--step", help='step name, e.g. "Build Source"')
+    parser.add_argument("--since", type=datetime.fromisoformat, help="ISO time, UTC by default")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="ISO time, UTC by default")
+    parser.add_argument("--failed", action="store_true", help="only steps that failed")
+    parser.add_argument("--grep", type=re.compile, help="print matching lines")
+    parser.add_argument("--show", action="store_true", help="print the output of every match")
+    parser.add_argument("--id", type=int, help="print the output of one log")
+    arguments = parser.parse_args()
+
+    count = 0
+    if arguments.id is not None:
+        for line in read_log(arguments.id):
+            print(line)
+        count = 1
+    else:
+        if arguments.grep is None:
+            print(
+                f"{'id':>8}  {'started':<21}{'deployment':<28}{'step':<36}"
+                f"{'exit':>5}{'bytes':>12}"
+            )
+        logs = find_logs(
+            arguments.deployment,
+            arguments.step,
+            arguments.since,
+            arguments.until,
+            arguments.failed,
+        )
+        for log in logs:
+            count += 1
+            if arguments.grep is not None:
+                for number, line in enumerate(read_log(log["id"]), 1):
+                    if arguments.grep.search(line):
+                        print(f"{log['id']:>8}:{number}: {line}")
+            else:
+                print(format_log(log))
+                if arguments.show:
+                    for line in read_log(log["id"]):
+                        print(f"          {line}")
+    if 0 == count:
+        print("No matching logs found")
+
+    return 0 if 0 != count else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import codecs
+from datetime import datetime, timedelta, timezone
+import logging
+import sqlite3
+from typing import Iterator
+import zlib
+
+from settings import get_setting
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_LOG_DATABASE = "nexus-logs.db"
+DEFAULT_MAX_STEP_OUTPUT_KB = 1024
+DEFAULT_MAX_SIZE_MB = 256
+DEFAULT_RETENTION_DAYS = 30
+LOG_DATABASE = get_setting("logs", "database", DEFAULT_LOG_DATABASE)
+ENABLED = get_setting("logs", "enabled", True)
+MAX_STEP_OUTPUT = get_setting("logs", "max_step_output_kb", DEFAULT_MAX_STEP_OUTPUT_KB) * 1024
+MAX_SIZE = get_setting("logs", "max_size_mb", DEFAULT_MAX_SIZE_MB) * 1024 * 1024
+RETENTION = timedelta(days=get_setting("logs", "retention_days", DEFAULT_RETENTION_DAYS))
+COMPRESSION_LEVEL = 6
+CHUNK_SIZE = 64 * 1024
+LOCK_TIMEOUT_SECONDS = 30
+
+
+class LogEntry:
+    def __init__(
+        self, step: str, exit_code: int, output: str, started_at: datetime, duration: float
+    ) -> None:
+        self.step = step
+        self.exit_code = exit_code
+        self.output = output
+        self.started_at = started_at
+        self.duration = duration
+
+
+def connect() -> sqlite3.Connection:
+    database = sqlite3.connect(LOG_DATABASE, timeout=LOCK_TIMEOUT_SECONDS)
+    database.row_factory = sqlite3.Row
+    return database
+
+
+def create_log_database(cursor: sqlite3.Cursor) -> None:
+    # Only takes effect on a new database, and lets pruning hand pages back to the disk
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS step_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                trace_id TEXT,
+                deployment TEXT,
+                role TEXT,
+                step TEXT,
+                exit_code INTEGER,
+                started_at TEXT,
+                finished_at TEXT,
+                size INTEGER,
+                stored INTEGER,
+                truncated INTEGER
+            )
+        """
+    )
+    cursor.execute(
+        """
+            CREATE INDEX IF NOT EXISTS step_logs_deployment
+            ON step_logs (deployment, started_at)
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS step_logs_started_at ON step_logs (started_at)"
+    )
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS step_log_chunks (
+                log_id INTEGER,
+                sequence INTEGER,
+                data BLOB,
+                PRIMARY KEY (log_id, sequence)
+            )
+        """
+    )
+
+
+def compress(data: bytes) -> Iterator[bytes]:
+    # One zlib stream split into chunks, so reads can decompress it piece by piece
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    for offset in range(0, len(data), CHUNK_SIZE):
+        chunk = compressor.compress(data[offset : offset + CHUNK_SIZE])
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def prune(cursor: sqlite3.Cursor) -> None:
+    cutoff = (datetime.now(timezone.utc) - RETENTION).isoformat()
+    cursor.execute(
+        """
+            DELETE FROM step_log_chunks
+            WHERE log_id IN (SELECT id FROM step_logs WHERE started_at < ?)
+        """,
+        (cutoff,),
+    )
+    cursor.execute("DELETE FROM step_logs WHERE started_at < ?", (cutoff,))
+    # The newest logs are kept up to the size cap, everything older goes
+    cursor.execute(
+        """
+            SELECT MAX(id) FROM (
+                SELECT id, SUM(stored) OVER (ORDER BY id DESC) AS total
+                FROM step_logs
+            )
+            WHERE total > ?
+        """,
+        (MAX_SIZE,),
+    )
+    last_id = cursor.fetchone()[0]
+    if last_id is not None:
+        cursor.execute("DELETE FROM step_log_chunks WHERE log_id <= ?", (last_id,))
+        cursor.execute("DELETE FROM step_logs WHERE id <= ?", (last_id,))
+    cursor.execute("PRAGMA incremental_vacuum").fetchall()
+
+
+def save_logs(trace_id: str, deployment: str, role: str, entries: list[LogEntry]) -> None:
+    if ENABLED:
+        try:
+            with connect() as database:
+                cursor = database.cursor()
+                create_log_database(cursor)
+                for entry in entries:
+                    data = (entry.output or "").encode()
+                    # The end of the output is where a failed build says why
+                    truncated = max(len(data) - MAX_STEP_OUTPUT, 0)
+                    chunks = list(compress(data[truncated:]))
+                    cursor.execute(
+                        """
+                            INSERT INTO step_logs
+                            (trace_id, deployment, role, step, exit_code, started_at,
+                            finished_at, size, stored, truncated)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        (
+                            trace_id,
+                            deployment,
+                            role,
+                            entry.step,
+                            entry.exit_code,
+                            entry.started_at.isoformat(),
+                            (entry.started_at + timedelta(seconds=entry.duration)).isoformat(),
+                            len(data),
+                            sum(len(chunk) for chunk in chunks),
+                            truncated,
+                        ),
+                    )
+                    log_id = cursor.lastrowid
+                    cursor.executemany(
+                        "INSERT INTO step_log_chunks (log_id, sequence, data) VALUES (?, ?, ?)",
+                        [(log_id, sequence, chunk) for sequence, chunk in enumerate(chunks)],
+                    )
+                prune(cursor)
+                database.commit()
+        except sqlite3.Error as error:
+            LOGGER.error(f"Failed to save step logs of {deployment}: {error}")
+
+
+def to_timestamp(moment: datetime) -> str:
+    # Stored times are UTC, naive bounds are taken to be UTC as well
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).isoformat()
+
+
+def find_logs(
+    deployment: str | None = None,
+    step: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    failed: bool = False,
+) -> Iterator[dict]:
+    conditions = []
+    parameters = []
+    if deployment is not None:
+        conditions.append("deployment = ?")
+        parameters.append(deployment)
+    if step is not None:
+        conditions.append("step = ?")
+        parameters.append(step)
+    if since is not None:
+        conditions.append("started_at >= ?")
+        parameters.append(to_timestamp(since))
+    if until is not None:
+        conditions.append("started_at < ?")
+        parameters.append(to_timestamp(until))
+    if failed:
+        conditions.append("exit_code != 0")
+    where = f"WHERE {' AND '.join(conditions)}" if 0 != len(conditions) else ""
+    with connect() as database:
+        cursor = database.cursor()
+        create_log_database(cursor)
+        cursor.execute(f"SELECT * FROM step_logs {where} ORDER BY started_at, id", parameters)
+        for row in cursor:
+            yield {key: row[key] for key in row.keys()}
+
+
+def read_log(log_id: int) -> Iterator[str]:
+    # Chunks are fetched and decompressed one at a time, a log is never held whole
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    with connect() as database:
+        cursor = database.execute(
+            "SELECT data FROM step_log_chunks WHERE log_id = ? ORDER BY sequence",
+            (log_id,),
+        )
+        for row in cursor:
+            lines = (pending + decoder.decode(decompressor.decompress(row["data"]))).split("\n")
+            pending = lines.pop()
+            yield from lines
+    pending += decoder.decode(decompressor.flush(), final=True)
+    if pending:
+        yield pending
@@ -1,14 +1,110 @@
+from argparse import ArgumentParser
+from deploy import get_deployment_records
+from garbage import collect
 from menu import MenuContext
 from menus import MAIN_MENU
+from planning import format_plans, plan_all, plan_deploy, plan_update
+from profiling import enable
+from reconcile import DEFAULT_INTERVAL_SECONDS, reconcile, run_loop
+from restore import restore_all
+from steps import DEFAULT_CONFIG_FILE, Properties
+import sys
+from tracing import enable as enable_tracing
+
+
+def plan(target: str, config_file: str) -> int:
+    exit_code = 0
+    records = {
+        record[Properties.NAME]: record for record in get_deployment_records()
+    }
+    if "all" == target:
+        plans = plan_all()
+    elif target in records:
+        plans = [plan_update(records[target])]
+    else:
+        try:
+            with open(config_file) as file:
+                plans = [plan_deploy(target, file.read())]
+        except OSError as error:
+            plans = []
+            exit_code = -1
+            print(f"Cannot plan {target}: {error}")
+    print(format_plans(plans))
+    return exit_code
 
 
 def main() -> int:
-    menu_context = MenuContext()
-    menu_context.add_menu(MAIN_MENU)
-    menu_context.show()
+    parser = ArgumentParser(description="Nexus deployment manager")
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="converge Docker and the reverse proxy on nexus.db instead of showing the menu",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=0,
+        help=f"repeat reconciliation every INTERVAL seconds (e.g. {DEFAULT_INTERVAL_SECONDS})",
+    )
+    parser.add_argument(
+        "--gc",
+        action="store_true",
+        help="remove containers, images and proxy configs not referenced by nexus.db",
+    )
+    parser.add_argument(
+        "--restore",
+        action="store_true",
+        help="recreate missing containers from their committed images after a host reboot",
+    )
+    parser.add_argument(
+        "--plan",
+        metavar="TARGET",
+        help="show the steps and estimated time of updating a deployment by name, "
+        "of updating all deployments with 'all', or of deploying a repository",
+    )
+    parser.add_argument(
+        "--config",
+        default=DEFAULT_CONFIG_FILE,
+        help="nexus.toml to plan a new repository with",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only log the planned changes"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write a profile report for every deployment run",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="append spans of every run to the trace file for waterfall.py",
+    )
+    arguments = parser.parse_args()
+    if arguments.profile:
+        enable()
+    if arguments.trace:
+        enable_tracing()
+
+    exit_code = 0
+    if arguments.reconcile and 0 < arguments.interval:
+        run_loop(arguments.interval, arguments.dry_run)
+    elif arguments.reconcile:
+        exit_code, output = reconcile(arguments.dry_run)
+    elif arguments.gc:
+        exit_code, output = collect(arguments.dry_run)
+    elif arguments.restore:
+        exit_code, output = restore_all()
+        print(output)
+    elif arguments.plan is not None:
+        exit_code = plan(arguments.plan, arguments.config)
+    else:
+        menu_context = MenuContext()
+        menu_context.add_menu(MAIN_MENU)
+        menu_context.show()
 
-    return 0
+    return exit_code
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
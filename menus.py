@@ -1,119 +1,25 @@
-from deploy import Deployment, get_deployments
-from environment import ContainerEnvironment, Images
+from deploy import get_deployments
+from garbage import collect
 import logging
 from menu import Choice, ListMenu, TextMenu
-from steps import (
-    AddDomainToCertificate,
-    BuildNginxReverseProxyConfig,
-    GitClone,
-    GitPull,
-    Properties,
-    ReadNexusConfig,
-    ReloadNginx,
-    RemoveNginxConfig,
-    TeardownEnvironment,
-    TestNginxConfig,
-)
+from pipelines import deploy, teardown, update
+from reconcile import reconcile
+from restore import restore_all
+from snapshots import get_snapshots, rollback
+from steps import Properties
 
 LOGGER = logging.getLogger(__name__)
-REVERSR_PROXY_NAME = "nexus-reverse-proxy"
 
 logging.basicConfig(level=logging.INFO)
 
 
-def get_reverse_proxy() -> Deployment:
-    return Deployment(
-        ContainerEnvironment(
-            container_name=REVERSR_PROXY_NAME,
-            container_image=Images.REVERSE_PROXY,
-            container_ports={"80/tcp": 80, "443/tcp": 443},
-        ),
-        REVERSR_PROXY_NAME,
-    )
-
-
-# TODO return and handle exit code
-def update(deployment: Deployment) -> None:
-    reverse_proxy_deployment = get_reverse_proxy()
-    reverse_proxy_deployment.add_step(
-        RemoveNginxConfig(deployment.get_property(Properties.DOMAIN))
-    )
-    exit_code, output = reverse_proxy_deployment.run_all_steps()
-
-    if 0 == exit_code:
-        deployment.add_step(GitPull())
-        deployment.add_step(ReadNexusConfig())
-        exit_code, output = deployment.run_all_steps()
-
-    if 0 == exit_code:
-        name = deployment.get_property(Properties.NAME)
-        domain = deployment.get_property(Properties.DOMAIN)
-        email = deployment.get_property(Properties.EMAIL)
-        reverse_proxy_deployment.add_step(AddDomainToCertificate(domain, email))
-        reverse_proxy_deployment.add_step(BuildNginxReverseProxyConfig(domain, name))
-        reverse_proxy_deployment.add_step(TestNginxConfig())
-        reverse_proxy_deployment.add_step(ReloadNginx())
-        exit_code, output = reverse_proxy_deployment.run_all_steps()
-
-    if 0 != exit_code:
-        logging.error(f"Exit code: {exit_code}, Error message {output}")
-    else:
-        deployment.save()
-
-
-# TODO return and handle exit code
-def teardown(deployment: Deployment) -> None:
-    reverse_proxy_deployment = get_reverse_proxy()
-    reverse_proxy_deployment.add_step(
-        RemoveNginxConfig(deployment.get_property(Properties.DOMAIN))
-    )
-    reverse_proxy_deployment.add_step(TestNginxConfig())
-    reverse_proxy_deployment.add_step(ReloadNginx())
-    exit_code, output = reverse_proxy_deployment.run_all_steps()
-
-    if 0 == exit_code:
-        deployment.add_step(TeardownEnvironment())
-        exit_code, output = deployment.run_all_steps()
-
-    if 0 != exit_code:
-        logging.error(f"Exit code: {exit_code}, Error message {output}")
-    else:
-        deployment.delete()
-
-
 class StaticSiteMenu(TextMenu):
     def __init__(self) -> None:
         super().__init__("Deploy new static site", "Enter repo to deploy: ")
 
     def on_select(self, selection: str) -> bool:
-        valid = True
-        reverse_proxy_deployment = get_reverse_proxy()
-        environment = ContainerEnvironment()
-        deployment = Deployment(environment)
-        deployment.add_step(GitClone(selection))
-        deployment.add_step(ReadNexusConfig())
-        exit_code, output = deployment.run_all_steps()
-
-        if 0 == exit_code:
-            name = deployment.get_property(Properties.NAME)
-            domain = deployment.get_property(Properties.DOMAIN)
-            email = deployment.get_property(Properties.EMAIL)
-            reverse_proxy_deployment.add_step(AddDomainToCertificate(domain, email))
-            reverse_proxy_deployment.add_step(
-                BuildNginxReverseProxyConfig(domain, name)
-            )
-            reverse_proxy_deployment.add_step(TestNginxConfig())
-            reverse_proxy_deployment.add_step(ReloadNginx())
-            exit_code, output = reverse_proxy_deployment.run_all_steps()
-
-        if 0 != exit_code:
-            # TODO kill container and prune if failure
-            logging.error(f"Exit code: {exit_code}, Error message {output}")
-            valid = False
-        else:
-            deployment.save()
-
-        return valid
+        exit_code, output = deploy(selection)
+        return 0 == exit_code
 
 
 NEW_DEPLOYMENT_CHOICES = [
@@ -152,6 +58,38 @@ TEARDOWN_DEPLOYMENT_MENU = {
     ],
 }
 
+def get_snapshot_choices(deployment) -> list[Choice]:
+    current = deployment.get_property(Properties.SNAPSHOT)
+    return [
+        Choice(
+            title=f"{snapshot[Properties.BUILT_AT]} {snapshot[Properties.COMMIT_SHA]}"
+            + (" (current)" if snapshot["path"] == current else ""),
+            callback=lambda snapshot=snapshot: rollback(deployment, snapshot),
+        )
+        for snapshot in get_snapshots(deployment.get_property(Properties.NAME))
+    ]
+
+
+ROLLBACK_DEPLOYMENT_MENU = {
+    "title": "Rollback Deployment",
+    "prompt": "Select deployment: ",
+    "choices": [],
+    "refresh_choices": lambda choices: [
+        Choice(
+            title=str(deployment.get_property(Properties.NAME)),
+            next_menu=ListMenu(
+                title=f"Rollback {deployment.get_property(Properties.NAME)}",
+                prompt="Select snapshot: ",
+                choices=[],
+                refresh_choices=lambda choices, deployment=deployment: get_snapshot_choices(
+                    deployment
+                ),
+            ),
+        )
+        for deployment in get_deployments()
+    ],
+}
+
 MAIN_MENU_CHOICES = [
     {
         "title": "New Deployment",
@@ -163,11 +101,31 @@ MAIN_MENU_CHOICES = [
         "callback": None,
         "next_menu": ListMenu(**UPDATE_DEPLOYMENT_MENU),
     },
+    {
+        "title": "Rollback Deployment",
+        "callback": None,
+        "next_menu": ListMenu(**ROLLBACK_DEPLOYMENT_MENU),
+    },
     {
         "title": "Teardown Deployment",
         "callback": None,
         "next_menu": ListMenu(**TEARDOWN_DEPLOYMENT_MENU),
     },
+    {
+        "title": "Reconcile Deployments",
+        "callback": reconcile,
+        "next_menu": None,
+    },
+    {
+        "title": "Restore Deployments",
+        "callback": restore_all,
+        "next_menu": None,
+    },
+    {
+        "title": "Collect Garbage",
+        "callback": collect,
+        "next_menu": None,
+    },
 ]
 
 MAIN_MENU = ListMenu(
@@ -0,0 +1,445 @@
+from deploy import Deployment, Roles, get_deployment_records
+from docker import errors
+from enum import StrEnum, auto
+from environment import BASE_DIRECTORY, ContainerEnvironment, Images, DEFAULT_UPSTREAM_PORT
+from hosts import HOSTS
+import logging
+from profiling import profiled
+from settings import get_setting
+from snapshots import commit_image, prune_snapshots
+from steps import (
+    AddDomainToCertificate,
+    BuildNginxProxyMapConfig,
+    BuildNginxReverseProxyConfig,
+    CopyDirectory,
+    GitClone,
+    GitPull,
+    Properties,
+    ProxyLayouts,
+    ReadGitRemote,
+    ReadNexusConfig,
+    ReloadNginx,
+    RemoveNginxConfig,
+    SetName,
+    SNAPSHOT_DIRECTORY,
+    TeardownEnvironment,
+    TestNginxConfig,
+)
+import time
+from tracing import traced
+
+
+class UpdateStrategies(StrEnum):
+    IN_PLACE = auto()
+    BLUE_GREEN = auto()
+
+
+LOGGER = logging.getLogger(__name__)
+REVERSR_PROXY_NAME = "nexus-reverse-proxy"
+DEFAULT_DRAIN_SECONDS = 10
+PROXY_LAYOUT = get_setting("proxy", "layout", ProxyLayouts.FILES)
+UPDATE_STRATEGY = get_setting("update", "strategy", UpdateStrategies.IN_PLACE)
+DRAIN_SECONDS = get_setting("update", "drain_seconds", DEFAULT_DRAIN_SECONDS)
+RETIRED_SUFFIX = "-retired"
+
+
+def get_reverse_proxy() -> Deployment:
+    return Deployment(
+        ContainerEnvironment(
+            container_name=REVERSR_PROXY_NAME,
+            container_image=Images.REVERSE_PROXY,
+            container_ports={"80/tcp": 80, "443/tcp": 443},
+            # Docker brings the proxy back after a reboot, sites are restored by Nexus
+            restart_policy={"Name": "unless-stopped"},
+        ),
+        REVERSR_PROXY_NAME,
+    )
+
+
+def get_proxy_config(properties: dict) -> BuildNginxReverseProxyConfig:
+    upstream = properties.get(Properties.UPSTREAM)
+    if not upstream:
+        upstream = f"{properties[Properties.NAME]}:{DEFAULT_UPSTREAM_PORT}"
+    # sqlite hands booleans back as integers
+    http2 = properties.get(Properties.PROXY_HTTP2)
+    if http2 in (0, 1):
+        http2 = bool(http2)
+    return BuildNginxReverseProxyConfig(
+        properties[Properties.DOMAIN],
+        upstream,
+        keepalive=properties.get(Properties.PROXY_KEEPALIVE),
+        http2=http2,
+        cache_ttl=properties.get(Properties.PROXY_CACHE_TTL),
+        buffer_size=properties.get(Properties.PROXY_BUFFER_SIZE),
+    )
+
+
+def get_proxy_sites(
+    deployment: Deployment | None = None, exclude: str | None = None
+) -> list[BuildNginxReverseProxyConfig]:
+    sites = {}
+    for record in get_deployment_records():
+        if record[Properties.DOMAIN]:
+            sites[record[Properties.DOMAIN]] = get_proxy_config(record)
+    if deployment is not None:
+        sites[deployment.get_property(Properties.DOMAIN)] = get_proxy_config(
+            {property: deployment.get_property(property) for property in Properties}
+        )
+    if exclude is not None:
+        sites.pop(exclude, None)
+    return list(sites.values())
+
+
+def add_reverse_proxy_steps(
+    reverse_proxy_deployment: Deployment,
+    deployment: Deployment,
+    certificate: bool = True,
+    force_reload: bool = False,
+) -> None:
+    domain = deployment.get_property(Properties.DOMAIN)
+    email = deployment.get_property(Properties.EMAIL)
+    deployment.set_properties(
+        {Properties.UPSTREAM: deployment.environment.get_upstream()}
+    )
+    reverse_proxy_deployment.link(deployment)
+    reverse_proxy_deployment.set_subject(deployment.get_subject(), Roles.PROXY)
+    if certificate:
+        reverse_proxy_deployment.add_step(AddDomainToCertificate(domain, email))
+    if ProxyLayouts.MAP == PROXY_LAYOUT:
+        # Test and reload are only added by the step when the config changed
+        reverse_proxy_deployment.add_step(
+            BuildNginxProxyMapConfig(
+                get_proxy_sites(deployment), force_reload=force_reload
+            )
+        )
+    else:
+        reverse_proxy_deployment.add_step(
+            get_proxy_config(
+                {property: deployment.get_property(property) for property in Properties}
+            )
+        )
+        reverse_proxy_deployment.add_step(TestNginxConfig())
+        reverse_proxy_deployment.add_step(ReloadNginx())
+
+
+def add_remove_proxy_steps(
+    reverse_proxy_deployment: Deployment, deployment: Deployment
+) -> None:
+    reverse_proxy_deployment.link(deployment)
+    reverse_proxy_deployment.set_subject(deployment.get_subject(), Roles.PROXY)
+    if ProxyLayouts.MAP == PROXY_LAYOUT:
+        reverse_proxy_deployment.add_step(
+            BuildNginxProxyMapConfig(
+                get_proxy_sites(exclude=deployment.get_property(Properties.DOMAIN))
+            )
+        )
+    else:
+        reverse_proxy_deployment.add_step(
+            RemoveNginxConfig(deployment.get_property(Properties.DOMAIN))
+        )
+        reverse_proxy_deployment.add_step(TestNginxConfig())
+        reverse_proxy_deployment.add_step(ReloadNginx())
+
+
+@traced
+@profiled("deploy")
+def deploy(repository: str) -> tuple[int, str]:
+    reverse_proxy_deployment = get_reverse_proxy()
+    environment = ContainerEnvironment(host=HOSTS.get_least_loaded())
+    deployment = Deployment(environment)
+    deployment.add_step(GitClone(repository))
+    deployment.add_step(ReadNexusConfig())
+    exit_code, output = deployment.run_all_steps()
+
+    if 0 == exit_code:
+        add_reverse_proxy_steps(reverse_proxy_deployment, deployment)
+        exit_code, output = reverse_proxy_deployment.run_all_steps()
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+        environment.teardown()
+    else:
+        commit_image(deployment)
+        deployment.save()
+        prune_snapshots(deployment)
+
+    return exit_code, output
+
+
+@traced
+def restore(record: dict) -> tuple[int, str]:
+    # The committed image already holds the build, so nothing is cloned or built
+    exit_code = 0
+    output = ""
+    name = record[Properties.NAME]
+    deployment = None
+    try:
+        environment = ContainerEnvironment(
+            container_image=record[Properties.IMAGE],
+            working_directory=record["working_directory"] or BASE_DIRECTORY,
+            host=HOSTS.get(record["host"]),
+        )
+        deployment = Deployment(environment)
+    except errors.APIError as error:
+        exit_code = -1
+        output = f"Failed to restore {name} from {record[Properties.IMAGE]}: {error}"
+
+    if 0 == exit_code:
+        deployment.id = record["id"]
+        deployment.set_properties({property: record[property] for property in Properties})
+        deployment.add_step(SetName(name))
+        exit_code, output = deployment.run_all_steps()
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+        if deployment is not None:
+            deployment.environment.teardown()
+    else:
+        deployment.set_properties(
+            {Properties.UPSTREAM: deployment.environment.get_upstream()}
+        )
+        deployment.save()
+        output = f"Restored {name} from {record[Properties.IMAGE]}"
+
+    return exit_code, output
+
+
+def resume(record: dict) -> tuple[int, str]:
+    # Remote sites publish a new random port on every start, so the upstream is read again
+    name = record[Properties.NAME]
+    deployment = None
+    try:
+        environment = ContainerEnvironment(
+            container_name=name,
+            working_directory=record["working_directory"] or BASE_DIRECTORY,
+            host=HOSTS.get(record["host"]),
+        )
+        deployment = Deployment(environment, name)
+        exit_code, output = environment.start()
+    except errors.APIError as error:
+        exit_code = -1
+        output = f"Failed to start {name}: {error}"
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+    else:
+        deployment.id = record["id"]
+        deployment.set_properties(
+            {Properties.UPSTREAM: deployment.environment.get_upstream()}
+        )
+        deployment.save()
+        output = f"Started {name}"
+
+    return exit_code, output
+
+
+@traced
+@profiled("recreate")
+def recreate(record: dict) -> tuple[int, str]:
+    name = record[Properties.NAME]
+    exit_code = -1
+    output = f"No image recorded for {name}"
+    if record[Properties.IMAGE]:
+        exit_code, output = restore(record)
+
+    # Without a usable image the deployment is rebuilt from its repository
+    deployment = None
+    if 0 != exit_code and record[Properties.REPOSITORY]:
+        LOGGER.info(f"{output}, rebuilding {name}")
+        environment = ContainerEnvironment(host=HOSTS.get(record["host"]))
+        deployment = Deployment(environment)
+        deployment.id = record["id"]
+        deployment.add_step(GitClone(record[Properties.REPOSITORY]))
+        deployment.add_step(ReadNexusConfig(rename=False))
+        deployment.add_step(SetName(name))
+        exit_code, output = deployment.run_all_steps()
+    elif 0 != exit_code:
+        output = f"No image or repository recorded for {name}"
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+        if deployment is not None:
+            deployment.environment.teardown()
+    elif deployment is not None:
+        deployment.set_properties(
+            {Properties.UPSTREAM: deployment.environment.get_upstream()}
+        )
+        commit_image(deployment, record[Properties.IMAGE])
+        deployment.save()
+        prune_snapshots(deployment)
+
+    return exit_code, output
+
+
+def update_in_place(deployment: Deployment) -> tuple[int, str]:
+    reverse_proxy_deployment = get_reverse_proxy()
+    exit_code = 0
+    output = ""
+    reverse_proxy_deployment.link(deployment)
+    reverse_proxy_deployment.set_subject(deployment.get_subject(), Roles.PROXY)
+    start = time.perf_counter()
+    if ProxyLayouts.FILES == PROXY_LAYOUT:
+        reverse_proxy_deployment.add_step(
+            RemoveNginxConfig(deployment.get_property(Properties.DOMAIN))
+        )
+        exit_code, output = reverse_proxy_deployment.run_all_steps()
+
+    if 0 == exit_code:
+        deployment.add_step(GitPull())
+        deployment.add_step(ReadNexusConfig())
+        exit_code, output = deployment.run_all_steps()
+
+    if 0 == exit_code:
+        add_reverse_proxy_steps(reverse_proxy_deployment, deployment)
+        exit_code, output = reverse_proxy_deployment.run_all_steps()
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+    else:
+        commit_image(deployment)
+        deployment.save()
+        prune_snapshots(deployment)
+        if ProxyLayouts.FILES == PROXY_LAYOUT:
+            output = f"Switchover gap: {time.perf_counter() - start:.3f}s"
+            LOGGER.info(output)
+
+    return exit_code, output
+
+
+def restore_blue(
+    deployment: Deployment,
+    green_deployment: Deployment,
+    name: str,
+    renamed: bool,
+    flipped: bool,
+) -> None:
+    # The old container gets its name and route back, the new one is removed
+    green_deployment.environment.teardown()
+    if renamed:
+        deployment.add_step(SetName(name))
+        deployment.run_all_steps()
+    if flipped:
+        reverse_proxy_deployment = get_reverse_proxy()
+        add_reverse_proxy_steps(reverse_proxy_deployment, deployment, False, True)
+        exit_code, output = reverse_proxy_deployment.run_all_steps()
+        if 0 != exit_code:
+            logging.error(f"Failed to route back to the old container: {output}")
+
+
+def update_blue_green(deployment: Deployment) -> tuple[int, str]:
+    name = deployment.get_property(Properties.NAME)
+    # Both containers are renamed on the way, their history stays under the deployment
+    deployment.set_subject(name)
+    exit_code = 0
+    output = ""
+    if deployment.get_property(Properties.REPOSITORY) is None:
+        deployment.add_step(ReadGitRemote())
+        exit_code, output = deployment.run_all_steps()
+
+    # The new revision is built beside the old container, which keeps serving
+    green_deployment = None
+    if 0 == exit_code:
+        green_deployment = Deployment(
+            ContainerEnvironment(host=deployment.environment.get_host())
+        )
+        green_deployment.set_subject(name)
+        green_deployment.set_properties(
+            {Properties.REPOSITORY: deployment.get_property(Properties.REPOSITORY)}
+        )
+        green_deployment.add_step(
+            GitClone(deployment.get_property(Properties.REPOSITORY))
+        )
+        green_deployment.add_step(ReadNexusConfig(rename=False))
+        # Earlier snapshots move with the deployment so rollbacks keep working
+        green_deployment.add_step(
+            CopyDirectory(deployment.environment, SNAPSHOT_DIRECTORY)
+        )
+        exit_code, output = green_deployment.run_all_steps()
+
+    # Certificates are checked first so that only the flip itself is timed
+    reverse_proxy_deployment = get_reverse_proxy()
+    if 0 == exit_code:
+        reverse_proxy_deployment.link(green_deployment)
+        reverse_proxy_deployment.set_subject(green_deployment.get_subject(), Roles.PROXY)
+        reverse_proxy_deployment.add_step(
+            AddDomainToCertificate(
+                green_deployment.get_property(Properties.DOMAIN),
+                green_deployment.get_property(Properties.EMAIL),
+            )
+        )
+        exit_code, output = reverse_proxy_deployment.run_all_steps()
+
+    # The new container takes the name first, so the proxy is only written once.
+    # nginx keeps the old container's resolved address until it reloads.
+    renamed = False
+    if 0 == exit_code:
+        deployment.add_step(SetName(f"{name}{RETIRED_SUFFIX}"))
+        exit_code, output = deployment.run_all_steps()
+        renamed = 0 == exit_code
+    if 0 == exit_code:
+        green_deployment.add_step(SetName(name))
+        exit_code, output = green_deployment.run_all_steps()
+
+    switchover = None
+    if 0 == exit_code:
+        start = time.perf_counter()
+        # The upstream name may be unchanged, so nginx is reloaded to resolve it again
+        add_reverse_proxy_steps(reverse_proxy_deployment, green_deployment, False, True)
+        exit_code, output = reverse_proxy_deployment.run_all_steps()
+        switchover = time.perf_counter() - start
+
+    if 0 != exit_code and green_deployment is not None:
+        restore_blue(
+            deployment, green_deployment, name, renamed, switchover is not None
+        )
+
+    # Recorded before the old container goes, so nexus.db always names the serving one
+    if 0 == exit_code:
+        green_deployment.id = deployment.id
+        commit_image(green_deployment, deployment.get_property(Properties.IMAGE))
+        green_deployment.save()
+        LOGGER.info(f"Switched {name} to new revision, draining for {DRAIN_SECONDS}s")
+        time.sleep(DRAIN_SECONDS)
+        # Green is serving and recorded, a leftover blue is only garbage to collect
+        deployment.add_step(TeardownEnvironment())
+        teardown_exit_code, teardown_output = deployment.run_all_steps()
+        if 0 != teardown_exit_code:
+            LOGGER.warning(f"Failed to remove the old container of {name}: {teardown_output}")
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+    else:
+        prune_snapshots(green_deployment)
+        output = f"Switchover gap: {switchover:.3f}s"
+        LOGGER.info(output)
+
+    return exit_code, output
+
+
+@traced
+@profiled("update")
+def update(deployment: Deployment) -> tuple[int, str]:
+    if UpdateStrategies.BLUE_GREEN == UPDATE_STRATEGY:
+        exit_code, output = update_blue_green(deployment)
+    else:
+        exit_code, output = update_in_place(deployment)
+    return exit_code, output
+
+
+@traced
+@profiled("teardown")
+def teardown(deployment: Deployment) -> tuple[int, str]:
+    reverse_proxy_deployment = get_reverse_proxy()
+    add_remove_proxy_steps(reverse_proxy_deployment, deployment)
+    exit_code, output = reverse_proxy_deployment.run_all_steps()
+
+    if 0 == exit_code:
+        deployment.add_step(TeardownEnvironment())
+        exit_code, output = deployment.run_all_steps()
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+    else:
+        deployment.delete()
+
+    return exit_code, output
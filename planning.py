@@ -0,0 +1,350 @@
+from deploy import (
+    DATABASE_NAME,
+    Deployment,
+    Roles,
+    chain_fingerprints,
+    create_deployment_database,
+    get_deployment_records,
+)
+from environment import BASE_DIRECTORY, Environment
+import logging
+from pipelines import (
+    DRAIN_SECONDS,
+    PROXY_LAYOUT,
+    RETIRED_SUFFIX,
+    REVERSR_PROXY_NAME,
+    UPDATE_STRATEGY,
+    UpdateStrategies,
+    add_reverse_proxy_steps,
+)
+from snapshots import COMMIT_IMAGES, DISK_BUDGET, KEEP, get_image_repository, get_image_tag
+import sqlite3
+from statistics import median
+from steps import (
+    DEFAULT_CONFIG_FILE,
+    SNAPSHOT_DIRECTORY,
+    AddDomainToCertificate,
+    CommitImage,
+    CopyDirectory,
+    GitClone,
+    GitPull,
+    Properties,
+    ProxyLayouts,
+    PruneSnapshots,
+    ReadNexusConfig,
+    RemoveNginxConfig,
+    SetName,
+    SourceFields,
+    Step,
+    TeardownEnvironment,
+)
+import subprocess
+from tomllib import loads, TOMLDecodeError
+
+LOGGER = logging.getLogger(__name__)
+HISTORY_SAMPLES = 10
+REMOTE_TIMEOUT_SECONDS = 10
+
+
+class PlanEnvironment(Environment):
+    # Answers the few commands whose output steps depend on and runs nothing
+    def __init__(
+        self,
+        name: str = "",
+        config: str = "",
+        revision: str | None = None,
+        upstream: str | None = None,
+        working_directory: str = BASE_DIRECTORY,
+    ) -> None:
+        super().__init__(name=name, working_directory=working_directory)
+        self.config = config
+        self.revision = revision
+        self.upstream = upstream
+
+    def run_commands(self, commands: list[str]) -> tuple[int, str]:
+        output = ""
+        for command in commands:
+            if f"cat {DEFAULT_CONFIG_FILE}" in command:
+                output = self.config
+            elif "git rev-parse HEAD" == command:
+                output = self.revision or ""
+            else:
+                output = ""
+        return 0, output
+
+    def teardown(self) -> tuple[int, str]:
+        return 0, ""
+
+    def write_file(self, path: str, content: str) -> tuple[int, str]:
+        return 0, ""
+
+    def copy_directory(self, path: str, destination: Environment) -> tuple[int, str]:
+        return 0, ""
+
+    def commit_image(self, repository: str, tag: str) -> tuple[int, str]:
+        return 0, f"{repository}:{tag}"
+
+    def get_upstream(self) -> str:
+        upstream = self.upstream
+        if upstream is None:
+            upstream = super().get_upstream()
+        return upstream
+
+
+class PlannedStep:
+    def __init__(self, subject: str, role: Roles, deployment: str, step: str) -> None:
+        self.subject = subject
+        self.role = role
+        self.deployment = deployment
+        self.step = step
+        self.estimate = None
+        self.unchanged = False
+
+
+class Plan:
+    def __init__(self, title: str) -> None:
+        self.title = title
+        self.steps = []
+        self.error = None
+
+    def get_estimate(self) -> float:
+        return sum(step.estimate or 0.0 for step in self.steps)
+
+    def get_skippable(self) -> float:
+        return sum(step.estimate or 0.0 for step in self.steps if step.unchanged)
+
+
+def get_remote_revision(repository: str, config: str) -> str | None:
+    # Asks the remote directly, so no container is needed to learn what would be built
+    revision = None
+    reference = "HEAD"
+    try:
+        branch = loads(config).get("source", {}).get(SourceFields.BRANCH)
+        if branch:
+            reference = f"refs/heads/{branch}"
+    except TOMLDecodeError:
+        pass
+    try:
+        result = subprocess.run(
+            ["git", "ls-remote", repository, reference],
+            capture_output=True,
+            text=True,
+            timeout=REMOTE_TIMEOUT_SECONDS,
+        )
+        if 0 == result.returncode and result.stdout:
+            revision = result.stdout.split()[0]
+    except (OSError, subprocess.TimeoutExpired) as error:
+        LOGGER.warning(f"Failed to read the revision of {repository}: {error}")
+    return revision
+
+
+def expand(deployment: Deployment) -> tuple[list[Step], str | None]:
+    # Mirrors Deployment.run_all_steps, without recording history or traces
+    steps = []
+    error = None
+    while deployment.steps and error is None:
+        step = deployment.steps.pop()
+        step.exit_code, step.output = step.run_action(deployment.environment)
+        steps.append(step)
+        if 0 != step.exit_code:
+            error = f"{step.name}: {step.output}"
+        else:
+            deployment.add_steps(step.get_next_steps())
+            deployment.set_properties(step.get_properties())
+    return steps, error
+
+
+def read_history(cursor: sqlite3.Cursor, planned: PlannedStep) -> tuple[list, list]:
+    cursor.execute(
+        """
+            SELECT duration, fingerprint, exit_code
+            FROM step_history
+            WHERE subject = ? AND role = ? AND step = ?
+            ORDER BY id DESC
+            LIMIT ?
+        """,
+        (planned.subject, planned.role, planned.step, HISTORY_SAMPLES),
+    )
+    own = cursor.fetchall()
+    # New deployments are estimated from the same step across all deployments
+    cursor.execute(
+        """
+            SELECT duration, fingerprint, exit_code
+            FROM step_history
+            WHERE role = ? AND step = ? AND exit_code = 0
+            ORDER BY id DESC
+            LIMIT ?
+        """,
+        (planned.role, planned.step, HISTORY_SAMPLES),
+    )
+    return own, cursor.fetchall()
+
+
+def add_run(plan: Plan, deployment: Deployment, revision_known: bool = True) -> None:
+    if plan.error is None:
+        steps, plan.error = expand(deployment)
+        fingerprints = chain_fingerprints(deployment.get_fingerprint_seed(), steps)
+        with sqlite3.connect(DATABASE_NAME) as database:
+            cursor = database.cursor()
+            create_deployment_database(cursor)
+            for step, fingerprint in zip(steps, fingerprints):
+                planned = PlannedStep(
+                    deployment.get_subject(),
+                    deployment.role,
+                    deployment.get_property(Properties.NAME) or deployment.get_subject(),
+                    step.name,
+                )
+                own, shared = read_history(cursor, planned)
+                durations = [row[0] for row in own if 0 == row[2]] or [
+                    row[0] for row in shared
+                ]
+                if 0 != len(durations):
+                    planned.estimate = median(durations)
+                # Site steps can only be skipped if the revision to build is known
+                planned.unchanged = (
+                    0 != len(own)
+                    and 0 == own[0][2]
+                    and fingerprint == own[0][1]
+                    and (revision_known or Roles.PROXY == deployment.role)
+                )
+                plan.steps.append(planned)
+
+
+def add_wait(plan: Plan, subject: str, description: str, seconds: float) -> None:
+    planned = PlannedStep(subject, Roles.SITE, subject, description)
+    planned.estimate = seconds
+    plan.steps.append(planned)
+
+
+def get_reverse_proxy_plan() -> Deployment:
+    return Deployment(PlanEnvironment(REVERSR_PROXY_NAME), REVERSR_PROXY_NAME)
+
+
+def add_finish_run(plan: Plan, deployment: Deployment) -> None:
+    if COMMIT_IMAGES:
+        deployment.add_step(
+            CommitImage(
+                get_image_repository(deployment.get_property(Properties.NAME) or ""),
+                get_image_tag(deployment),
+            )
+        )
+    deployment.add_step(
+        PruneSnapshots([], deployment.get_property(Properties.SNAPSHOT), KEEP, DISK_BUDGET)
+    )
+    add_run(plan, deployment)
+
+
+def plan_deploy(repository: str, config: str) -> Plan:
+    plan = Plan(f"Deploy {repository}")
+    revision = get_remote_revision(repository, config)
+    deployment = Deployment(PlanEnvironment(config=config, revision=revision))
+    deployment.add_step(GitClone(repository))
+    deployment.add_step(ReadNexusConfig())
+    add_run(plan, deployment, revision is not None)
+
+    reverse_proxy_deployment = get_reverse_proxy_plan()
+    if plan.error is None:
+        add_reverse_proxy_steps(reverse_proxy_deployment, deployment)
+    add_run(plan, reverse_proxy_deployment)
+    add_finish_run(plan, deployment)
+    return plan
+
+
+def get_record_deployment(record: dict, revision: str | None) -> Deployment:
+    deployment = Deployment(
+        PlanEnvironment(
+            record[Properties.NAME],
+            record[Properties.CONFIG] or "",
+            revision,
+            record[Properties.UPSTREAM],
+            record["working_directory"] or BASE_DIRECTORY,
+        ),
+        record[Properties.NAME],
+    )
+    deployment.set_properties({property: record[property] for property in Properties})
+    return deployment
+
+
+def plan_update(record: dict) -> Plan:
+    name = record[Properties.NAME]
+    plan = Plan(f"Update {name} ({UPDATE_STRATEGY})")
+    if not record[Properties.CONFIG]:
+        plan.error = f"No config recorded for {name}, deploy or update it once first"
+    revision = None
+    if plan.error is None and record[Properties.REPOSITORY]:
+        revision = get_remote_revision(record[Properties.REPOSITORY], record[Properties.CONFIG])
+    deployment = get_record_deployment(record, revision)
+    reverse_proxy_deployment = get_reverse_proxy_plan()
+    reverse_proxy_deployment.link(deployment)
+    reverse_proxy_deployment.set_subject(deployment.get_subject(), Roles.PROXY)
+
+    if UpdateStrategies.BLUE_GREEN == UPDATE_STRATEGY:
+        green_deployment = Deployment(
+            PlanEnvironment(config=record[Properties.CONFIG] or "", revision=revision)
+        )
+        green_deployment.set_subject(name)
+        green_deployment.add_step(GitClone(record[Properties.REPOSITORY]))
+        green_deployment.add_step(ReadNexusConfig(rename=False))
+        green_deployment.add_step(CopyDirectory(deployment.environment, SNAPSHOT_DIRECTORY))
+        add_run(plan, green_deployment, revision is not None)
+        if plan.error is None:
+            reverse_proxy_deployment.link(green_deployment)
+            reverse_proxy_deployment.set_subject(green_deployment.get_subject(), Roles.PROXY)
+            reverse_proxy_deployment.add_step(
+                AddDomainToCertificate(
+                    green_deployment.get_property(Properties.DOMAIN),
+                    green_deployment.get_property(Properties.EMAIL),
+                )
+            )
+        add_run(plan, reverse_proxy_deployment)
+        deployment.add_step(SetName(f"{name}{RETIRED_SUFFIX}"))
+        add_run(plan, deployment)
+        green_deployment.add_step(SetName(name))
+        add_run(plan, green_deployment)
+        if plan.error is None:
+            add_reverse_proxy_steps(reverse_proxy_deployment, green_deployment, False, True)
+        add_run(plan, reverse_proxy_deployment)
+        add_wait(plan, name, "Drain", DRAIN_SECONDS)
+        deployment.add_step(TeardownEnvironment())
+        add_run(plan, deployment)
+        add_finish_run(plan, green_deployment)
+    else:
+        if ProxyLayouts.FILES == PROXY_LAYOUT:
+            reverse_proxy_deployment.add_step(RemoveNginxConfig(record[Properties.DOMAIN]))
+            add_run(plan, reverse_proxy_deployment)
+        deployment.add_step(GitPull())
+        deployment.add_step(ReadNexusConfig())
+        add_run(plan, deployment, revision is not None)
+        if plan.error is None:
+            add_reverse_proxy_steps(reverse_proxy_deployment, deployment)
+        add_run(plan, reverse_proxy_deployment)
+        add_finish_run(plan, deployment)
+    return plan
+
+
+def plan_all() -> list[Plan]:
+    return [plan_update(record) for record in get_deployment_records()]
+
+
+def format_plans(plans: list[Plan]) -> str:
+    lines = []
+    for plan in plans:
+        lines += [plan.title, f"{'deployment':<28}{'step':<36}{'estimate (s)':>14}"]
+        for step in plan.steps:
+            estimate = "?" if step.estimate is None else f"{step.estimate:.2f}"
+            flag = "  unchanged" if step.unchanged else ""
+            lines.append(f"{step.deployment[:27]:<28}{step.step[:35]:<36}{estimate:>14}{flag}")
+        if plan.error is not None:
+            lines.append(f"Plan incomplete: {plan.error}")
+        lines += [
+            f"Estimated: {plan.get_estimate():.2f}s, "
+            f"{plan.get_skippable():.2f}s in unchanged steps",
+            "",
+        ]
+    if 1 < len(plans):
+        lines.append(
+            f"Total for {len(plans)} deployments: "
+            f"{sum(plan.get_estimate() for plan in plans):.2f}s, "
+            f"{sum(plan.get_skippable() for plan in plans):.2f}s in unchanged steps"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,214 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime, timezone
+from enum import StrEnum, auto
+from functools import wraps
+from io import StringIO
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+from settings import get_setting
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_PROFILE_DIRECTORY = "profiles"
+PROFILE_DIRECTORY = get_setting("profiling", "directory", DEFAULT_PROFILE_DIRECTORY)
+REPORT_FUNCTIONS = 40
+REPORT_ALLOCATIONS = 20
+EXEC_START_PATH = re.compile(r"/exec/[^/]+/start")
+MEBIBYTE = 1024 * 1024
+
+
+class Categories(StrEnum):
+    DOCKER = auto()
+    CONTAINER = auto()
+
+
+class StepProfile:
+    def __init__(self, deployment: str, step: str) -> None:
+        self.deployment = deployment
+        self.step = step
+        self.wall = 0.0
+        self.waits = {category: 0.0 for category in Categories}
+        self.peak_memory = 0
+
+    def get_python(self) -> float:
+        return max(self.wall - sum(self.waits.values()), 0.0)
+
+
+class Run:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started_at = datetime.now(timezone.utc)
+        self.steps = []
+        self.lock = threading.Lock()
+        self.profiler = cProfile.Profile()
+
+    def add_step(self, step: StepProfile) -> None:
+        with self.lock:
+            self.steps.append(step)
+
+
+class State(threading.local):
+    def __init__(self) -> None:
+        self.step = None
+        self.waiting = False
+
+
+ENABLED = get_setting("profiling", "enabled", False)
+RUN = None
+RUN_LOCK = threading.Lock()
+STATE = State()
+
+
+def enable(enabled: bool = True) -> None:
+    global ENABLED
+    ENABLED = enabled
+
+
+def is_enabled() -> bool:
+    return ENABLED
+
+
+@contextmanager
+def wait(category: Categories):
+    # Nested waits are charged to the outermost one, so nothing is counted twice
+    step = STATE.step
+    if step is None or STATE.waiting:
+        yield
+    else:
+        STATE.waiting = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            step.waits[category] += time.perf_counter() - start
+            STATE.waiting = False
+
+
+def instrument(client) -> None:
+    # Every Docker API request goes through the session's send, including exec starts
+    send = client.api.send
+
+    @wraps(send)
+    def timed_send(request, **kwargs):
+        category = Categories.DOCKER
+        if EXEC_START_PATH.search(request.path_url):
+            # A non-streaming exec start returns when the command exits
+            category = Categories.CONTAINER
+        with wait(category):
+            return send(request, **kwargs)
+
+    client.api.send = timed_send
+
+
+@contextmanager
+def profile_step(deployment: str, step: str):
+    if RUN is None:
+        yield
+    else:
+        profile = StepProfile(deployment, step)
+        previous = STATE.step
+        STATE.step = profile
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.wall = time.perf_counter() - start
+            profile.peak_memory = tracemalloc.get_traced_memory()[1]
+            STATE.step = previous
+            RUN.add_step(profile)
+
+
+@contextmanager
+def profile_run(name: str):
+    # Runs do not nest, a pipeline that runs several deployments produces one report
+    global RUN
+    with RUN_LOCK:
+        owner = ENABLED and RUN is None
+        if owner:
+            RUN = Run(name)
+    if not owner:
+        yield
+    else:
+        tracemalloc.start()
+        RUN.profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            RUN.profiler.disable()
+            total = time.perf_counter() - start
+            allocations = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            run = RUN
+            RUN = None
+            write_report(run, total, allocations)
+
+
+def profiled(name: str) -> Callable:
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_run(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def build_report(run: Run, total: float, allocations: tracemalloc.Snapshot) -> str:
+    lines = [
+        f"Nexus profile: {run.name}",
+        f"Started: {run.started_at.isoformat()}",
+        f"Wall time: {total:.3f}s",
+        "",
+        f"{'deployment':<28}{'step':<36}{'wall (s)':>10}{'python (s)':>12}"
+        f"{'docker (s)':>12}{'container (s)':>15}{'peak (MiB)':>12}",
+    ]
+    for step in run.steps:
+        lines.append(
+            f"{step.deployment[:27]:<28}{step.step[:35]:<36}{step.wall:>10.3f}"
+            f"{step.get_python():>12.3f}{step.waits[Categories.DOCKER]:>12.3f}"
+            f"{step.waits[Categories.CONTAINER]:>15.3f}"
+            f"{step.peak_memory / MEBIBYTE:>12.2f}"
+        )
+    steps_wall = sum(step.wall for step in run.steps)
+    lines.append(
+        f"{'total':<64}{steps_wall:>10.3f}"
+        f"{sum(step.get_python() for step in run.steps):>12.3f}"
+        f"{sum(step.waits[Categories.DOCKER] for step in run.steps):>12.3f}"
+        f"{sum(step.waits[Categories.CONTAINER] for step in run.steps):>15.3f}"
+    )
+    lines.append(f"Outside steps: {max(total - steps_wall, 0.0):.3f}s")
+
+    # cProfile only sees the thread that started the run
+    statistics = StringIO()
+    pstats.Stats(run.profiler, stream=statistics).sort_stats("cumulative").print_stats(
+        REPORT_FUNCTIONS
+    )
+    lines += ["", "Functions by cumulative time (main thread)", statistics.getvalue()]
+
+    lines += ["Allocations still held at the end of the run"]
+    for statistic in allocations.statistics("lineno")[:REPORT_ALLOCATIONS]:
+        lines.append(str(statistic))
+    return "\n".join(lines) + "\n"
+
+
+def write_report(run: Run, total: float, allocations: tracemalloc.Snapshot) -> None:
+    os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+    path = os.path.join(
+        PROFILE_DIRECTORY,
+        f"{run.started_at.strftime('%Y%m%dT%H%M%S%fZ')}-{run.name}",
+    )
+    with open(f"{path}.txt", "w") as file:
+        file.write(build_report(run, total, allocations))
+    run.profiler.dump_stats(f"{path}.prof")
+    LOGGER.info(f"Profile written to {path}.txt")
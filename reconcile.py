@@ -0,0 +1,297 @@
+from concurrent.futures import ThreadPoolExecutor
+from deploy import Deployment, get_deployment_records
+from docker import errors
+from environment import DEFAULT_CONTAINER_NETWORK
+from garbage import is_orphan_container
+from hashlib import sha256
+from hosts import HOSTS, Host
+import logging
+from pipelines import (
+    PROXY_LAYOUT,
+    get_proxy_config,
+    get_proxy_sites,
+    get_reverse_proxy,
+    recreate,
+    resume,
+)
+from profiling import profiled
+from requests import RequestException
+from settings import get_setting
+from tracing import bind, traced
+from steps import (
+    AddDomainToCertificate,
+    BuildNginxProxyMapConfig,
+    DEFAULT_CERTIFICATE_NAME,
+    PROXY_CONFIG_DIRECTORY,
+    PROXY_MAP_CONFIG,
+    PROXY_MAP_DIGEST_PREFIX,
+    Properties,
+    ProxyLayouts,
+    ReloadNginx,
+    RemoveNginxConfig,
+    Step,
+    TestNginxConfig,
+)
+import time
+from typing import Callable
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_INTERVAL_SECONDS = 300
+DEFAULT_WORKERS = 8
+WORKERS = get_setting("reconcile", "workers", DEFAULT_WORKERS)
+STATE_SEPARATOR = "--- nexus ---"
+CERTIFICATE_DOMAINS = f"/etc/letsencrypt/live/{DEFAULT_CERTIFICATE_NAME}/domains.txt"
+SHARED_PROXY_CONFIGS = ["00-nexus-cache.conf", "nexus-sites.conf"]
+
+
+class Action:
+    def __init__(self, description: str, apply: Callable[[], tuple[int, str]]) -> None:
+        self.description = description
+        self.apply = apply
+
+    def run(self) -> tuple[int, str]:
+        LOGGER.info(f"Reconcile: {self.description}")
+        try:
+            exit_code, output = self.apply()
+        except Exception as error:
+            exit_code = -1
+            output = str(error)
+        if 0 != exit_code:
+            LOGGER.error(f"Reconcile failed: {self.description}: {output}")
+        return exit_code, output
+
+
+class State:
+    def __init__(self) -> None:
+        self.containers = {}
+        self.proxy_configs = set()
+        self.proxy_map_digest = ""
+        self.certificate_domains = set()
+        self.unreachable = set()
+
+
+def read_containers(host: Host) -> dict | None:
+    # The list endpoint returns every container in one call, without an inspect per container
+    containers = None
+    try:
+        containers = {
+            summary["Names"][0].lstrip("/"): summary
+            for summary in host.get_client().api.containers(all=True)
+        }
+    except (errors.DockerException, RequestException) as error:
+        LOGGER.warning(f"Skipping unreachable host {host.get_name()}: {error}")
+    return containers
+
+
+def read_state(reverse_proxy_deployment: Deployment) -> State:
+    state = State()
+    hosts = HOSTS.get_hosts()
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        results = list(executor.map(read_containers, hosts))
+    for host, containers in zip(hosts, results):
+        if containers is None:
+            state.unreachable.add(host.get_name())
+        else:
+            state.containers[host.get_name()] = containers
+
+    # A single exec covers the proxy configs, the map digest and the certificate
+    exit_code, output = reverse_proxy_deployment.environment.run_command(
+        "sh -c '"
+        f"ls {PROXY_CONFIG_DIRECTORY}; echo {STATE_SEPARATOR}; "
+        f"if [ -e {PROXY_MAP_CONFIG} ]; then head -n 1 {PROXY_MAP_CONFIG}; fi; "
+        f"echo {STATE_SEPARATOR}; "
+        f"if [ -e {CERTIFICATE_DOMAINS} ]; then cat {CERTIFICATE_DOMAINS}; fi'"
+    )
+    if 0 != exit_code:
+        raise RuntimeError(f"Failed to read reverse proxy state: {output}")
+    configs, digest, domains = output.split(f"{STATE_SEPARATOR}\n")
+    state.proxy_configs = set(configs.split()) - set(SHARED_PROXY_CONFIGS)
+    state.proxy_map_digest = digest.strip()
+    state.certificate_domains = set(domains.strip().split(",")) - {""}
+    return state
+
+
+def connect(host: Host, name: str) -> tuple[int, str]:
+    exit_code = 0
+    output = f"Connected {name}"
+    try:
+        client = host.get_client()
+        client.networks.get(DEFAULT_CONTAINER_NETWORK).connect(client.containers.get(name))
+    except errors.APIError as error:
+        exit_code = -1
+        output = f"Failed to connect {name}: {error}"
+    return exit_code, output
+
+
+def remove(host: Host, name: str) -> tuple[int, str]:
+    exit_code = 0
+    output = f"Removed {name}"
+    try:
+        host.get_client().containers.get(name).remove(force=True)
+    except errors.APIError as error:
+        exit_code = -1
+        output = f"Failed to remove {name}: {error}"
+    return exit_code, output
+
+
+def plan_containers(records: list[dict], state: State) -> tuple[list[Action], set]:
+    actions = []
+    recreated = set()
+    names = set(record[Properties.NAME] for record in records)
+    for record in records:
+        name = record[Properties.NAME]
+        host = HOSTS.get(record["host"])
+        if host.get_name() in state.unreachable:
+            continue
+        summary = state.containers[host.get_name()].get(name)
+        if summary is None:
+            recreated.add(name)
+            actions.append(Action(f"recreate {name}", lambda record=record: recreate(record)))
+        else:
+            if "running" != summary["State"]:
+                actions.append(Action(f"start {name}", lambda record=record: resume(record)))
+            networks = summary.get("NetworkSettings", {}).get("Networks", {})
+            if host is HOSTS.get_default() and DEFAULT_CONTAINER_NETWORK not in networks:
+                actions.append(
+                    Action(
+                        f"connect {name} to {DEFAULT_CONTAINER_NETWORK}",
+                        lambda host=host, name=name: connect(host, name),
+                    )
+                )
+
+    for host in HOSTS.get_hosts():
+        for name, summary in state.containers.get(host.get_name(), {}).items():
+            if is_orphan_container(name, summary, names):
+                actions.append(
+                    Action(
+                        f"remove leaked container {name} on {host.get_name()}",
+                        lambda host=host, name=name: remove(host, name),
+                    )
+                )
+    return actions, recreated
+
+
+def plan_proxy(records: list[dict], state: State, recreated: set) -> list[tuple[str, Step]]:
+    steps = []
+    for record in records:
+        domain = record[Properties.DOMAIN]
+        if domain and domain not in state.certificate_domains:
+            steps.append(
+                (
+                    f"add {domain} to certificate",
+                    AddDomainToCertificate(domain, record[Properties.EMAIL]),
+                )
+            )
+
+    if ProxyLayouts.MAP == PROXY_LAYOUT:
+        # The step compares digests itself and only reloads nginx when the map changed
+        step = BuildNginxProxyMapConfig(get_proxy_sites())
+        digest = PROXY_MAP_DIGEST_PREFIX + sha256(step.build_config().encode()).hexdigest()
+        if digest != state.proxy_map_digest:
+            steps.append(("rebuild proxy map config", step))
+    else:
+        domains = set(record[Properties.DOMAIN] for record in records) - {None, ""}
+        for record in records:
+            domain = record[Properties.DOMAIN]
+            if domain and (
+                f"{domain}.conf" not in state.proxy_configs
+                or record[Properties.NAME] in recreated
+            ):
+                steps.append((f"write proxy config for {domain}", get_proxy_config(record)))
+        for config in sorted(state.proxy_configs):
+            domain = config.removesuffix(".conf")
+            if config.endswith(".conf") and domain not in domains:
+                steps.append((f"remove proxy config for {domain}", RemoveNginxConfig(domain)))
+        if 0 != len(steps):
+            steps.append(("test proxy config", TestNginxConfig()))
+            steps.append(("reload proxy", ReloadNginx()))
+    return steps
+
+
+def find_moved(records: list[dict], fresh_records: list[dict]) -> set:
+    # Sites started on a remote host publish a new port, so their proxy config is rewritten
+    upstreams = {record[Properties.NAME]: record[Properties.UPSTREAM] for record in records}
+    return set(
+        record[Properties.NAME]
+        for record in fresh_records
+        if upstreams.get(record[Properties.NAME]) != record[Properties.UPSTREAM]
+    )
+
+
+def run_proxy_steps(
+    reverse_proxy_deployment: Deployment, steps: list[tuple[str, Step]]
+) -> list[tuple[str, int, str]]:
+    # Configs are written and reloaded in one run, then each certificate runs on its own,
+    # so a failed certbot request neither blocks the configs nor the other domains
+    runs = [[step for _, step in steps if not isinstance(step, AddDomainToCertificate)]]
+    runs += [[step] for _, step in steps if isinstance(step, AddDomainToCertificate)]
+    results = []
+    for run in runs:
+        if 0 != len(run):
+            reverse_proxy_deployment.add_steps(run[::-1])
+            exit_code, output = reverse_proxy_deployment.run_all_steps()
+            results.append((run[0].name, exit_code, output))
+    return results
+
+
+def apply_changes(dry_run: bool) -> tuple[int, str]:
+    records = get_deployment_records()
+    reverse_proxy_deployment = get_reverse_proxy()
+    state = read_state(reverse_proxy_deployment)
+    actions, recreated = plan_containers(records, state)
+
+    failures = 0
+    moved = set()
+    if dry_run:
+        for action in actions:
+            LOGGER.info(f"Would {action.description}")
+    else:
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            results = list(executor.map(bind(lambda action: action.run()), actions))
+        failures += sum(1 for exit_code, _ in results if 0 != exit_code)
+        # Recreated and started sites may have new upstreams,
+        # so the proxy is planned from fresh records
+        fresh_records = get_deployment_records()
+        moved = find_moved(records, fresh_records)
+        records = fresh_records
+
+    steps = plan_proxy(records, state, recreated | moved)
+    for description, _ in steps:
+        LOGGER.info(f"{'Would' if dry_run else 'Reconcile:'} {description}")
+    if not dry_run:
+        for name, exit_code, output in run_proxy_steps(reverse_proxy_deployment, steps):
+            if 0 != exit_code:
+                failures += 1
+                LOGGER.error(f"Reconcile failed: reverse proxy: {name}: {output}")
+
+    exit_code = -1 if 0 != failures + len(state.unreachable) else 0
+    output = (
+        f"{len(actions) + len(steps)} changes "
+        f"{'planned' if dry_run else 'applied'}, {failures} failed"
+    )
+    if 0 != len(state.unreachable):
+        output += f"; skipped unreachable hosts {', '.join(sorted(state.unreachable))}"
+    LOGGER.info(output)
+    return exit_code, output
+
+
+@traced
+@profiled("reconcile")
+def reconcile(dry_run: bool = False) -> tuple[int, str]:
+    # Docker and proxy errors end the run with a result, so callers such as menus keep going
+    try:
+        exit_code, output = apply_changes(dry_run)
+    except (errors.DockerException, RequestException, RuntimeError) as error:
+        exit_code = -1
+        output = f"Reconcile failed: {error}"
+        LOGGER.error(output)
+    return exit_code, output
+
+
+def run_loop(interval: int = DEFAULT_INTERVAL_SECONDS, dry_run: bool = False) -> None:
+    while True:
+        try:
+            reconcile(dry_run)
+        except Exception as error:
+            LOGGER.error(f"Reconcile failed: {error}")
+        time.sleep(interval)
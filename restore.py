@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+from deploy import get_deployment_records
+from docker import errors
+from hosts import HOSTS
+import logging
+from pipelines import get_reverse_proxy, restore, resume
+from profiling import profiled
+from reconcile import WORKERS, Action, find_moved, plan_proxy, read_state, run_proxy_steps
+from requests import RequestException
+from steps import Properties
+import time
+from tracing import bind, traced
+
+LOGGER = logging.getLogger(__name__)
+
+
+def restore_deployments() -> tuple[int, str]:
+    # Timed from the first read, so the result is the time until every site is served again
+    started = time.perf_counter()
+    records = get_deployment_records()
+    reverse_proxy_deployment = get_reverse_proxy()
+    # The proxy state is read with an exec, so a proxy stopped by the reboot is started first
+    exit_code, output = reverse_proxy_deployment.environment.start()
+    if 0 != exit_code:
+        raise RuntimeError(output)
+    state = read_state(reverse_proxy_deployment)
+
+    actions = []
+    restored = set()
+    missing = []
+    for record in records:
+        name = record[Properties.NAME]
+        host = HOSTS.get(record["host"])
+        if host.get_name() in state.unreachable:
+            continue
+        summary = state.containers[host.get_name()].get(name)
+        if summary is None and record[Properties.IMAGE]:
+            restored.add(name)
+            actions.append(Action(f"restore {name}", lambda record=record: restore(record)))
+        elif summary is None:
+            missing.append(name)
+        elif "running" != summary["State"]:
+            actions.append(Action(f"start {name}", lambda record=record: resume(record)))
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        results = list(executor.map(bind(lambda action: action.run()), actions))
+    failures = sum(1 for exit_code, _ in results if 0 != exit_code)
+
+    # Restored sites and remote sites that were started have new upstreams,
+    # so the proxy is planned from fresh records
+    fresh_records = get_deployment_records()
+    moved = find_moved(records, fresh_records)
+    steps = plan_proxy(fresh_records, state, restored | moved)
+    for description, _ in steps:
+        LOGGER.info(f"Restore: {description}")
+    for name, exit_code, output in run_proxy_steps(reverse_proxy_deployment, steps):
+        if 0 != exit_code:
+            failures += 1
+            LOGGER.error(f"Restore failed: reverse proxy: {name}: {output}")
+
+    output = (
+        f"Restored {len(restored)} and started {len(actions) - len(restored)} "
+        f"deployments in {time.perf_counter() - started:.2f}s, {failures} failed"
+    )
+    if 0 != len(missing):
+        output += f"; no image recorded for {', '.join(missing)}, reconcile to rebuild them"
+    if 0 != len(state.unreachable):
+        output += f"; skipped unreachable hosts {', '.join(sorted(state.unreachable))}"
+    LOGGER.info(output)
+    return (0 if 0 == failures + len(missing) + len(state.unreachable) else -1), output
+
+
+@traced
+@profiled("restore")
+def restore_all() -> tuple[int, str]:
+    try:
+        exit_code, output = restore_deployments()
+    except (errors.DockerException, RequestException, RuntimeError) as error:
+        exit_code = -1
+        output = f"Restore failed: {error}"
+        LOGGER.error(output)
+    return exit_code, output
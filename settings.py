@@ -0,0 +1,54 @@
+import logging
+import re
+from tomllib import load, TOMLDecodeError
+from typing import Any
+
+LOGGER = logging.getLogger(__name__)
+SETTINGS_FILE = "server.toml"
+
+
+def read_settings(settings_file: str = SETTINGS_FILE) -> dict:
+    settings = {}
+    try:
+        with open(settings_file, "rb") as file:
+            settings = load(file)
+    except FileNotFoundError:
+        pass
+    except TOMLDecodeError:
+        LOGGER.error(f"Settings file {settings_file} is invalid, using defaults")
+    return settings
+
+
+SETTINGS = read_settings()
+
+
+def get_section(section: str) -> dict:
+    value = {}
+    if section in SETTINGS and isinstance(SETTINGS[section], dict):
+        value = SETTINGS[section]
+    return value
+
+
+def check_value(
+    section: str, field: str, value: Any, default: Any, pattern: str | None = None
+) -> Any:
+    # Values end up in nginx configs and commands, so the type of the default is enforced
+    valid = True
+    if isinstance(default, bool):
+        valid = isinstance(value, bool)
+    elif isinstance(default, int):
+        # Booleans are ints as well, and no setting may be negative
+        valid = isinstance(value, int) and not isinstance(value, bool) and 0 <= value
+    elif isinstance(default, str):
+        # An empty default such as an unset cache time need not match the pattern
+        valid = isinstance(value, str) and (
+            pattern is None or value == default or re.fullmatch(pattern, value) is not None
+        )
+    if not valid:
+        LOGGER.warning(f"Invalid {field} {value!r} in [{section}], using {default!r}")
+        value = default
+    return value
+
+
+def get_setting(section: str, field: str, default: Any = None) -> Any:
+    return check_value(section, field, get_section(section).get(field, default), default)
@@ -0,0 +1,124 @@
+import logging
+import re
+import select
+import shlex
+import struct
+import threading
+from uuid import uuid4
+
+from docker import DockerClient, errors
+
+from profiling import Categories, wait
+from settings import get_setting
+
+LOGGER = logging.getLogger(__name__)
+FRAME_HEADER_SIZE = 8
+READ_SIZE = 65536
+DEFAULT_TIMEOUT_SECONDS = 600
+TIMEOUT_SECONDS = get_setting("shell", "timeout_seconds", DEFAULT_TIMEOUT_SECONDS)
+
+
+class ShellSession:
+    def __init__(self, client: DockerClient, container_id: str) -> None:
+        self.client = client
+        self.container_id = container_id
+        self.socket = None
+        self.buffer = b""
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        # A closed session shows up as a readable socket that returns no data
+        alive = self.socket is not None
+        if alive:
+            try:
+                readable, _, _ = select.select([self.socket], [], [], 0)
+                if readable:
+                    alive = 0 != len(self.read_frame())
+            except (OSError, ValueError):
+                alive = False
+        return alive
+
+    def open(self) -> None:
+        self.close()
+        exec_id = self.client.api.exec_create(
+            self.container_id, ["sh"], stdin=True, stdout=True, stderr=True, tty=False
+        )["Id"]
+        response = self.client.api.exec_start(exec_id, socket=True)
+        self.socket = getattr(response, "_sock", response)
+        # A command that stops writing output without exiting resets the session
+        self.socket.settimeout(TIMEOUT_SECONDS)
+        self.buffer = b""
+        LOGGER.debug(f"Opened shell session in {self.container_id}")
+
+    def close(self) -> None:
+        if self.socket is not None:
+            try:
+                self.socket.sendall(b"exit\n")
+                self.socket.close()
+            except OSError:
+                pass
+        self.socket = None
+
+    def receive(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.socket.recv(min(size - len(data), READ_SIZE))
+            if 0 == len(chunk):
+                break
+            data += chunk
+        return data
+
+    def read_frame(self) -> bytes:
+        # Without a TTY, Docker prefixes each chunk of stdout or stderr with an 8 byte header
+        payload = b""
+        header = self.receive(FRAME_HEADER_SIZE)
+        if FRAME_HEADER_SIZE == len(header):
+            _, size = struct.unpack(">BxxxL", header)
+            payload = self.receive(size)
+            self.buffer += payload
+        return payload
+
+    def build_script(
+        self, command: str, marker: str, working_directory: str | None, variables: dict
+    ) -> bytes:
+        exports = "".join(
+            f"export {name}={shlex.quote(str(value))}; "
+            for name, value in variables.items()
+        )
+        directory = f"cd {shlex.quote(working_directory)} && " if working_directory else ""
+        # The command is a single quoted argument, so unbalanced quotes in it fail in the
+        # inner shell instead of leaving the session's shell waiting for more input
+        return (
+            f"({exports}{directory}sh -c {shlex.quote(command)}) < /dev/null 2>&1; "
+            f"printf '\\n%s %d\\n' {marker} $?\n"
+        ).encode()
+
+    def run(
+        self, command: str, working_directory: str | None = None, variables: dict = {}
+    ) -> tuple[int, bytes]:
+        exit_code = -1
+        output = b""
+        marker = f"__NEXUS_{uuid4().hex}__"
+        pattern = re.compile(b"\n" + marker.encode() + b" (-?\\d+)\n")
+        with self.lock, wait(Categories.CONTAINER):
+            try:
+                if not self.is_open():
+                    self.open()
+                self.socket.sendall(
+                    self.build_script(command, marker, working_directory, variables)
+                )
+                match = pattern.search(self.buffer)
+                while match is None:
+                    if 0 == len(self.read_frame()):
+                        raise ConnectionError("Shell session closed")
+                    match = pattern.search(self.buffer)
+                exit_code = int(match.group(1))
+                output = self.buffer[: match.start()]
+                self.buffer = self.buffer[match.end() :]
+            except (OSError, errors.APIError) as error:
+                # The next command opens a fresh session
+                LOGGER.error(f"Shell session in {self.container_id} failed: {error}")
+                output = self.buffer + f"\nShell session failed: {error}".encode()
+                self.close()
+                self.buffer = b""
+        return exit_code, output
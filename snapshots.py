@@ -0,0 +1,142 @@
+from datetime import datetime, timezone
+from deploy import DATABASE_NAME, Deployment, create_deployment_database
+from docker import errors
+from hosts import Host
+import logging
+import os
+from profiling import profiled
+from tracing import traced
+from settings import get_setting
+import re
+import sqlite3
+from steps import (
+    CommitImage,
+    Properties,
+    PruneSnapshots,
+    ReloadNginx,
+    RepointNginxRoot,
+    TestNginxConfig,
+)
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_KEEP = 5
+DEFAULT_DISK_BUDGET_MB = 1024
+KEEP = get_setting("snapshots", "keep", DEFAULT_KEEP)
+DISK_BUDGET = get_setting("snapshots", "disk_budget_mb", DEFAULT_DISK_BUDGET_MB) * 1024 * 1024
+COMMIT_IMAGES = get_setting("snapshots", "commit_images", True)
+IMAGE_REPOSITORY = "nexus-site"
+
+
+def get_snapshots(name: str) -> list[dict]:
+    snapshots = []
+    with sqlite3.connect(DATABASE_NAME) as database:
+        database.row_factory = sqlite3.Row
+        cursor = database.cursor()
+        create_deployment_database(cursor)
+        cursor.execute(
+            f"""
+                SELECT *
+                FROM snapshots
+                WHERE deployment = ?
+                ORDER BY {Properties.BUILT_AT} DESC
+            """,
+            (name,),
+        )
+        for row in cursor.fetchall():
+            snapshots.append({key: row[key] for key in row.keys()})
+    return snapshots
+
+
+def delete_snapshots(name: str, paths: list[str]) -> None:
+    with sqlite3.connect(DATABASE_NAME) as database:
+        cursor = database.cursor()
+        create_deployment_database(cursor)
+        cursor.executemany(
+            "DELETE FROM snapshots WHERE deployment = ? AND path = ?",
+            [(name, path) for path in paths],
+        )
+        database.commit()
+
+
+def prune_snapshots(deployment: Deployment) -> tuple[int, str]:
+    name = deployment.get_property(Properties.NAME)
+    step = PruneSnapshots(
+        [snapshot["path"] for snapshot in get_snapshots(name)],
+        deployment.get_property(Properties.SNAPSHOT),
+        KEEP,
+        DISK_BUDGET,
+    )
+    deployment.add_step(step)
+    exit_code, output = deployment.run_all_steps()
+    if 0 == exit_code and 0 != len(step.get_removed()):
+        delete_snapshots(name, step.get_removed())
+        LOGGER.info(f"Removed {len(step.get_removed())} snapshots of {name}")
+    return exit_code, output
+
+
+def get_image_repository(name: str) -> str:
+    # Repository names must be lowercase, deployment names need not be
+    return f"{IMAGE_REPOSITORY}/{re.sub(r'[^a-z0-9._-]+', '-', name.lower())}"
+
+
+def get_image_tag(deployment: Deployment) -> str:
+    snapshot = deployment.get_property(Properties.SNAPSHOT)
+    if snapshot:
+        tag = os.path.basename(snapshot)
+    else:
+        tag = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S%fZ}"
+    return tag
+
+
+def remove_image(host: Host, image: str) -> None:
+    # A restored container may still run from the image, only its tag is removed then
+    try:
+        host.get_client().api.remove_image(image, force=True)
+    except errors.APIError as error:
+        LOGGER.warning(f"Failed to remove image {image}: {error}")
+
+
+def commit_image(deployment: Deployment, previous: str | None = None) -> tuple[int, str]:
+    exit_code = 0
+    output = ""
+    if COMMIT_IMAGES:
+        name = deployment.get_property(Properties.NAME)
+        if previous is None:
+            previous = deployment.get_property(Properties.IMAGE)
+        deployment.add_step(
+            CommitImage(get_image_repository(name), get_image_tag(deployment))
+        )
+        exit_code, output = deployment.run_all_steps()
+        if 0 != exit_code:
+            LOGGER.warning(f"Restores of {name} keep using {previous}: {output}")
+        elif previous and previous != output:
+            remove_image(deployment.environment.get_host(), previous)
+    return exit_code, output
+
+
+@traced
+@profiled("rollback")
+def rollback(deployment: Deployment, snapshot: dict) -> tuple[int, str]:
+    deployment.add_step(RepointNginxRoot(snapshot["path"]))
+    deployment.add_step(TestNginxConfig())
+    deployment.add_step(ReloadNginx())
+    exit_code, output = deployment.run_all_steps()
+
+    if 0 != exit_code:
+        logging.error(f"Exit code: {exit_code}, Error message {output}")
+    else:
+        deployment.set_properties(
+            {
+                Properties.SNAPSHOT: snapshot["path"],
+                Properties.COMMIT_SHA: snapshot[Properties.COMMIT_SHA],
+                Properties.BUILT_AT: snapshot[Properties.BUILT_AT],
+            }
+        )
+        commit_image(deployment)
+        deployment.save()
+        LOGGER.info(
+            f"Rolled back {deployment.get_property(Properties.NAME)} "
+            f"to {snapshot[Properties.COMMIT_SHA]}"
+        )
+
+    return exit_code, output
@@ -1,14 +1,67 @@
 from abc import ABC, abstractmethod
+from datetime import datetime, timezone
 from enum import StrEnum, auto
+from hashlib import sha256
+import json
 import logging
 from tomllib import loads, TOMLDecodeError
 
 from environment import Environment
+from settings import check_value
 
 LOGGER = logging.getLogger(__name__)
 DEFAULT_CONFIG_FILE = "nexus.toml"
 BASE_CERTIFICATE_PATH = "/etc/letsencrypt/live/"
 DEFAULT_CERTIFICATE_NAME = "nexus"
+DEFAULT_MIN_COMPRESS_SIZE = 1024
+DEFAULT_CACHE_MAX_AGE = 31536000
+DEFAULT_HASHED_ASSET_PATTERN = (
+    "[.-][0-9a-f]{8,}\\.(css|js|mjs|map|json|woff2?|ttf|svg|png|jpe?g|gif|webp|avif|ico)$"
+)
+DEFAULT_PROXY_KEEPALIVE = 16
+DEFAULT_PROXY_BUFFER_SIZE = "16k"
+NGINX_TIME_PATTERN = "[0-9]+(ms|s|m|h|d|w|M|y)?"
+NGINX_SIZE_PATTERN = "[0-9]+[kKmMgG]?"
+UPSTREAM_NAME_HASH_LENGTH = 16
+PROXY_CACHE_ZONE = "nexus"
+PROXY_CACHE_ZONE_SIZE = "10m"
+PROXY_CACHE_MAX_SIZE = "1g"
+PROXY_CACHE_PATH = "/var/cache/nginx/nexus"
+PROXY_CACHE_CONFIG = "/etc/nginx/http.d/00-nexus-cache.conf"
+PROXY_CONFIG_DIRECTORY = "/etc/nginx/http.d"
+SITE_CONFIG = "/etc/nginx/http.d/site.conf"
+SNAPSHOT_DIRECTORY = "/srv/nexus/snapshots"
+PROXY_MAP_CONFIG = "/etc/nginx/http.d/nexus-sites.conf"
+PROXY_MAP_DIGEST_PREFIX = "# nexus-digest: "
+STEP_RUNTIME_FIELDS = ("exit_code", "output", "next_steps", "properties", "removed")
+COMPRESSIBLE_EXTENSIONS = [
+    "html",
+    "htm",
+    "css",
+    "js",
+    "mjs",
+    "map",
+    "json",
+    "xml",
+    "svg",
+    "txt",
+    "wasm",
+    "ttf",
+    "otf",
+    "ico",
+]
+GZIP_TYPES = [
+    "text/css",
+    "text/plain",
+    "text/xml",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "application/wasm",
+    "image/svg+xml",
+    "font/ttf",
+    "font/otf",
+]
 
 
 class HostFields(StrEnum):
@@ -27,13 +80,55 @@ class DeployFields(StrEnum):
     PUBLISH_DIRECTORY = auto()
 
 
+class PerformanceFields(StrEnum):
+    PRECOMPRESS = auto()
+    BROTLI = auto()
+    MIN_COMPRESS_SIZE = auto()
+    CACHE_MAX_AGE = auto()
+    HASHED_ASSET_PATTERN = auto()
+
+
+class ProxyFields(StrEnum):
+    KEEPALIVE = auto()
+    HTTP2 = auto()
+    CACHE_TTL = auto()
+    BUFFER_SIZE = auto()
+
+
+class ProxyLayouts(StrEnum):
+    FILES = auto()
+    MAP = auto()
+
+
 class Properties(StrEnum):
     NAME = auto()
     DOMAIN = auto()
     EMAIL = auto()
+    UPSTREAM = auto()
+    REPOSITORY = auto()
+    SNAPSHOT = auto()
+    COMMIT_SHA = auto()
+    BUILT_AT = auto()
+    PROXY_KEEPALIVE = auto()
+    PROXY_HTTP2 = auto()
+    PROXY_CACHE_TTL = auto()
+    PROXY_BUFFER_SIZE = auto()
+    CONFIG = auto()
+    IMAGE = auto()
+
+
+def build_proxy_cache_config() -> str:
+    return (
+        f"proxy_cache_path {PROXY_CACHE_PATH} levels=1:2 "
+        f"keys_zone={PROXY_CACHE_ZONE}:{PROXY_CACHE_ZONE_SIZE} "
+        f"max_size={PROXY_CACHE_MAX_SIZE} inactive=60m use_temp_path=off;\n"
+    )
 
 
 class Step(ABC):
+    # Fields that differ on every run without changing what the step does
+    volatile_fields = ()
+
     def __init__(self, name: str) -> None:
         self.name = name
         self.exit_code = None
@@ -53,6 +148,25 @@ class Step(ABC):
     def get_properties(self) -> dict:
         return self.properties
 
+    def get_fingerprint(self) -> str:
+        # A plan runs steps against other environments than a deploy, so they are left out
+        fields = {
+            field: value
+            for field, value in vars(self).items()
+            if field not in STEP_RUNTIME_FIELDS + self.volatile_fields
+            and not isinstance(value, Environment)
+        }
+        # Nested steps contribute their own fingerprint, other objects only their type
+        return sha256(
+            json.dumps(
+                fields,
+                sort_keys=True,
+                default=lambda value: value.get_fingerprint()
+                if isinstance(value, Step)
+                else type(value).__name__,
+            ).encode()
+        ).hexdigest()
+
     def run(self, environment: Environment) -> tuple[int, str]:
         LOGGER.info(f"Step: {self.name}")
         exit_code, output = self.run_action(environment)
@@ -83,8 +197,15 @@ class SetName(Step):
         self.deploy_name = name
 
     def run_action(self, environment: Environment) -> tuple[int, str]:
-        environment.set_name(self.deploy_name)
-        return 0, ""
+        exit_code = 0
+        output = ""
+        try:
+            environment.set_name(self.deploy_name)
+        except Exception as error:
+            # Docker refuses names that are taken, the caller decides how to recover
+            exit_code = -1
+            output = f"Failed to rename {environment.get_name()} to {self.deploy_name}: {error}"
+        return exit_code, output
 
 
 class TeardownEnvironment(Step):
@@ -101,7 +222,21 @@ class GitClone(Step):
         self.repository = repository
 
     def run_action(self, environment: Environment) -> tuple[int, str]:
-        return environment.run_command(f"git clone {self.repository} .")
+        exit_code, output = environment.run_command(f"git clone {self.repository} .")
+        if 0 == exit_code:
+            self.properties[Properties.REPOSITORY] = self.repository
+        return exit_code, output
+
+
+class ReadGitRemote(Step):
+    def __init__(self) -> None:
+        super().__init__("Read Git Remote")
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        exit_code, output = environment.run_command("git remote get-url origin")
+        if 0 == exit_code:
+            self.properties[Properties.REPOSITORY] = output.strip()
+        return exit_code, output
 
 
 class GitCheckout(Step):
@@ -130,24 +265,220 @@ class BuildSource(Step):
         return environment.run_command(f"sh -c '{self.build_command}'")
 
 
+class PrecompressAssets(Step):
+    def __init__(
+        self,
+        publish_directory: str,
+        min_size: int = DEFAULT_MIN_COMPRESS_SIZE,
+        brotli: bool = True,
+    ) -> None:
+        super().__init__("Precompress Assets")
+        self.publish_directory = publish_directory
+        self.min_size = min_size
+        self.brotli = brotli
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        names = " -o ".join(
+            f'-name "*.{extension}"' for extension in COMPRESSIBLE_EXTENSIONS
+        )
+        # Compressed copies newer than their source are left untouched
+        script = (
+            f"find {self.publish_directory} -type f \\( {names} \\) "
+            f"-size +{max(self.min_size - 1, 0)}c | "
+            "while IFS= read -r file; do "
+            '[ "$file.gz" -nt "$file" ] || gzip -9 -c "$file" > "$file.gz" || exit 1; '
+        )
+        if self.brotli:
+            script += (
+                "if command -v brotli > /dev/null; then "
+                '[ "$file.br" -nt "$file" ] || brotli -f -q 11 -o "$file.br" "$file" || exit 1; '
+                "fi; "
+            )
+        script += "done"
+
+        return environment.run_command(f"sh -c '{script}'")
+
+
+class SnapshotPublishDirectory(Step):
+    volatile_fields = ("snapshot",)
+
+    def __init__(self, publish_directory: str, snapshot: str) -> None:
+        super().__init__("Snapshot Publish Directory")
+        self.publish_directory = publish_directory
+        self.snapshot = snapshot
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        exit_code, output = environment.run_command("git rev-parse HEAD")
+        commit_sha = output.strip()
+        if 0 == exit_code:
+            exit_code, output = environment.run_commands(
+                [
+                    f"mkdir -p {self.snapshot}",
+                    f"cp -a {self.publish_directory}/. {self.snapshot}",
+                ]
+            )
+        if 0 == exit_code:
+            self.properties[Properties.SNAPSHOT] = self.snapshot
+            self.properties[Properties.COMMIT_SHA] = commit_sha
+            self.properties[Properties.BUILT_AT] = datetime.now(timezone.utc).isoformat()
+        return exit_code, output
+
+
+class CommitImage(Step):
+    volatile_fields = ("tag",)
+
+    def __init__(self, repository: str, tag: str) -> None:
+        super().__init__("Commit Image")
+        self.repository = repository
+        self.tag = tag
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        exit_code, output = environment.commit_image(self.repository, self.tag)
+        if 0 == exit_code:
+            self.properties[Properties.IMAGE] = output
+        return exit_code, output
+
+
+class CopyDirectory(Step):
+    def __init__(self, source: Environment, path: str) -> None:
+        super().__init__("Copy Directory")
+        self.source = source
+        self.path = path
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        return self.source.copy_directory(self.path, environment)
+
+
+class PruneSnapshots(Step):
+    volatile_fields = ("snapshots", "current")
+
+    def __init__(
+        self, snapshots: list[str], current: str, keep: int, disk_budget: int
+    ) -> None:
+        super().__init__("Prune Snapshots")
+        self.snapshots = snapshots
+        self.current = current
+        self.keep = keep
+        self.disk_budget = disk_budget
+        self.removed = []
+
+    def get_removed(self) -> list[str]:
+        return self.removed
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        exit_code = 0
+        output = ""
+        sizes = {}
+        if 0 != len(self.snapshots):
+            # Missing snapshots are left out of the output rather than failing
+            exit_code, output = environment.run_command(
+                f"sh -c 'du -sk {' '.join(self.snapshots)} 2> /dev/null; true'"
+            )
+        if 0 == exit_code:
+            for line in output.splitlines():
+                fields = line.split()
+                if 2 == len(fields) and fields[0].isdigit():
+                    sizes[fields[1]] = int(fields[0]) * 1024
+
+            # Snapshots are ordered newest first, the current one is always kept
+            kept = 0
+            total = 0
+            for snapshot in self.snapshots:
+                size = sizes.get(snapshot, 0)
+                if snapshot == self.current or (
+                    snapshot in sizes
+                    and kept < self.keep
+                    and total + size <= self.disk_budget
+                ):
+                    kept += 1
+                    total += size
+                else:
+                    self.removed.append(snapshot)
+
+            existing = [snapshot for snapshot in self.removed if snapshot in sizes]
+            if 0 != len(existing):
+                exit_code, output = environment.run_command(
+                    f"rm -rf {' '.join(existing)}"
+                )
+        return exit_code, output
+
+
+class RepointNginxRoot(Step):
+    def __init__(self, root: str) -> None:
+        super().__init__("Repoint Nginx Root")
+        self.root = root
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        return environment.run_commands(
+            [
+                f"test -d {self.root}",
+                f'sed -i -E "s#^([[:space:]]*)root [^;]*;#\\1root {self.root};#" {SITE_CONFIG}',
+            ]
+        )
+
+
 class BuildNginxStaticSiteConfig(Step):
-    def __init__(self, config_file: str, domain: str, publish_directory: str) -> None:
+    volatile_fields = ("publish_directory",)
+
+    def __init__(
+        self,
+        config_file: str,
+        domain: str,
+        publish_directory: str,
+        brotli: bool = False,
+        cache_max_age: int = DEFAULT_CACHE_MAX_AGE,
+        hashed_asset_pattern: str = DEFAULT_HASHED_ASSET_PATTERN,
+        min_compress_size: int = DEFAULT_MIN_COMPRESS_SIZE,
+    ) -> None:
         super().__init__("Build Nginx Static Site Config")
         self.config_file = config_file
         self.domain = domain
         self.publish_directory = publish_directory
+        self.brotli = brotli
+        self.cache_max_age = cache_max_age
+        self.hashed_asset_pattern = hashed_asset_pattern
+        self.min_compress_size = min_compress_size
 
     def run_action(self, environment: Environment) -> tuple[int, str]:
         config = (
             "server {\n"
             "\tlisten 80;\n\n"
             f"\tserver_name {self.domain} www.{self.domain};\n\n"
-            f"\troot {self.publish_directory};\n"
+            f"\troot {self.publish_directory};\n\n"
+            "\tsendfile on;\n"
+            "\ttcp_nopush on;\n"
+            "\topen_file_cache max=1000 inactive=60s;\n"
+            "\topen_file_cache_valid 60s;\n"
+            "\topen_file_cache_min_uses 2;\n"
+            "\topen_file_cache_errors on;\n\n"
+            "\tgzip on;\n"
+            "\tgzip_static on;\n"
+            "\tgzip_vary on;\n"
+            # Matches the precompressed files, so nginx and gzip_static agree
+            f"\tgzip_min_length {self.min_compress_size};\n"
+            f"\tgzip_types {' '.join(GZIP_TYPES)};\n"
+        )
+        if self.brotli:
+            # Only serve brotli files when the module is installed in the container
+            exit_code, output = environment.run_command(
+                "sh -c 'cat /etc/nginx/modules/*.conf'"
+            )
+            if 0 == exit_code and "brotli_static" in output:
+                config += "\tbrotli_static on;\n"
+        hashed_asset_pattern = self.hashed_asset_pattern.replace("$", "\\$")
+        config += (
+            "\n"
+            f'\tlocation ~* \\"{hashed_asset_pattern}\\" {{\n'
+            f'\t\tadd_header Cache-Control \\"public, max-age={self.cache_max_age}, immutable\\";\n'
+            "\t}\n\n"
+            "\tlocation / {\n"
+            '\t\tadd_header Cache-Control \\"no-cache\\";\n'
+            "\t}\n"
             "}\n"
         )
 
         return environment.run_command(
-            f"sh -c 'echo \"{config}\" > /etc/nginx/http.d/site.conf'"
+            f"sh -c 'echo \"{config}\" > {SITE_CONFIG}'"
         )
 
 
@@ -157,6 +488,10 @@ class BuildNginxReverseProxyConfig(Step):
         domain: str,
         upstream: str,
         certificate_name: str = DEFAULT_CERTIFICATE_NAME,
+        keepalive: int | None = None,
+        http2: bool | None = None,
+        cache_ttl: str | None = None,
+        buffer_size: str | None = None,
     ) -> None:
         super().__init__("Build Nginx Reverse Proxy Config")
         self.domain = domain
@@ -165,21 +500,71 @@ class BuildNginxReverseProxyConfig(Step):
             BASE_CERTIFICATE_PATH + certificate_name + "/fullchain.pem"
         )
         self.path_to_key = BASE_CERTIFICATE_PATH + certificate_name + "/privkey.pem"
+        # Values recorded in nexus.db before they were checked are checked again here
+        self.keepalive = self.check(ProxyFields.KEEPALIVE, keepalive, DEFAULT_PROXY_KEEPALIVE)
+        self.http2 = self.check(ProxyFields.HTTP2, http2, True)
+        self.cache_ttl = self.check(ProxyFields.CACHE_TTL, cache_ttl, "", NGINX_TIME_PATTERN)
+        self.buffer_size = self.check(
+            ProxyFields.BUFFER_SIZE, buffer_size, DEFAULT_PROXY_BUFFER_SIZE, NGINX_SIZE_PATTERN
+        )
+
+    def check(self, field: ProxyFields, value, default, pattern: str | None = None):
+        if value is None or "" == value:
+            value = default
+        return check_value(f"proxy of {self.domain}", field, value, default, pattern)
+
+    def get_upstream_name(self) -> str:
+        # Dots and dashes both become underscores, the hash keeps a-b.com and a.b.com apart
+        digest = sha256(self.domain.encode()).hexdigest()[:UPSTREAM_NAME_HASH_LENGTH]
+        return f"nexus_{self.domain.replace('.', '_').replace('-', '_')}_{digest}"
+
+    def build_upstream(self) -> str:
+        config = (
+            f"upstream {self.get_upstream_name()} {{\n"
+            f"\tserver {self.upstream};\n"
+        )
+        if self.keepalive > 0:
+            config += f"\tkeepalive {self.keepalive};\n"
+        config += "}\n\n"
+        return config
+
+    def build_location(self) -> str:
+        config = (
+            "\tlocation / {\n"
+            f"\t\tproxy_pass http://{self.get_upstream_name()};\n"
+            "\t\tproxy_http_version 1.1;\n"
+            '\t\tproxy_set_header Connection \\"\\";\n'
+            "\t\tproxy_set_header Host \\$host;\n"
+            "\t\tproxy_set_header X-Real-IP \\$remote_addr;\n"
+            "\t\tproxy_set_header X-Forwarded-For \\$remote_addr;\n\n"
+            "\t\tproxy_buffering on;\n"
+            f"\t\tproxy_buffer_size {self.buffer_size};\n"
+            f"\t\tproxy_buffers 8 {self.buffer_size};\n"
+        )
+        if self.cache_ttl:
+            config += (
+                "\n"
+                f"\t\tproxy_cache {PROXY_CACHE_ZONE};\n"
+                f"\t\tproxy_cache_valid 200 301 302 {self.cache_ttl};\n"
+                "\t\tproxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;\n"
+                "\t\tproxy_cache_background_update on;\n"
+                "\t\tproxy_cache_lock on;\n"
+                "\t\tadd_header X-Cache-Status \\$upstream_cache_status;\n"
+            )
+        config += "\t}\n"
+        return config
 
     def run_action(self, environment: Environment) -> tuple[int, str]:
         config = (
-            "server {\n"
+            self.build_upstream()
+            + "server {\n"
             "\tlisten 443 ssl;\n"
-            f"\tserver_name {self.domain} www.{self.domain};\n\n"
+            + ("\thttp2 on;\n" if self.http2 else "")
+            + f"\tserver_name {self.domain} www.{self.domain};\n\n"
             f"\tssl_certificate {self.path_to_certificate};\n"
             f"\tssl_certificate_key {self.path_to_key};\n\n"
-            "\tlocation / {\n"
-            f"\t\tproxy_pass http://{self.upstream}:80;\n"
-            "\t\tproxy_set_header Host \\$host;\n"
-            "\t\tproxy_set_header X-Real-IP \\$remote_addr;\n"
-            "\t\tproxy_set_header X-Forwarded-For \\$remote_addr;\n"
-            "\t}\n"
-            "}\n\n"
+            + self.build_location()
+            + "}\n\n"
             "server {\n"
             "\tlisten 80;\n"
             f"\tserver_name {self.domain} www.{self.domain};\n\n"
@@ -187,10 +572,152 @@ class BuildNginxReverseProxyConfig(Step):
             "}\n"
         )
 
-        return environment.run_command(
+        commands = []
+        if self.cache_ttl:
+            # The shared cache zone is defined once for every site in the http context
+            commands.append(f"mkdir -p {PROXY_CACHE_PATH}")
+            commands.append(
+                f"sh -c 'echo \"{build_proxy_cache_config()}\" > {PROXY_CACHE_CONFIG}'"
+            )
+        commands.append(
             f"sh -c 'echo \"{config}\" > /etc/nginx/http.d/{self.domain}.conf'"
         )
 
+        return environment.run_commands(commands)
+
+
+class BuildNginxProxyMapConfig(Step):
+    def __init__(
+        self,
+        sites: list[BuildNginxReverseProxyConfig],
+        certificate_name: str = DEFAULT_CERTIFICATE_NAME,
+        force_reload: bool = False,
+    ) -> None:
+        super().__init__("Build Nginx Proxy Map Config")
+        self.sites = sorted(sites, key=lambda site: site.domain)
+        self.force_reload = force_reload
+        self.path_to_certificate = (
+            BASE_CERTIFICATE_PATH + certificate_name + "/fullchain.pem"
+        )
+        self.path_to_key = BASE_CERTIFICATE_PATH + certificate_name + "/privkey.pem"
+
+    def build_location(self, site: BuildNginxReverseProxyConfig) -> str:
+        config = (
+            "\tlocation / {\n"
+            "\t\tproxy_pass http://$nexus_upstream;\n"
+            "\t\tproxy_http_version 1.1;\n"
+            '\t\tproxy_set_header Connection "";\n'
+            "\t\tproxy_set_header Host $host;\n"
+            "\t\tproxy_set_header X-Real-IP $remote_addr;\n"
+            "\t\tproxy_set_header X-Forwarded-For $remote_addr;\n\n"
+            "\t\tproxy_buffering on;\n"
+            f"\t\tproxy_buffer_size {site.buffer_size};\n"
+            f"\t\tproxy_buffers 8 {site.buffer_size};\n"
+        )
+        if site.cache_ttl:
+            config += (
+                "\n"
+                f"\t\tproxy_cache {PROXY_CACHE_ZONE};\n"
+                f"\t\tproxy_cache_valid 200 301 302 {site.cache_ttl};\n"
+                "\t\tproxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;\n"
+                "\t\tproxy_cache_background_update on;\n"
+                "\t\tproxy_cache_lock on;\n"
+                "\t\tadd_header X-Cache-Status $upstream_cache_status;\n"
+            )
+        config += "\t}\n"
+        return config
+
+    def build_config(self) -> str:
+        upstreams = ""
+        upstream_map = "map $host $nexus_upstream {\n\thostnames;\n"
+        redirect_names = ""
+        groups = {}
+        for site in self.sites:
+            upstreams += site.build_upstream()
+            upstream_map += (
+                f"\t{site.domain} {site.get_upstream_name()};\n"
+                f"\twww.{site.domain} {site.get_upstream_name()};\n"
+            )
+            redirect_names += f"\n\t\t{site.domain} www.{site.domain}"
+            # Sites sharing a profile share one server block
+            profile = (site.http2, site.cache_ttl, site.buffer_size)
+            groups.setdefault(profile, []).append(site)
+        upstream_map += "}\n\n"
+
+        servers = ""
+        for (http2, cache_ttl, buffer_size), sites in groups.items():
+            names = "".join(
+                f"\n\t\t{site.domain} www.{site.domain}" for site in sites
+            )
+            servers += (
+                "server {\n"
+                "\tlisten 443 ssl;\n"
+                + ("\thttp2 on;\n" if http2 else "")
+                + f"\tserver_name{names};\n\n"
+                f"\tssl_certificate {self.path_to_certificate};\n"
+                f"\tssl_certificate_key {self.path_to_key};\n\n"
+                + self.build_location(sites[0])
+                + "}\n\n"
+            )
+        if redirect_names:
+            servers += (
+                "server {\n"
+                "\tlisten 80;\n"
+                f"\tserver_name{redirect_names};\n\n"
+                "\treturn 301 https://$host$request_uri;\n"
+                "}\n"
+            )
+
+        return (
+            "map_hash_max_size 65536;\n"
+            "map_hash_bucket_size 128;\n"
+            "server_names_hash_max_size 65536;\n"
+            "server_names_hash_bucket_size 128;\n\n"
+            + upstreams
+            + upstream_map
+            + servers
+        )
+
+    def run_action(self, environment: Environment) -> tuple[int, str]:
+        # The whole map is regenerated from nexus.db every time, the digest only
+        # skips the write, test and reload when the result is unchanged
+        config = self.build_config()
+        digest = PROXY_MAP_DIGEST_PREFIX + sha256(config.encode()).hexdigest()
+        exit_code, output = environment.run_command(
+            f"sh -c 'if [ -e {PROXY_MAP_CONFIG} ]; then head -n 1 {PROXY_MAP_CONFIG}; fi'"
+        )
+        changed = 0 == exit_code and digest != output.strip()
+        if not changed:
+            LOGGER.info("Proxy map config unchanged")
+
+        if changed and any(site.cache_ttl for site in self.sites):
+            exit_code, output = environment.run_command(f"mkdir -p {PROXY_CACHE_PATH}")
+            if 0 == exit_code:
+                exit_code, output = environment.write_file(
+                    PROXY_CACHE_CONFIG, build_proxy_cache_config()
+                )
+        if changed and 0 == exit_code:
+            exit_code, output = environment.write_file(
+                PROXY_MAP_CONFIG, f"{digest}\n{config}"
+            )
+        if changed and 0 == exit_code:
+            # Per-site files left over from the files layout would duplicate server names
+            exit_code, output = environment.run_command(f"ls {PROXY_CONFIG_DIRECTORY}")
+        if changed and 0 == exit_code:
+            existing = set(output.split())
+            stale = [
+                f"{PROXY_CONFIG_DIRECTORY}/{site.domain}.conf"
+                for site in self.sites
+                if f"{site.domain}.conf" in existing
+            ]
+            if 0 != len(stale):
+                exit_code, output = environment.run_command(f"rm -f {' '.join(stale)}")
+        if (changed or self.force_reload) and 0 == exit_code:
+            self.next_steps.append(TestNginxConfig())
+            self.next_steps.append(ReloadNginx())
+
+        return exit_code, output
+
 
 class RemoveNginxConfig(Step):
     def __init__(self, domain) -> None:
@@ -265,10 +792,18 @@ class AddDomainToCertificate(Step):
 
 
 class ReadNexusConfig(Step):
-    def __init__(self, config_file: str = DEFAULT_CONFIG_FILE) -> None:
+    def __init__(
+        self, config_file: str = DEFAULT_CONFIG_FILE, rename: bool = True
+    ) -> None:
         super().__init__("Read Nexus Config")
         self.config_file = config_file
+        self.rename = rename
         self.publish_directory = None
+        self.precompress = True
+        self.brotli = True
+        self.min_compress_size = DEFAULT_MIN_COMPRESS_SIZE
+        self.cache_max_age = DEFAULT_CACHE_MAX_AGE
+        self.hashed_asset_pattern = DEFAULT_HASHED_ASSET_PATTERN
 
     def parse(self, config: dict, environment: Environment) -> tuple[int, str]:
         exit_code = 0
@@ -286,7 +821,8 @@ class ReadNexusConfig(Step):
                 exit_code = -1
                 output = "Missing email"
             else:
-                self.next_steps.append(SetName(host[HostFields.NAME]))
+                if self.rename:
+                    self.next_steps.append(SetName(host[HostFields.NAME]))
                 self.properties[Properties.DOMAIN] = host[HostFields.DOMAIN]
                 self.properties[Properties.EMAIL] = host[HostFields.EMAIL]
         else:
@@ -315,6 +851,45 @@ class ReadNexusConfig(Step):
             else:
                 self.publish_directory = environment.get_working_directory()
 
+        if "performance" in config and 0 == exit_code:
+            performance = config["performance"]
+
+            def get(field: PerformanceFields, default):
+                return check_value(
+                    "performance", field, performance.get(field, default), default
+                )
+
+            self.precompress = get(PerformanceFields.PRECOMPRESS, self.precompress)
+            self.brotli = get(PerformanceFields.BROTLI, self.brotli)
+            self.min_compress_size = get(
+                PerformanceFields.MIN_COMPRESS_SIZE, self.min_compress_size
+            )
+            self.cache_max_age = get(PerformanceFields.CACHE_MAX_AGE, self.cache_max_age)
+            self.hashed_asset_pattern = get(
+                PerformanceFields.HASHED_ASSET_PATTERN, self.hashed_asset_pattern
+            )
+
+        if 0 == exit_code:
+            # Always set so that removing a field from the config clears it
+            proxy = config.get("proxy", {})
+
+            def get_proxy(field: ProxyFields, default, pattern: str | None = None):
+                value = proxy.get(field)
+                if value is not None:
+                    value = check_value("proxy", field, value, default, pattern)
+                return value
+
+            self.properties[Properties.PROXY_KEEPALIVE] = get_proxy(
+                ProxyFields.KEEPALIVE, DEFAULT_PROXY_KEEPALIVE
+            )
+            self.properties[Properties.PROXY_HTTP2] = get_proxy(ProxyFields.HTTP2, True)
+            self.properties[Properties.PROXY_CACHE_TTL] = get_proxy(
+                ProxyFields.CACHE_TTL, "", NGINX_TIME_PATTERN
+            )
+            self.properties[Properties.PROXY_BUFFER_SIZE] = get_proxy(
+                ProxyFields.BUFFER_SIZE, DEFAULT_PROXY_BUFFER_SIZE, NGINX_SIZE_PATTERN
+            )
+
         # TODO environment variable and secrets
 
         return exit_code, output
@@ -326,14 +901,32 @@ class ReadNexusConfig(Step):
             output = f"Failed to read config file {self.config_file}"
         else:
             try:
+                self.properties[Properties.CONFIG] = output
                 exit_code, output = self.parse(loads(output), environment)
                 # TODO conditionally add steps to build configs for other deployments if applicable
                 if 0 == exit_code:
+                    if self.precompress:
+                        self.next_steps.append(
+                            PrecompressAssets(
+                                self.publish_directory,
+                                self.min_compress_size,
+                                self.brotli,
+                            )
+                        )
+                    # The site is served from a snapshot so it can be rolled back later
+                    snapshot = f"{SNAPSHOT_DIRECTORY}/{datetime.now(timezone.utc):%Y%m%dT%H%M%S%fZ}"
+                    self.next_steps.append(
+                        SnapshotPublishDirectory(self.publish_directory, snapshot)
+                    )
                     self.next_steps.append(
                         BuildNginxStaticSiteConfig(
                             "config.conf",
                             self.properties[Properties.DOMAIN],
-                            self.publish_directory,
+                            snapshot,
+                            self.precompress and self.brotli,
+                            self.cache_max_age,
+                            self.hashed_asset_pattern,
+                            self.min_compress_size,
                         )
                     )
                     self.next_steps.append(TestNginxConfig())
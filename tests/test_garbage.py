@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+from docker import errors
+
+import garbage
+from environment import MANAGED_LABELS, Images
+from hosts import Host, HostRegistry
+from steps import PROXY_CACHE_CONFIG, PROXY_MAP_CONFIG, Properties, ProxyLayouts
+
+OLD = garbage.GRACE_PERIOD + timedelta(minutes=1)
+NEW = garbage.GRACE_PERIOD - timedelta(minutes=1)
+
+
+def get_created(age: timedelta) -> int:
+    return int((datetime.now(timezone.utc) - age).timestamp())
+
+
+def get_container(age: timedelta = OLD, labels: dict = MANAGED_LABELS, image: str = "") -> dict:
+    return {"Labels": labels, "Image": image, "Created": get_created(age)}
+
+
+def get_image(tags: list[str], age: timedelta = OLD) -> dict:
+    return {"Id": f"sha256:{len(tags)}", "RepoTags": tags, "Created": get_created(age)}
+
+
+def fake_proxy(*paths: str) -> MagicMock:
+    reverse_proxy_deployment = MagicMock()
+    reverse_proxy_deployment.environment.run_command.return_value = (
+        0,
+        "".join(f"100 {path}\n" for path in paths),
+    )
+    return reverse_proxy_deployment
+
+
+def find_config_orphans(monkeypatch, layout: ProxyLayouts, *paths: str) -> list[str]:
+    monkeypatch.setattr(garbage, "PROXY_LAYOUT", layout)
+    records = [{Properties.DOMAIN: "a.example.com"}, {Properties.DOMAIN: None}]
+    orphans = garbage.find_config_orphans(fake_proxy(*paths), records)
+    return [orphan.name for orphan in orphans]
+
+
+def test_collect_returns_failure_when_docker_fails(monkeypatch):
+    def find_orphans(reverse_proxy_deployment):
+        raise errors.APIError("daemon is shutting down")
+
+    monkeypatch.setattr(garbage, "get_reverse_proxy", MagicMock)
+    monkeypatch.setattr(garbage, "find_orphans", find_orphans)
+    exit_code, output = garbage.collect()
+    assert -1 == exit_code
+    assert "Garbage collection failed: daemon is shutting down" == output
+
+
+def test_collect_skips_and_reports_unreachable_hosts(monkeypatch):
+    local = Host("local", client=MagicMock())
+    local.client.api.containers.return_value = []
+    local.client.api.images.return_value = []
+    remote = Host("node-2", client=MagicMock())
+    remote.client.api.containers.side_effect = errors.DockerException("connection refused")
+    monkeypatch.setattr(garbage, "HOSTS", HostRegistry([local, remote]))
+    monkeypatch.setattr(garbage, "get_deployment_records", lambda: [])
+    monkeypatch.setattr(garbage, "get_reverse_proxy", lambda: fake_proxy(PROXY_MAP_CONFIG))
+    exit_code, output = garbage.collect()
+    assert -1 == exit_code
+    assert output.endswith("0 failed; skipped unreachable hosts node-2")
+
+
+def test_orphan_containers_are_managed_unrecorded_and_old():
+    names = {"site"}
+    assert garbage.is_orphan_container("site-retired", get_container(), names)
+    assert garbage.is_orphan_container(
+        "green-1", get_container(labels=None, image=f"{Images.STATIC_HOST}:latest"), names
+    )
+    assert not garbage.is_orphan_container("site", get_container(), names)
+    assert not garbage.is_orphan_container("postgres", get_container(labels={}), names)
+    assert not garbage.is_orphan_container("green-1", get_container(NEW), names)
+    assert not garbage.is_orphan_container(garbage.REVERSR_PROXY_NAME, get_container(), names)
+
+
+def test_orphan_site_images_are_unrecorded_unused_and_old():
+    images = {"nexus-site/site:2"}
+    assert garbage.is_orphan_site_image(get_image(["nexus-site/site:1"]), images, set())
+    assert garbage.is_orphan_site_image(get_image([]), images, set())
+    assert not garbage.is_orphan_site_image(get_image(["nexus-site/site:2"]), images, set())
+    assert not garbage.is_orphan_site_image(get_image([]), images, {"sha256:0"})
+    assert not garbage.is_orphan_site_image(get_image([], NEW), images, set())
+
+
+def test_config_orphans_in_the_files_layout(monkeypatch):
+    paths = [
+        PROXY_CACHE_CONFIG,
+        "/etc/nginx/http.d/a.example.com.conf",
+        "/etc/nginx/http.d/b.example.com.conf",
+    ]
+    assert ["/etc/nginx/http.d/b.example.com.conf"] == find_config_orphans(
+        monkeypatch, ProxyLayouts.FILES, *paths
+    )
+
+
+def test_config_orphans_in_the_map_layout(monkeypatch):
+    site = "/etc/nginx/http.d/a.example.com.conf"
+    # Site files still route traffic until the map config exists
+    assert [] == find_config_orphans(monkeypatch, ProxyLayouts.MAP, PROXY_CACHE_CONFIG, site)
+    assert [site] == find_config_orphans(
+        monkeypatch, ProxyLayouts.MAP, PROXY_CACHE_CONFIG, PROXY_MAP_CONFIG, site
+    )
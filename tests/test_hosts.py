@@ -0,0 +1,128 @@
+from unittest.mock import MagicMock
+
+from docker import errors
+
+import environment
+import hosts
+from hosts import Host, HostRegistry, read_hosts
+
+
+def fake_client(containers: int = 0, memory_used: int = 0, memory_total: int = 1000):
+    client = MagicMock()
+    container = MagicMock()
+    container.stats.return_value = {"memory_stats": {"usage": memory_used // max(containers, 1)}}
+    client.containers.list.return_value = [container] * containers
+    client.info.return_value = {"MemTotal": memory_total}
+    return client
+
+
+def failing_client():
+    client = MagicMock()
+    client.containers.list.side_effect = errors.DockerException("connection refused")
+    return client
+
+
+def test_read_hosts_parses_fields_and_defaults(monkeypatch):
+    monkeypatch.setattr(
+        hosts,
+        "get_section",
+        lambda section: {
+            "local": {},
+            "node-2": {
+                "base_url": "tcp://10.0.0.2:2376",
+                "address": "192.168.0.2",
+                "pool_size": 4,
+                "max_containers": 20,
+            },
+        },
+    )
+    registry = read_hosts()
+    local, remote = registry.get_hosts()
+    assert "local" == local.get_name()
+    assert "" == local.base_url
+    assert hosts.DEFAULT_POOL_SIZE == local.pool_size
+    assert hosts.DEFAULT_MAX_CONTAINERS == local.max_containers
+    assert "tcp://10.0.0.2:2376" == remote.base_url
+    assert "192.168.0.2" == remote.address
+    assert 4 == remote.pool_size
+    assert 20 == remote.max_containers
+    assert local is registry.get_default()
+
+
+def test_read_hosts_without_settings_uses_local_host(monkeypatch):
+    monkeypatch.setattr(hosts, "get_section", lambda section: {})
+    registry = read_hosts()
+    assert [hosts.DEFAULT_HOST_NAME] == [host.get_name() for host in registry.get_hosts()]
+
+
+def test_read_hosts_checks_field_types(monkeypatch, caplog):
+    monkeypatch.setattr(
+        hosts,
+        "get_section",
+        lambda section: {
+            "node-2": {
+                "base_url": 2376,
+                "address": ["10.0.0.2"],
+                "pool_size": "4",
+                "max_containers": -1,
+            }
+        },
+    )
+    host = read_hosts().get_default()
+    assert "" == host.base_url
+    assert "" == host.address
+    assert hosts.DEFAULT_POOL_SIZE == host.pool_size
+    assert hosts.DEFAULT_MAX_CONTAINERS == host.max_containers
+    assert "Invalid pool_size '4' in [hosts.node-2]" in caplog.text
+
+
+def test_get_address_falls_back_to_base_url_host():
+    assert "10.0.0.5" == Host("a", address="10.0.0.5").get_address()
+    assert "10.0.0.2" == Host("b", base_url="tcp://10.0.0.2:2376").get_address()
+    assert "127.0.0.1" == Host("c").get_address()
+
+
+def test_get_unknown_host_returns_default():
+    default = Host("local", client=fake_client())
+    registry = HostRegistry([default, Host("node-2", client=fake_client())])
+    assert default is registry.get("missing")
+    assert default is registry.get(None)
+    assert registry.get_hosts()[1] is registry.get("node-2")
+
+
+def test_get_load_is_the_larger_of_memory_and_containers():
+    assert 0.5 == Host("a", max_containers=10, client=fake_client(5, 100)).get_load()
+    assert 0.8 == Host("b", max_containers=100, client=fake_client(5, 800)).get_load()
+
+
+def test_get_least_loaded_picks_lowest_load():
+    busy = Host("local", max_containers=10, client=fake_client(8))
+    idle = Host("node-2", max_containers=10, client=fake_client(2))
+    medium = Host("node-3", max_containers=10, client=fake_client(5))
+    assert idle is HostRegistry([busy, idle, medium]).get_least_loaded()
+
+
+def test_get_least_loaded_skips_unavailable_hosts():
+    busy = Host("local", max_containers=10, client=fake_client(8))
+    down = Host("node-2", client=failing_client())
+    assert busy is HostRegistry([busy, down]).get_least_loaded()
+
+
+def test_get_least_loaded_falls_back_to_default():
+    default = Host("local", client=failing_client())
+    registry = HostRegistry([default, Host("node-2", client=failing_client())])
+    assert default is registry.get_least_loaded()
+
+
+def test_remote_sites_publish_only_on_private_address(monkeypatch):
+    default = Host("local", client=fake_client())
+    remote = Host("node-2", base_url="tcp://10.0.0.2:2376", address="192.168.0.2")
+    remote.client = fake_client()
+    remote.client.containers.get.side_effect = errors.NullResource()
+    remote.client.networks.list.return_value = [MagicMock(containers=[])]
+    monkeypatch.setattr(environment, "HOSTS", HostRegistry([default, remote]))
+
+    environment.ContainerEnvironment(host=remote)
+
+    ports = remote.client.containers.run.call_args.kwargs["ports"]
+    assert {"80/tcp": ("192.168.0.2", None)} == ports
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+
+import logstore
+from logstore import LogEntry, find_logs, read_log, save_logs
+
+
+def get_entry(step: str, output: str, exit_code: int = 0, age: timedelta = timedelta()) -> LogEntry:
+    return LogEntry(step, exit_code, output, datetime.now(timezone.utc) - age, 1.5)
+
+
+def test_saved_logs_are_found_and_read_back():
+    output = "".join(f"line {number}\n" for number in range(20000))
+    entries = [get_entry("Build Source", output), get_entry("Git Pull", "")]
+    save_logs("trace", "site", "site", entries)
+    logs = list(find_logs())
+    assert ["Build Source", "Git Pull"] == [log["step"] for log in logs]
+    assert len(output.encode()) == logs[0]["size"]
+    assert logs[0]["stored"] < logs[0]["size"]
+    assert "trace" == logs[0]["trace_id"]
+    # The output spans several chunks, lines split across them are joined again
+    assert output.splitlines() == list(read_log(logs[0]["id"]))
+    assert [] == list(read_log(logs[1]["id"]))
+
+
+def test_find_logs_filters():
+    save_logs("trace", "site", "site", [get_entry("Build Source", "failed", 1)])
+    save_logs("trace", "site", "proxy", [get_entry("Reload Nginx", "")])
+    save_logs("trace", "other", "site", [get_entry("Build Source", "", age=timedelta(hours=2))])
+    assert ["site"] == [log["deployment"] for log in find_logs(failed=True)]
+    assert 2 == len(list(find_logs(deployment="site")))
+    assert ["Reload Nginx"] == [log["step"] for log in find_logs(step="Reload Nginx")]
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+    assert ["other"] == [log["deployment"] for log in find_logs(until=since)]
+    assert 2 == len(list(find_logs(since=since.replace(tzinfo=None))))
+
+
+def test_long_output_keeps_its_end(monkeypatch):
+    monkeypatch.setattr(logstore, "MAX_STEP_OUTPUT", 11)
+    save_logs("trace", "site", "site", [get_entry("Build Source", "start\nerror: why\n")])
+    log = next(find_logs())
+    assert 6 == log["truncated"]
+    assert ["error: why"] == list(read_log(log["id"]))
+
+
+def test_prune_removes_expired_logs_then_oldest_beyond_size(monkeypatch):
+    save_logs("trace", "site", "site", [get_entry("Expired", "x", age=timedelta(days=31))])
+    assert [] == list(find_logs(step="Expired"))
+
+    entries = [get_entry(f"Step {number}", "x" * 100) for number in range(3)]
+    save_logs("trace", "site", "site", entries)
+    stored = next(find_logs())["stored"]
+    monkeypatch.setattr(logstore, "MAX_SIZE", 2 * stored)
+    save_logs("trace", "site", "site", [get_entry("Step 3", "x" * 100)])
+    logs = list(find_logs())
+    assert ["Step 2", "Step 3"] == [log["step"] for log in logs]
+    assert [] == list(read_log(logs[0]["id"] - 1))
@@ -0,0 +1,173 @@
+from docker import errors
+
+import pipelines
+from deploy import Deployment, get_deployment_records
+from environment import Environment
+from steps import Properties
+
+CONFIG = """
+[host]
+name = "site"
+domain = "example.com"
+email = "admin@example.com"
+"""
+
+
+class FakeEnvironment(Environment):
+    # Containers are told apart by identity, since blue and green swap names
+    def __init__(self, identity: str, name: str, events: list, failures: list) -> None:
+        self.identity = identity
+        self.events = events
+        self.failures = failures
+        super().__init__(name=name)
+
+    def set_name(self, name: str) -> None:
+        if "" != name and getattr(self, "name", name) != name:
+            self.fail_or_log("rename", name)
+        super().set_name(name)
+
+    def get_host(self) -> None:
+        return None
+
+    def get_upstream(self) -> str:
+        return f"{self.identity}:80"
+
+    def fail_or_log(self, *event: str) -> int:
+        exit_code = 0
+        for failure in self.failures:
+            if self.identity == failure[0] and failure[1] in " ".join(event):
+                # Each failure happens once, so recovery steps can succeed
+                self.failures.remove(failure)
+                exit_code = 1
+                if "rename" == event[0]:
+                    raise errors.APIError(f"Conflict renaming {self.identity}")
+                break
+        if 0 == exit_code:
+            self.events.append((self.identity, *event))
+        return exit_code
+
+    def run_commands(self, commands: list[str]) -> tuple[int, str]:
+        exit_code = 0
+        output = ""
+        for command in commands:
+            exit_code = self.fail_or_log("command", command)
+            output = CONFIG if "cat nexus.toml" in command else ""
+            if 0 != exit_code:
+                output = f"{command} failed"
+                break
+        return exit_code, output
+
+    def teardown(self) -> tuple[int, str]:
+        exit_code = self.fail_or_log("teardown")
+        return exit_code, "" if 0 == exit_code else "Failed to remove container"
+
+    def write_file(self, path: str, content: str) -> tuple[int, str]:
+        return self.fail_or_log("write", path, content), ""
+
+    def copy_directory(self, path: str, destination: Environment) -> tuple[int, str]:
+        return self.fail_or_log("copy", path), ""
+
+    def commit_image(self, repository: str, tag: str) -> tuple[int, str]:
+        return 0, f"{repository}:{tag}"
+
+
+class BlueGreen:
+    def __init__(self, monkeypatch, failures: list = []) -> None:
+        self.events = []
+        self.failures = list(failures)
+        self.pruned = []
+        proxy = FakeEnvironment("proxy", "nexus-reverse-proxy", self.events, self.failures)
+        monkeypatch.setattr(pipelines, "DRAIN_SECONDS", 0)
+        monkeypatch.setattr(pipelines, "PROXY_LAYOUT", "files")
+        monkeypatch.setattr(
+            pipelines,
+            "ContainerEnvironment",
+            lambda host: FakeEnvironment("green", "green-1", self.events, self.failures),
+        )
+        monkeypatch.setattr(
+            pipelines, "get_reverse_proxy", lambda: Deployment(proxy, "nexus-reverse-proxy")
+        )
+        monkeypatch.setattr(pipelines, "commit_image", lambda deployment, image: None)
+        monkeypatch.setattr(
+            pipelines, "prune_snapshots", lambda deployment: self.pruned.append(deployment)
+        )
+        self.blue = Deployment(FakeEnvironment("blue", "site", self.events, self.failures), "site")
+        self.blue.set_properties(
+            {
+                Properties.REPOSITORY: "https://example.com/site.git",
+                Properties.DOMAIN: "example.com",
+                Properties.EMAIL: "admin@example.com",
+            }
+        )
+        self.blue.save()
+        self.events.clear()
+
+    def update(self) -> tuple[int, str]:
+        return pipelines.update_blue_green(self.blue)
+
+    def get(self, identity: str, kind: str) -> list:
+        return [event[2:] for event in self.events if (identity, kind) == event[:2]]
+
+    def get_routes(self) -> list[str]:
+        return [
+            upstream
+            for (command,) in self.get("proxy", "command")
+            for upstream in ("blue:80", "green:80")
+            if f"server {upstream};" in command
+        ]
+
+
+def test_successful_update_flips_to_green_and_retires_blue(monkeypatch):
+    blue_green = BlueGreen(monkeypatch)
+    exit_code, output = blue_green.update()
+    assert 0 == exit_code, output
+    assert output.startswith("Switchover gap:")
+    assert [("site-retired",)] == blue_green.get("blue", "rename")
+    assert [("site",)] == blue_green.get("green", "rename")
+    assert ["green:80"] == blue_green.get_routes()
+    assert [()] == blue_green.get("blue", "teardown")
+    assert [] == blue_green.get("green", "teardown")
+    assert [("site", "green:80")] == [
+        (record[Properties.NAME], record[Properties.UPSTREAM])
+        for record in get_deployment_records()
+    ]
+    assert 1 == len(blue_green.pruned)
+
+
+def test_failed_build_leaves_blue_serving(monkeypatch):
+    blue_green = BlueGreen(monkeypatch, [("green", "git clone")])
+    assert 0 != blue_green.update()[0]
+    assert [] == blue_green.get("blue", "rename")
+    assert [] == blue_green.get_routes()
+    assert [()] == blue_green.get("green", "teardown")
+    assert [] == blue_green.get("blue", "teardown")
+
+
+def test_failed_green_rename_gives_blue_its_name_back(monkeypatch):
+    blue_green = BlueGreen(monkeypatch, [("green", "rename")])
+    assert 0 != blue_green.update()[0]
+    assert [("site-retired",), ("site",)] == blue_green.get("blue", "rename")
+    assert [] == blue_green.get_routes()
+    assert [()] == blue_green.get("green", "teardown")
+    assert [] == blue_green.get("blue", "teardown")
+    assert [None] == [record["upstream"] for record in get_deployment_records()]
+
+
+def test_failed_flip_routes_back_to_blue(monkeypatch):
+    blue_green = BlueGreen(monkeypatch, [("proxy", "nginx -t")])
+    assert 0 != blue_green.update()[0]
+    assert [("site-retired",), ("site",)] == blue_green.get("blue", "rename")
+    assert ["green:80", "blue:80"] == blue_green.get_routes()
+    assert ("proxy", "command", "nginx -s reload") == blue_green.events[-1]
+    assert [()] == blue_green.get("green", "teardown")
+    assert [] == blue_green.get("blue", "teardown")
+    assert [] == blue_green.pruned
+
+
+def test_failed_blue_teardown_still_succeeds(monkeypatch, caplog):
+    blue_green = BlueGreen(monkeypatch, [("blue", "teardown")])
+    exit_code, output = blue_green.update()
+    assert 0 == exit_code, output
+    assert ["green:80"] == blue_green.get_routes()
+    assert "Failed to remove the old container of site" in caplog.text
+    assert 1 == len(blue_green.pruned)
@@ -0,0 +1,178 @@
+import sqlite3
+from unittest.mock import MagicMock
+
+import planning
+from deploy import (
+    DATABASE_NAME,
+    Deployment,
+    Roles,
+    chain_fingerprints,
+    create_deployment_database,
+)
+from environment import ContainerEnvironment
+from planning import (
+    Plan,
+    PlanEnvironment,
+    PlannedStep,
+    add_run,
+    expand,
+    get_record_deployment,
+    plan_update,
+)
+from steps import CopyDirectory, GitPull, Properties
+
+
+def get_record(**fields) -> dict:
+    record = {property: None for property in Properties}
+    record.update({Properties.NAME: "site", Properties.CONFIG: "", "working_directory": None})
+    record.update(fields)
+    return record
+
+
+def test_fingerprint_ignores_the_environment_a_step_runs_against():
+    planned = CopyDirectory(PlanEnvironment("site"), "/snapshots")
+    executed = CopyDirectory(MagicMock(spec=ContainerEnvironment), "/snapshots")
+    assert planned.get_fingerprint() == executed.get_fingerprint()
+    assert planned.get_fingerprint() != CopyDirectory(PlanEnvironment(), "/other").get_fingerprint()
+
+
+def test_record_deployment_uses_recorded_working_directory():
+    deployment = get_record_deployment(get_record(working_directory="/srv/site"), None)
+    assert "/srv/site" == deployment.environment.get_working_directory()
+    default = PlanEnvironment().get_working_directory()
+    assert default == get_record_deployment(get_record(), None).environment.get_working_directory()
+
+
+def test_history_subject_is_set_apart_from_links():
+    site = Deployment(PlanEnvironment("site"), "site")
+    proxy = Deployment(PlanEnvironment("nexus-reverse-proxy"), "nexus-reverse-proxy")
+    proxy.link(site)
+    assert "nexus-reverse-proxy" == proxy.get_subject()
+    assert Roles.SITE == proxy.role
+    proxy.set_subject(site.get_subject(), Roles.PROXY)
+    assert "site" == proxy.get_subject()
+    assert Roles.PROXY == proxy.role
+
+
+
+CONFIG = """
+[host]
+name = "site"
+domain = "example.com"
+email = "admin@example.com"
+"""
+
+
+def get_deployment(revision: str = "abc", role: Roles = Roles.SITE) -> Deployment:
+    deployment = Deployment(PlanEnvironment("site", revision=revision), "site")
+    deployment.set_properties({Properties.COMMIT_SHA: revision})
+    deployment.set_subject("site", role)
+    deployment.add_step(GitPull())
+    return deployment
+
+
+def get_fingerprint(role: Roles = Roles.SITE) -> str:
+    deployment = get_deployment(role=role)
+    steps, _ = expand(deployment)
+    return chain_fingerprints(deployment.get_fingerprint_seed(), steps)[-1]
+
+
+def seed(*rows: tuple) -> None:
+    with sqlite3.connect(DATABASE_NAME) as database:
+        cursor = database.cursor()
+        create_deployment_database(cursor)
+        cursor.executemany(
+            """
+                INSERT INTO step_history (subject, role, step, fingerprint, duration, exit_code)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+        database.commit()
+
+
+def plan_run(deployment: Deployment, revision_known: bool = True) -> PlannedStep:
+    plan = Plan("Update site")
+    add_run(plan, deployment, revision_known)
+    assert plan.error is None
+    return plan.steps[-1]
+
+
+def test_estimate_is_the_median_of_successful_runs():
+    fingerprint = get_fingerprint()
+    seed(
+        ("site", Roles.SITE, "Git Pull", fingerprint, 1.0, 0),
+        ("site", Roles.SITE, "Git Pull", fingerprint, 3.0, 0),
+        ("site", Roles.SITE, "Git Pull", fingerprint, 10.0, 1),
+        ("site", Roles.SITE, "Git Pull", fingerprint, 2.0, 0),
+        ("other", Roles.SITE, "Git Pull", fingerprint, 50.0, 0),
+    )
+    assert 2.0 == plan_run(get_deployment()).estimate
+
+
+def test_estimate_falls_back_to_other_deployments():
+    seed(
+        ("other", Roles.SITE, "Git Pull", "", 4.0, 0),
+        ("other", Roles.SITE, "Git Pull", "", 40.0, 1),
+        ("blog", Roles.SITE, "Git Pull", "", 6.0, 0),
+        ("blog", Roles.PROXY, "Git Pull", "", 60.0, 0),
+    )
+    planned = plan_run(get_deployment())
+    assert 5.0 == planned.estimate
+    assert not planned.unchanged
+
+
+def test_steps_without_history_have_no_estimate():
+    assert plan_run(get_deployment()).estimate is None
+
+
+def test_unchanged_needs_a_matching_successful_last_run():
+    seed(("site", Roles.SITE, "Git Pull", get_fingerprint(), 1.0, 0))
+    assert plan_run(get_deployment()).unchanged
+    assert not plan_run(get_deployment("def")).unchanged
+    seed(("site", Roles.SITE, "Git Pull", get_fingerprint(), 1.0, 1))
+    assert not plan_run(get_deployment()).unchanged
+
+
+def test_unknown_revision_only_leaves_proxy_steps_unchanged():
+    seed(
+        ("site", Roles.SITE, "Git Pull", get_fingerprint(), 1.0, 0),
+        ("site", Roles.PROXY, "Git Pull", get_fingerprint(Roles.PROXY), 1.0, 0),
+    )
+    assert not plan_run(get_deployment(), False).unchanged
+    assert plan_run(get_deployment(role=Roles.PROXY), False).unchanged
+
+
+def test_update_plan_is_unchanged_when_history_matches(monkeypatch):
+    fingerprints = []
+
+    def record_fingerprints(seed: str, steps: list) -> list[str]:
+        fingerprints.extend(chain_fingerprints(seed, steps))
+        return fingerprints[len(fingerprints) - len(steps):]
+
+    record = get_record(
+        **{
+            Properties.CONFIG: CONFIG,
+            Properties.REPOSITORY: "https://example.com/site.git",
+            Properties.DOMAIN: "example.com",
+            Properties.EMAIL: "admin@example.com",
+        }
+    )
+    monkeypatch.setattr(planning, "get_remote_revision", lambda repository, config: "abc")
+    monkeypatch.setattr(planning, "chain_fingerprints", record_fingerprints)
+    plan = plan_update(record)
+    assert plan.error is None, plan.error
+    assert not any(step.unchanged for step in plan.steps)
+    seed(
+        *(
+            (step.subject, step.role, step.step, fingerprint, 2.0, 0)
+            for step, fingerprint in zip(plan.steps, fingerprints)
+        )
+    )
+    plan = plan_update(record)
+    assert all(step.unchanged for step in plan.steps)
+    assert plan.get_estimate() == plan.get_skippable() == 2.0 * len(plan.steps)
+
+    monkeypatch.setattr(planning, "get_remote_revision", lambda repository, config: None)
+    plan = plan_update(record)
+    assert {Roles.PROXY} == set(step.role for step in plan.steps if step.unchanged)
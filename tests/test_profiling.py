@@ -0,0 +1,102 @@
+import os
+import tracemalloc
+from unittest.mock import MagicMock
+
+import profiling
+from profiling import Categories, Run, StepProfile, instrument, profile_run, profile_step, wait
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def perf_counter(self) -> float:
+        return self.now
+
+
+def start_step(monkeypatch) -> tuple[StepProfile, Clock]:
+    clock = Clock()
+    step = StepProfile("site", "Clone Repository")
+    monkeypatch.setattr(profiling, "time", clock)
+    monkeypatch.setattr(profiling.STATE, "step", step)
+    return step, clock
+
+
+def test_nested_waits_are_charged_to_the_outermost(monkeypatch):
+    step, clock = start_step(monkeypatch)
+    with wait(Categories.DOCKER):
+        clock.now += 1
+        with wait(Categories.CONTAINER):
+            clock.now += 2
+    with wait(Categories.CONTAINER):
+        clock.now += 4
+    assert {Categories.DOCKER: 3.0, Categories.CONTAINER: 4.0} == step.waits
+
+
+def test_exec_starts_are_container_time(monkeypatch):
+    step, clock = start_step(monkeypatch)
+    client = MagicMock()
+    durations = {"/v1.43/containers/site/json": 1, "/v1.43/exec/0123abcd/start": 5}
+
+    def send(request, **kwargs):
+        clock.now += durations[request.path_url]
+
+    client.api.send = send
+    instrument(client)
+    for path in durations:
+        client.api.send(MagicMock(path_url=path), timeout=60)
+    assert {Categories.DOCKER: 1.0, Categories.CONTAINER: 5.0} == step.waits
+
+
+def test_runs_do_not_nest(monkeypatch):
+    reports = []
+    monkeypatch.setattr(profiling, "ENABLED", True)
+    monkeypatch.setattr(
+        profiling, "write_report", lambda run, total, allocations: reports.append(run)
+    )
+    with profile_run("update"):
+        with profile_run("steps"):
+            with profile_step("site", "Clone Repository"):
+                pass
+        with profile_run("steps"):
+            with profile_step("nexus-reverse-proxy", "Reload Nginx"):
+                pass
+    assert ["update"] == [run.name for run in reports]
+    assert ["Clone Repository", "Reload Nginx"] == [step.step for step in reports[0].steps]
+    assert profiling.RUN is None
+
+
+def test_runs_are_only_profiled_when_enabled(monkeypatch):
+    reports = []
+    monkeypatch.setattr(
+        profiling, "write_report", lambda run, total, allocations: reports.append(run)
+    )
+    with profile_run("update"):
+        with profile_step("site", "Clone Repository"):
+            pass
+    assert [] == reports
+
+
+def test_report_splits_steps_into_categories():
+    run = Run("deploy")
+    step = StepProfile("site", "Clone Repository")
+    step.wall = 3.0
+    step.waits = {Categories.DOCKER: 1.0, Categories.CONTAINER: 1.5}
+    run.add_step(step)
+    run.profiler.enable()
+    run.profiler.disable()
+    tracemalloc.start()
+    allocations = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    profiling.write_report(run, 4.0, allocations)
+
+    names = sorted(os.listdir(profiling.PROFILE_DIRECTORY))
+    assert [".prof", ".txt"] == [os.path.splitext(name)[1] for name in names]
+    assert names[1].endswith("-deploy.txt")
+    with open(os.path.join(profiling.PROFILE_DIRECTORY, names[1])) as file:
+        lines = file.read().splitlines()
+    assert "Nexus profile: deploy" == lines[0]
+    assert "Wall time: 4.000s" == lines[2]
+    assert ["3.000", "0.500", "1.000", "1.500"] == lines[5].split()[3:7]
+    assert ["total", "3.000", "0.500", "1.000", "1.500"] == lines[6].split()
+    assert "Outside steps: 1.000s" == lines[7]
@@ -0,0 +1,148 @@
+from unittest.mock import MagicMock
+
+from docker import errors
+
+import reconcile
+from deploy import Deployment
+from environment import DEFAULT_CONTAINER_NETWORK, Environment
+from hosts import HOSTS, Host, HostRegistry
+from reconcile import State
+import steps
+from steps import Properties
+
+RUNNING = {"State": "running", "NetworkSettings": {"Networks": {DEFAULT_CONTAINER_NETWORK: {}}}}
+
+
+class ProxyEnvironment(Environment):
+    def __init__(self) -> None:
+        self.commands = []
+        super().__init__(name="nexus-reverse-proxy")
+
+    def run_commands(self, commands: list[str]) -> tuple[int, str]:
+        for command in commands:
+            self.commands.append(command)
+            if "certbot" in command and "a.example.com" in command:
+                return 1, "challenge failed"
+        return 0, ""
+
+    def teardown(self) -> tuple[int, str]:
+        return 0, ""
+
+    def write_file(self, path: str, content: str) -> tuple[int, str]:
+        return 0, ""
+
+    def copy_directory(self, path: str, destination: Environment) -> tuple[int, str]:
+        return 0, ""
+
+    def commit_image(self, repository: str, tag: str) -> tuple[int, str]:
+        return 0, ""
+
+
+def get_record(name: str, upstream: str = "", host: str | None = None) -> dict:
+    return {
+        "id": 1,
+        "host": host,
+        "working_directory": None,
+        Properties.NAME: name,
+        Properties.UPSTREAM: upstream,
+        Properties.IMAGE: None,
+    }
+
+
+def fake_proxy() -> MagicMock:
+    reverse_proxy_deployment = MagicMock()
+    reverse_proxy_deployment.environment.run_command.return_value = (
+        0,
+        f"{reconcile.STATE_SEPARATOR}\n\n{reconcile.STATE_SEPARATOR}\n",
+    )
+    return reverse_proxy_deployment
+
+
+def test_remove_returns_docker_errors():
+    host = Host("local", client=MagicMock())
+    container = host.client.containers.get.return_value
+    container.remove.side_effect = errors.APIError("removal already in progress")
+    exit_code, output = reconcile.remove(host, "site")
+    assert -1 == exit_code
+    assert "Failed to remove site: removal already in progress" == output
+
+
+def test_reconcile_returns_failure_when_state_cannot_be_read(monkeypatch):
+    def read_state(reverse_proxy_deployment):
+        raise errors.APIError("container is not running")
+
+    monkeypatch.setattr(reconcile, "get_deployment_records", lambda: [])
+    monkeypatch.setattr(reconcile, "get_reverse_proxy", MagicMock)
+    monkeypatch.setattr(reconcile, "read_state", read_state)
+    exit_code, output = reconcile.reconcile()
+    assert -1 == exit_code
+    assert "Reconcile failed: container is not running" == output
+
+
+def test_unreachable_hosts_are_skipped_and_reported(monkeypatch):
+    local = Host("local", client=MagicMock())
+    local.client.api.containers.return_value = [{"Names": ["/site"], **RUNNING}]
+    remote = Host("node-2", client=MagicMock())
+    remote.client.api.containers.side_effect = errors.DockerException("connection refused")
+    monkeypatch.setattr(reconcile, "HOSTS", HostRegistry([local, remote]))
+    monkeypatch.setattr(
+        reconcile,
+        "get_deployment_records",
+        lambda: [get_record("site"), get_record("remote", host="node-2")],
+    )
+    monkeypatch.setattr(reconcile, "get_reverse_proxy", fake_proxy)
+    monkeypatch.setattr(reconcile, "plan_proxy", lambda records, state, changed: [])
+    exit_code, output = reconcile.reconcile()
+    assert -1 == exit_code
+    assert "0 changes applied, 0 failed; skipped unreachable hosts node-2" == output
+
+
+def test_stopped_sites_are_resumed_and_moved_upstreams_rewritten(monkeypatch):
+    before = [get_record("moved", "10.0.0.2:32768"), get_record("same", "same:80")]
+    after = [get_record("moved", "10.0.0.2:32801"), get_record("same", "same:80")]
+    records = iter([before, after])
+    started = []
+    planned = []
+
+    def resume(record: dict) -> tuple[int, str]:
+        started.append(record[Properties.NAME])
+        return 0, ""
+
+    def plan_proxy(records: list[dict], state: State, changed: set) -> list:
+        planned.append((records, changed))
+        return []
+
+    state = State()
+    state.containers = {
+        HOSTS.get_default().get_name(): {"moved": {**RUNNING, "State": "exited"}, "same": RUNNING}
+    }
+    monkeypatch.setattr(reconcile, "get_deployment_records", lambda: next(records))
+    monkeypatch.setattr(reconcile, "get_reverse_proxy", MagicMock)
+    monkeypatch.setattr(reconcile, "read_state", lambda reverse_proxy_deployment: state)
+    monkeypatch.setattr(reconcile, "resume", resume)
+    monkeypatch.setattr(reconcile, "plan_proxy", plan_proxy)
+    exit_code, output = reconcile.reconcile()
+    assert 0 == exit_code, output
+    assert ["moved"] == started
+    assert [(after, {"moved"})] == planned
+
+
+def test_failed_certificate_does_not_block_proxy_configs():
+    environment = ProxyEnvironment()
+    reverse_proxy_deployment = Deployment(environment, "nexus-reverse-proxy")
+    planned = [
+        ("add a", steps.AddDomainToCertificate("a.example.com", "admin@example.com")),
+        ("add b", steps.AddDomainToCertificate("b.example.com", "admin@example.com")),
+        ("remove old", steps.RemoveNginxConfig("old.example.com")),
+        ("test", steps.TestNginxConfig()),
+        ("reload", steps.ReloadNginx()),
+    ]
+    results = reconcile.run_proxy_steps(reverse_proxy_deployment, planned)
+    assert [True, False, True] == [0 == exit_code for _, exit_code, _ in results]
+    certbot = [command for command in environment.commands if "certbot" in command]
+    assert 2 == len(certbot)
+    assert "b.example.com" in certbot[1]
+    assert environment.commands.index(certbot[0]) > max(
+        index for index, command in enumerate(environment.commands) if "nginx -s reload" in command
+    )
+    assert 0 == len(reverse_proxy_deployment.steps)
@@ -0,0 +1,116 @@
+from unittest.mock import MagicMock
+
+from docker import errors
+
+import restore
+from hosts import HOSTS, Host, HostRegistry
+from reconcile import State
+from steps import Properties
+
+
+def get_record(
+    name: str, upstream: str, image: str | None = "nexus-site/site:1", host: str | None = None
+) -> dict:
+    return {
+        "id": 1,
+        "host": host,
+        "working_directory": None,
+        Properties.NAME: name,
+        Properties.UPSTREAM: upstream,
+        Properties.IMAGE: image,
+    }
+
+
+def fake_state(containers: dict) -> State:
+    state = State()
+    state.containers = {HOSTS.get_default().get_name(): containers}
+    return state
+
+
+def fake_proxy(exit_code: int = 0, output: str = "") -> MagicMock:
+    reverse_proxy_deployment = MagicMock()
+    reverse_proxy_deployment.environment.start.return_value = (exit_code, output)
+    return reverse_proxy_deployment
+
+
+def test_started_sites_with_new_upstreams_get_new_proxy_configs(monkeypatch):
+    before = [get_record("moved", "10.0.0.2:32768"), get_record("same", "same:80")]
+    after = [get_record("moved", "10.0.0.2:32801"), get_record("same", "same:80")]
+    records = iter([before, after])
+    started = []
+    planned = []
+
+    def resume(record: dict) -> tuple[int, str]:
+        started.append(record[Properties.NAME])
+        return 0, ""
+
+    def plan_proxy(records: list[dict], state: State, changed: set) -> list:
+        planned.append((records, changed))
+        return []
+
+    state = fake_state({"moved": {"State": "exited"}, "same": {"State": "exited"}})
+    monkeypatch.setattr(restore, "get_deployment_records", lambda: next(records))
+    monkeypatch.setattr(restore, "get_reverse_proxy", fake_proxy)
+    monkeypatch.setattr(restore, "read_state", lambda reverse_proxy_deployment: state)
+    monkeypatch.setattr(restore, "resume", resume)
+    monkeypatch.setattr(restore, "plan_proxy", plan_proxy)
+    exit_code, output = restore.restore_all()
+    assert 0 == exit_code, output
+    assert ["moved", "same"] == sorted(started)
+    assert [(after, {"moved"})] == planned
+    assert output.startswith("Restored 0 and started 2 deployments")
+
+
+def test_restore_fails_when_the_proxy_cannot_start(monkeypatch):
+    reverse_proxy_deployment = fake_proxy(-1, "Failed to start proxy")
+    monkeypatch.setattr(restore, "get_deployment_records", lambda: [])
+    monkeypatch.setattr(restore, "get_reverse_proxy", lambda: reverse_proxy_deployment)
+    exit_code, output = restore.restore_all()
+    assert -1 == exit_code
+    assert "Restore failed: Failed to start proxy" == output
+
+
+def test_restore_returns_docker_errors(monkeypatch):
+    def get_reverse_proxy():
+        raise errors.APIError("no such image")
+
+    monkeypatch.setattr(restore, "get_deployment_records", lambda: [])
+    monkeypatch.setattr(restore, "get_reverse_proxy", get_reverse_proxy)
+    assert (-1, "Restore failed: no such image") == restore.restore_all()
+
+
+def test_restore_skips_and_reports_unreachable_hosts(monkeypatch):
+    local = Host("local", client=MagicMock())
+    remote = Host("node-2", client=MagicMock())
+    records = [get_record("site", "site:80"), get_record("remote", "", host="node-2")]
+    restored = []
+    state = State()
+    state.containers = {"local": {}}
+    state.unreachable = {"node-2"}
+
+    def restore_record(record: dict) -> tuple[int, str]:
+        restored.append(record[Properties.NAME])
+        return 0, ""
+
+    monkeypatch.setattr(restore, "HOSTS", HostRegistry([local, remote]))
+    monkeypatch.setattr(restore, "get_deployment_records", lambda: records)
+    monkeypatch.setattr(restore, "get_reverse_proxy", fake_proxy)
+    monkeypatch.setattr(restore, "read_state", lambda reverse_proxy_deployment: state)
+    monkeypatch.setattr(restore, "restore", restore_record)
+    monkeypatch.setattr(restore, "plan_proxy", lambda records, state, changed: [])
+    exit_code, output = restore.restore_all()
+    assert -1 == exit_code
+    assert ["site"] == restored
+    assert output.startswith("Restored 1 and started 0 deployments")
+    assert output.endswith("0 failed; skipped unreachable hosts node-2")
+
+
+def test_restore_returns_failure_when_the_proxy_host_is_down(monkeypatch):
+    def get_reverse_proxy():
+        raise errors.DockerException("Error while fetching server API version")
+
+    monkeypatch.setattr(restore, "get_deployment_records", lambda: [])
+    monkeypatch.setattr(restore, "get_reverse_proxy", get_reverse_proxy)
+    exit_code, output = restore.restore_all()
+    assert -1 == exit_code
+    assert "Restore failed: Error while fetching server API version" == output
@@ -0,0 +1,100 @@
+from unittest.mock import MagicMock
+
+import settings
+from settings import check_value, get_setting
+from pipelines import get_proxy_config
+from steps import (
+    DEFAULT_PROXY_BUFFER_SIZE,
+    DEFAULT_PROXY_KEEPALIVE,
+    BuildNginxStaticSiteConfig,
+    Properties,
+    ReadNexusConfig,
+)
+
+CONFIG = """
+[host]
+name = "site"
+domain = "example.com"
+email = "admin@example.com"
+
+[performance]
+{performance}
+"""
+
+
+def fake_environment(config: str = "") -> MagicMock:
+    environment = MagicMock()
+    environment.get_working_directory.return_value = "/tmp"
+    environment.run_command.return_value = (0, config)
+    return environment
+
+
+def read_config(performance: str) -> ReadNexusConfig:
+    step = ReadNexusConfig()
+    exit_code, output = step.run_action(fake_environment(CONFIG.format(performance=performance)))
+    assert 0 == exit_code, output
+    return step
+
+
+def test_check_value_accepts_matching_types():
+    assert 2048 == check_value("performance", "min_compress_size", 2048, 1024)
+    assert False is check_value("performance", "brotli", False, True)
+    assert "map" == check_value("proxy", "layout", "map", "files")
+
+
+def test_check_value_falls_back_on_wrong_types(caplog):
+    assert 1024 == check_value("performance", "min_compress_size", "2k", 1024)
+    assert 1024 == check_value("performance", "min_compress_size", -1, 1024)
+    assert 1024 == check_value("performance", "min_compress_size", True, 1024)
+    assert True is check_value("performance", "brotli", 1, True)
+    assert "Invalid min_compress_size '2k' in [performance]" in caplog.text
+
+
+def test_get_setting_checks_server_settings(monkeypatch):
+    monkeypatch.setattr(settings, "SETTINGS", {"snapshots": {"keep": "five"}})
+    assert 5 == get_setting("snapshots", "keep", 5)
+
+
+def test_site_config_uses_configured_min_compress_size():
+    step = read_config("min_compress_size = 4096")
+    steps = {next_step.name: next_step for next_step in step.next_steps}
+    precompress = steps["Precompress Assets"]
+    site_config = steps["Build Nginx Static Site Config"]
+    assert 4096 == precompress.min_size
+    assert 4096 == site_config.min_compress_size
+
+    environment = fake_environment()
+    site_config.brotli = False
+    site_config.run_action(environment)
+    assert "gzip_min_length 4096;" in environment.run_command.call_args.args[0]
+
+
+def test_invalid_performance_values_use_defaults():
+    step = read_config('min_compress_size = "big"\ncache_max_age = -5\nprecompress = "yes"')
+    assert ReadNexusConfig().min_compress_size == step.min_compress_size
+    assert ReadNexusConfig().cache_max_age == step.cache_max_age
+    assert True is step.precompress
+
+
+def test_static_site_config_defaults_to_precompress_threshold():
+    step = BuildNginxStaticSiteConfig("config.conf", "example.com", "/srv/site")
+    environment = fake_environment()
+    step.run_action(environment)
+    assert "gzip_min_length 1024;" in environment.run_command.call_args.args[0]
+
+
+def test_proxy_values_are_checked_when_read():
+    proxy = '\n[proxy]\nkeepalive = "32"\nhttp2 = false\ncache_ttl = "10m"\nbuffer_size = "huge"'
+    step = read_config(proxy)
+    assert DEFAULT_PROXY_KEEPALIVE == step.properties[Properties.PROXY_KEEPALIVE]
+    assert False is step.properties[Properties.PROXY_HTTP2]
+    assert "10m" == step.properties[Properties.PROXY_CACHE_TTL]
+    assert DEFAULT_PROXY_BUFFER_SIZE == step.properties[Properties.PROXY_BUFFER_SIZE]
+    assert None is read_config("").properties[Properties.PROXY_KEEPALIVE]
+
+
+def test_recorded_proxy_values_are_read_back():
+    record = {Properties.NAME: "site", Properties.DOMAIN: "example.com", Properties.PROXY_HTTP2: 0}
+    assert False is get_proxy_config(record).http2
+    record[Properties.PROXY_HTTP2] = "no"
+    assert True is get_proxy_config(record).http2
@@ -0,0 +1,152 @@
+import re
+import socket
+import struct
+import subprocess
+import threading
+from unittest.mock import MagicMock
+
+import environment
+import shell
+from hosts import Host, HostRegistry
+from shell import ShellSession
+
+STDOUT = 1
+STDERR = 2
+
+
+def frame(payload: bytes, stream: int = STDOUT) -> bytes:
+    return struct.pack(">BxxxL", stream, len(payload)) + payload
+
+
+def fake_session(responder=None) -> tuple[ShellSession, socket.socket]:
+    # The session end is handed out by exec_start, the other end plays the container shell
+    session_end, shell_end = socket.socketpair()
+    client = MagicMock()
+    client.api.exec_create.return_value = {"Id": "exec"}
+    client.api.exec_start.return_value = session_end
+    if responder is not None:
+        threading.Thread(target=responder, args=(shell_end,), daemon=True).start()
+    return ShellSession(client, "container"), shell_end
+
+
+def read_script(shell_end: socket.socket) -> str:
+    script = b""
+    while not script.endswith(b"\n"):
+        script += shell_end.recv(4096)
+    return script.decode()
+
+
+def answer(*chunks: str, exit_code: int = 0):
+    # Sends the chunks as separate frames, {marker} is replaced by the marker line
+    def responder(shell_end: socket.socket) -> None:
+        marker = re.search(r"__NEXUS_[0-9a-f]+__", read_script(shell_end)).group(0)
+        for chunk in chunks:
+            data = chunk.format(marker=f"\n{marker} {exit_code}\n").encode()
+            shell_end.sendall(frame(data))
+
+    return responder
+
+
+def test_read_frame_buffers_stdout_and_stderr():
+    session, shell_end = fake_session()
+    session.open()
+    shell_end.sendall(frame(b"out ") + frame(b"err", STDERR))
+    assert b"out " == session.read_frame()
+    assert b"err" == session.read_frame()
+    assert b"out err" == session.buffer
+
+
+def test_read_frame_reads_payloads_larger_than_one_read():
+    session, shell_end = fake_session()
+    session.open()
+    payload = b"x" * (shell.READ_SIZE * 3 + 7)
+    threading.Thread(target=shell_end.sendall, args=(frame(payload),), daemon=True).start()
+    assert payload == session.read_frame()
+
+
+def test_read_frame_returns_nothing_when_closed():
+    session, shell_end = fake_session()
+    session.open()
+    shell_end.close()
+    assert b"" == session.read_frame()
+    assert not session.is_open()
+
+
+def test_run_returns_output_before_marker_and_exit_code():
+    session, _ = fake_session(answer("built\n{marker}", exit_code=3))
+    exit_code, output = session.run("make")
+    assert 3 == exit_code
+    assert b"built\n" == output
+    assert b"" == session.buffer
+
+
+def test_run_finds_marker_split_across_frames():
+    def split_marker(shell_end: socket.socket) -> None:
+        marker = re.search(r"__NEXUS_[0-9a-f]+__", read_script(shell_end)).group(0)
+        line = f"\n{marker} 0\n".encode()
+        shell_end.sendall(frame(b"line one\n__NEXUS_"))
+        shell_end.sendall(frame(line[:10]))
+        shell_end.sendall(frame(line[10:] + b"next"))
+
+    session, _ = fake_session(split_marker)
+    exit_code, output = session.run("build")
+    assert 0 == exit_code
+    assert b"line one\n__NEXUS_" == output
+    assert b"next" == session.buffer
+
+
+def test_run_fails_and_reopens_when_session_closes():
+    def hang_up(shell_end: socket.socket) -> None:
+        read_script(shell_end)
+        shell_end.sendall(frame(b"partial"))
+        shell_end.close()
+
+    session, _ = fake_session(hang_up)
+    exit_code, output = session.run("build")
+    assert -1 == exit_code
+    assert output.startswith(b"partial\nShell session failed")
+    assert session.socket is None
+
+
+def test_build_script_quotes_directory_and_variables():
+    session, _ = fake_session()
+    script = session.build_script("echo $A", "MARK", "/srv/my site", {"A": "a b"}).decode()
+    assert script.startswith(
+        "(export A='a b'; cd '/srv/my site' && sh -c 'echo $A') < /dev/null 2>&1; "
+    )
+    assert script.endswith("printf '\\n%s %d\\n' MARK $?\n")
+
+
+def test_build_script_survives_unbalanced_quotes():
+    # A real shell reports the syntax error and still prints the marker
+    session, _ = fake_session()
+    script = session.build_script("sh -c 'echo it's'", "MARK", "/", {"A": "it's"})
+    result = subprocess.run(["sh"], input=script, capture_output=True, timeout=5)
+    assert re.search(b"\nMARK [1-9][0-9]*\n$", result.stdout)
+    script = session.build_script('echo "$A"', "MARK", "/", {"A": "it's"})
+    result = subprocess.run(["sh"], input=script, capture_output=True, timeout=5)
+    assert b"it's\n\nMARK 0\n" == result.stdout
+
+
+def test_run_resets_session_when_output_stops(monkeypatch):
+    monkeypatch.setattr(shell, "TIMEOUT_SECONDS", 0.1)
+    session, _ = fake_session(read_script)
+    exit_code, output = session.run("sleep infinity")
+    assert -1 == exit_code
+    assert b"Shell session failed: timed out" in output
+    assert session.socket is None
+
+
+def test_exec_run_fallback_runs_commands_through_a_shell(monkeypatch):
+    host = Host("local", client=MagicMock())
+    host.client.networks.list.return_value = []
+    host.client.containers.get.return_value.exec_run.return_value = (0, b"")
+    monkeypatch.setattr(environment, "HOSTS", HostRegistry([host]))
+    container_environment = environment.ContainerEnvironment(
+        container_network="", persistent_shell=False
+    )
+
+    container_environment.run_command("npm ci && npm run build")
+
+    command = host.client.containers.get.return_value.exec_run.call_args.args[0]
+    assert ["sh", "-c", "npm ci && npm run build"] == command
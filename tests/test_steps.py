@@ -0,0 +1,167 @@
+from hashlib import sha256
+from unittest.mock import MagicMock
+
+from steps import (
+    DEFAULT_PROXY_BUFFER_SIZE,
+    DEFAULT_PROXY_KEEPALIVE,
+    PROXY_MAP_CONFIG,
+    PROXY_MAP_DIGEST_PREFIX,
+    BuildNginxProxyMapConfig,
+    BuildNginxReverseProxyConfig,
+    PruneSnapshots,
+)
+
+SNAPSHOTS = [f"/srv/nexus/snapshots/{number}" for number in (5, 4, 3, 2, 1)]
+
+
+def fake_environment(*outputs: str) -> MagicMock:
+    environment = MagicMock()
+    environment.run_command.side_effect = [(0, output) for output in outputs]
+    environment.write_file.return_value = (0, "")
+    return environment
+
+
+def du_output(sizes: dict) -> str:
+    return "".join(f"{size // 1024}\t{snapshot}\n" for snapshot, size in sizes.items())
+
+
+def prune(current: str, keep: int, disk_budget: int, sizes: dict) -> tuple[PruneSnapshots, list]:
+    step = PruneSnapshots(SNAPSHOTS, current, keep, disk_budget)
+    environment = fake_environment(du_output(sizes), "")
+    exit_code, _ = step.run_action(environment)
+    assert 0 == exit_code
+    commands = [call.args[0] for call in environment.run_command.call_args_list]
+    return step, commands
+
+
+def test_prune_snapshots_keeps_the_newest():
+    sizes = {snapshot: 1024 for snapshot in SNAPSHOTS}
+    step, commands = prune(SNAPSHOTS[0], 3, 1024 * 1024, sizes)
+    assert SNAPSHOTS[3:] == step.get_removed()
+    assert f"rm -rf {' '.join(SNAPSHOTS[3:])}" == commands[1]
+
+
+def test_prune_snapshots_always_keeps_the_current_one():
+    sizes = {snapshot: 1024 for snapshot in SNAPSHOTS}
+    step, _ = prune(SNAPSHOTS[4], 2, 1024 * 1024, sizes)
+    assert SNAPSHOTS[2:4] == step.get_removed()
+
+
+def test_prune_snapshots_stays_within_disk_budget():
+    sizes = {snapshot: 4096 for snapshot in SNAPSHOTS}
+    step, _ = prune(SNAPSHOTS[0], 5, 3 * 4096, sizes)
+    assert SNAPSHOTS[3:] == step.get_removed()
+
+
+def test_prune_snapshots_only_removes_existing_directories():
+    sizes = {snapshot: 1024 for snapshot in SNAPSHOTS[:2]}
+    step, commands = prune(SNAPSHOTS[0], 5, 1024 * 1024, sizes)
+    assert SNAPSHOTS[2:] == step.get_removed()
+    assert 1 == len(commands)
+
+
+def get_sites() -> list[BuildNginxReverseProxyConfig]:
+    return [
+        BuildNginxReverseProxyConfig("b.example.com", "b:80"),
+        BuildNginxReverseProxyConfig("a.example.com", "10.0.0.2:32768", keepalive=0),
+        BuildNginxReverseProxyConfig("c.example.com", "c:80", cache_ttl="10m"),
+    ]
+
+
+def test_map_config_routes_every_site_through_the_map():
+    sites = get_sites()
+    b, a, c = (site.get_upstream_name() for site in sites)
+    config = BuildNginxProxyMapConfig(sites).build_config()
+    assert (
+        f"upstream {a} {{\n\tserver 10.0.0.2:32768;\n}}\n\n"
+        f"upstream {b} {{\n\tserver b:80;\n\tkeepalive 16;\n}}\n\n"
+    ) in config
+    assert (
+        "map $host $nexus_upstream {\n\thostnames;\n"
+        f"\ta.example.com {a};\n\twww.a.example.com {a};\n"
+        f"\tb.example.com {b};\n\twww.b.example.com {b};\n"
+        f"\tc.example.com {c};\n\twww.c.example.com {c};\n}}\n"
+    ) in config
+    assert (
+        "server_name\n\t\ta.example.com www.a.example.com\n\t\tb.example.com www.b.example.com;"
+    ) in config
+    assert "server_name\n\t\tc.example.com www.c.example.com;" in config
+    assert 1 == config.count("proxy_cache_valid 200 301 302 10m;")
+    assert 1 == config.count("return 301 https://$host$request_uri;")
+
+
+def test_upstream_names_do_not_collide():
+    dashed = BuildNginxReverseProxyConfig("a-b.com", "a:80").get_upstream_name()
+    dotted = BuildNginxReverseProxyConfig("a.b.com", "b:80").get_upstream_name()
+    assert dashed != dotted
+    assert dashed.startswith("nexus_a_b_com_")
+
+
+def test_invalid_proxy_values_fall_back_to_defaults(caplog):
+    site = BuildNginxReverseProxyConfig(
+        "a.example.com", "a:80", keepalive="32", http2="no", cache_ttl="1 hour", buffer_size=8
+    )
+    assert DEFAULT_PROXY_KEEPALIVE == site.keepalive
+    assert True is site.http2
+    assert "" == site.cache_ttl
+    assert DEFAULT_PROXY_BUFFER_SIZE == site.buffer_size
+    assert "Invalid keepalive '32' in [proxy of a.example.com]" in caplog.text
+    assert f"keepalive {DEFAULT_PROXY_KEEPALIVE};" in site.build_upstream()
+
+
+def test_valid_proxy_values_are_kept():
+    site = BuildNginxReverseProxyConfig(
+        "a.example.com", "a:80", keepalive=0, http2=False, cache_ttl="10m", buffer_size="32k"
+    )
+    assert (0, False, "10m", "32k") == (
+        site.keepalive, site.http2, site.cache_ttl, site.buffer_size
+    )
+
+
+def test_map_config_does_not_depend_on_site_order():
+    sites = get_sites()
+    assert (
+        BuildNginxProxyMapConfig(sites).build_config()
+        == BuildNginxProxyMapConfig(sites[::-1]).build_config()
+    )
+
+
+def test_map_config_without_sites_has_no_servers():
+    config = BuildNginxProxyMapConfig([]).build_config()
+    assert "server {" not in config
+    assert "map $host $nexus_upstream {\n\thostnames;\n}\n" in config
+
+
+def get_next_names(step: BuildNginxProxyMapConfig) -> list[str]:
+    return [next_step.name for next_step in step.get_next_steps()]
+
+
+def test_unchanged_map_config_is_not_written_or_reloaded():
+    step = BuildNginxProxyMapConfig(get_sites())
+    digest = PROXY_MAP_DIGEST_PREFIX + sha256(step.build_config().encode()).hexdigest()
+    environment = fake_environment(f"{digest}\n")
+    assert 0 == step.run_action(environment)[0]
+    environment.write_file.assert_not_called()
+    assert [] == step.get_next_steps()
+
+    step = BuildNginxProxyMapConfig(get_sites(), force_reload=True)
+    step.run_action(fake_environment(f"{digest}\n"))
+    assert ["Test Nginx Config", "Reload Nginx"] == get_next_names(step)
+
+
+def test_changed_map_config_replaces_site_files():
+    step = BuildNginxProxyMapConfig(get_sites())
+    environment = fake_environment("", "", "a.example.com.conf other.conf\n", "")
+    assert 0 == step.run_action(environment)[0]
+    path, content = environment.write_file.call_args_list[-1].args
+    assert PROXY_MAP_CONFIG == path
+    assert content.startswith(PROXY_MAP_DIGEST_PREFIX)
+    command = environment.run_command.call_args.args[0]
+    assert "rm -f /etc/nginx/http.d/a.example.com.conf" == command
+    assert ["Test Nginx Config", "Reload Nginx"] == get_next_names(step)
+
+
+def test_unset_proxy_values_use_defaults_quietly(caplog):
+    site = BuildNginxReverseProxyConfig("a.example.com", "a:80", cache_ttl="", buffer_size=None)
+    assert ("", DEFAULT_PROXY_BUFFER_SIZE) == (site.cache_ttl, site.buffer_size)
+    assert "Invalid" not in caplog.text
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import json
+import time
+
+import tracing
+from tracing import bind, start_span
+
+
+def read_names() -> list[str]:
+    with open(tracing.TRACE_FILE) as file:
+        return [
+            json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["name"]
+            for line in file
+        ]
+
+
+def write_line(name: str, start_time: int, size: int = 0) -> str:
+    span = tracing.Span(name)
+    span.start = start_time
+    span.set_attributes({"padding": "x" * size})
+    return tracing.encode_span(span)
+
+
+def test_tracing_is_off_by_default(tmp_path):
+    assert False is tracing.ENABLED
+    with start_span("run"):
+        pass
+    assert not (tmp_path / tracing.TRACE_FILE).exists()
+
+
+def test_trace_is_written_through_one_handle(monkeypatch):
+    monkeypatch.setattr(tracing, "ENABLED", True)
+    opened = []
+
+    def counting_open(file, mode="r"):
+        opened.append(mode)
+        return open(file, mode)
+
+    def step(index: int) -> None:
+        with start_span("step"):
+            pass
+
+    monkeypatch.setattr(tracing, "open", counting_open, raising=False)
+    with start_span("run"):
+        with start_span("deployment"):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(bind(step), range(2)))
+        for _ in range(3):
+            with start_span("exec"):
+                pass
+    # The second open is the pruning check once the trace is done
+    assert ["a", "r+"] == opened
+    assert ["step", "step", "deployment", "exec", "exec", "exec", "run"] == read_names()
+
+
+def test_prune_keeps_recent_spans_within_size(monkeypatch):
+    now = time.time_ns()
+    old = now - int(timedelta(days=31).total_seconds()) * 1_000_000_000
+    lines = [write_line("expired", old)] + [write_line(f"span-{index}", now) for index in range(4)]
+    with open(tracing.TRACE_FILE, "w") as file:
+        file.writelines(lines + ["{broken\n"])
+    monkeypatch.setattr(tracing, "MAX_SIZE", 2 * len(lines[1].encode()))
+    tracing.prune()
+    assert ["span-2", "span-3"] == read_names()
+
+
+def test_prune_leaves_small_recent_files_alone():
+    lines = [write_line(f"span-{index}", time.time_ns(), 100) for index in range(3)]
+    with open(tracing.TRACE_FILE, "w") as file:
+        file.writelines(lines)
+    tracing.prune()
+    assert ["span-0", "span-1", "span-2"] == read_names()
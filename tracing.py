@@ -0,0 +1,227 @@
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import timedelta
+from functools import wraps
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable
+
+from settings import get_setting
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_TRACE_FILE = "traces.jsonl"
+DEFAULT_MAX_SIZE_MB = 64
+DEFAULT_RETENTION_DAYS = 30
+TRACE_FILE = get_setting("tracing", "file", DEFAULT_TRACE_FILE)
+ENABLED = get_setting("tracing", "enabled", False)
+MAX_SIZE = get_setting("tracing", "max_size_mb", DEFAULT_MAX_SIZE_MB) * 1024 * 1024
+RETENTION = timedelta(days=get_setting("tracing", "retention_days", DEFAULT_RETENTION_DAYS))
+SERVICE_NAME = "nexus"
+SPAN_KIND_INTERNAL = 1
+STATUS_OK = 1
+STATUS_ERROR = 2
+MAX_ATTRIBUTE_LENGTH = 256
+CURRENT_SPAN = ContextVar("current_span", default=None)
+CURRENT_WRITER = ContextVar("current_writer", default=None)
+WRITE_LOCK = threading.Lock()
+
+
+def encode_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        # OTLP JSON carries 64 bit integers as strings
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)[:MAX_ATTRIBUTE_LENGTH]}
+    return encoded
+
+
+def decode_value(value: dict) -> Any:
+    decoded = None
+    if "intValue" in value:
+        decoded = int(value["intValue"])
+    elif 0 != len(value):
+        decoded = next(iter(value.values()))
+    return decoded
+
+
+def encode_attributes(attributes: dict) -> list[dict]:
+    return [
+        {"key": key, "value": encode_value(value)}
+        for key, value in attributes.items()
+        if value is not None
+    ]
+
+
+class Span:
+    def __init__(self, name: str, parent: "Span | None" = None) -> None:
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent is not None else ""
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = {}
+        self.links = []
+        self.status = 0
+
+    def set_attributes(self, attributes: dict) -> None:
+        self.attributes.update(attributes)
+
+    def add_link(self, span: "Span | None") -> None:
+        if span is not None:
+            self.links.append(span)
+
+    def set_exit_code(self, exit_code: int) -> None:
+        self.attributes["exit_code"] = exit_code
+        self.status = STATUS_OK if 0 == exit_code else STATUS_ERROR
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": encode_attributes(self.attributes),
+            "links": [
+                {"traceId": link.trace_id, "spanId": link.span_id} for link in self.links
+            ],
+            "status": {"code": self.status},
+        }
+
+
+def enable(enabled: bool = True) -> None:
+    global ENABLED
+    ENABLED = enabled
+
+
+def encode_span(span: Span) -> str:
+    # Each line is a complete OTLP/JSON export request, as written by the collector's file exporter
+    record = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": encode_attributes(
+                        {"service.name": SERVICE_NAME, "host.name": socket.gethostname()}
+                    )
+                },
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_dict()]}],
+            }
+        ]
+    }
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+def get_start_time(line: str) -> int:
+    # Lines that cannot be read count as the oldest, so pruning drops them first
+    start_time = 0
+    try:
+        span = json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+        start_time = int(span["startTimeUnixNano"])
+    except (ValueError, KeyError, IndexError):
+        pass
+    return start_time
+
+
+def prune() -> None:
+    # Same policy as the step log store: spans past the retention go, then the oldest beyond the cap
+    cutoff = time.time_ns() - int(RETENTION.total_seconds()) * 1_000_000_000
+    try:
+        # Rewritten in place, so handles of running traces keep appending to the same file
+        with WRITE_LOCK, open(TRACE_FILE, "r+") as file:
+            first = file.readline()
+            size = os.fstat(file.fileno()).st_size
+            if "" != first and (MAX_SIZE < size or get_start_time(first) < cutoff):
+                file.seek(0)
+                lines = [line for line in file if cutoff <= get_start_time(line)]
+                kept = []
+                size = 0
+                for line in reversed(lines):
+                    size += len(line.encode())
+                    if MAX_SIZE < size:
+                        break
+                    kept.append(line)
+                file.seek(0)
+                file.writelines(reversed(kept))
+                file.truncate()
+    except OSError as error:
+        LOGGER.error(f"Failed to prune {TRACE_FILE}: {error}")
+
+
+class TraceWriter:
+    # One handle per trace, shared by the threads its spans run in
+    def __init__(self) -> None:
+        self.file = None
+
+    def write(self, span: Span) -> None:
+        try:
+            with WRITE_LOCK:
+                if self.file is None:
+                    self.file = open(TRACE_FILE, "a")
+                self.file.write(encode_span(span))
+                # Traces from other threads append to the same file between these lines
+                self.file.flush()
+        except OSError as error:
+            LOGGER.error(f"Failed to write span {span.name}: {error}")
+
+    def close(self) -> None:
+        if self.file is not None:
+            with WRITE_LOCK:
+                self.file.close()
+            self.file = None
+            prune()
+
+
+@contextmanager
+def start_span(name: str, attributes: dict = {}):
+    parent = CURRENT_SPAN.get()
+    span = Span(name, parent)
+    span.set_attributes(attributes)
+    token = CURRENT_SPAN.set(span)
+    writer = CURRENT_WRITER.get()
+    writer_token = None
+    if parent is None and ENABLED:
+        writer = TraceWriter()
+        writer_token = CURRENT_WRITER.set(writer)
+    try:
+        yield span
+    except Exception as error:
+        span.status = STATUS_ERROR
+        span.set_attributes({"exception.message": str(error)})
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        span.end = time.time_ns()
+        if writer is not None:
+            writer.write(span)
+        if writer_token is not None:
+            CURRENT_WRITER.reset(writer_token)
+            writer.close()
+
+
+def traced(function: Callable) -> Callable:
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with start_span(function.__name__) as span:
+            result = function(*args, **kwargs)
+            if isinstance(result, tuple) and isinstance(result[0], int):
+                span.set_exit_code(result[0])
+            return result
+
+    return wrapper
+
+
+def bind(function: Callable) -> Callable:
+    # Worker threads start from an empty context, this keeps their spans in the caller's trace
+    context = copy_context()
+    return lambda *args: context.copy().run(function, *args)
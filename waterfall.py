@@ -0,0 +1,147 @@
+# Renders a waterfall of one traced run from the span file written by tracing.py.
+# Run from the directory Nexus runs in:
+#
+#     python waterfall.py [--trace TRACE_ID] [--deployment NAME] [--width 60]
+
+from argparse import ArgumentParser
+import json
+
+from tracing import TRACE_FILE, decode_value
+
+DEFAULT_WIDTH = 60
+DEFAULT_SLOWEST = 10
+NANOSECONDS = 1_000_000_000
+
+
+class SpanRecord:
+    def __init__(self, span: dict) -> None:
+        self.trace_id = span["traceId"]
+        self.span_id = span["spanId"]
+        self.parent_span_id = span.get("parentSpanId", "")
+        self.name = span["name"]
+        self.start = int(span["startTimeUnixNano"])
+        self.end = int(span["endTimeUnixNano"])
+        self.attributes = {
+            attribute["key"]: decode_value(attribute["value"])
+            for attribute in span.get("attributes", [])
+        }
+        self.links = [link["spanId"] for link in span.get("links", [])]
+        self.failed = 2 == span.get("status", {}).get("code")
+        self.children = []
+
+    def get_duration(self) -> float:
+        return (self.end - self.start) / NANOSECONDS
+
+    def get_label(self) -> str:
+        label = self.name
+        if "deployment" == self.name:
+            label += f" {self.attributes.get('deployment.name', '')}"
+            if self.attributes.get("deployment.domain"):
+                label += f" ({self.attributes['deployment.domain']})"
+        elif "exec" == self.name:
+            label = " ".join(self.attributes.get("command", "exec").split())
+        return label
+
+
+def read_spans(trace_file: str) -> list[SpanRecord]:
+    spans = []
+    with open(trace_file) as file:
+        for line in file:
+            for resource_spans in json.loads(line)["resourceSpans"]:
+                for scope_spans in resource_spans["scopeSpans"]:
+                    spans += [SpanRecord(span) for span in scope_spans["spans"]]
+    return spans
+
+
+def select_trace(spans: list[SpanRecord], trace_id: str, deployment: str) -> list[SpanRecord]:
+    candidates = [
+        span
+        for span in spans
+        if span.trace_id.startswith(trace_id)
+        and (
+            not deployment
+            or deployment == span.attributes.get("deployment.name")
+            or deployment == span.attributes.get("deployment.domain")
+        )
+    ]
+    selected = []
+    if 0 != len(candidates):
+        latest = max(candidates, key=lambda span: span.start).trace_id
+        selected = [span for span in spans if latest == span.trace_id]
+    return selected
+
+
+def render(spans: list[SpanRecord], width: int) -> list[str]:
+    by_id = {span.span_id: span for span in spans}
+    roots = []
+    for span in sorted(spans, key=lambda span: span.start):
+        parent = by_id.get(span.parent_span_id)
+        if parent is not None:
+            parent.children.append(span)
+        else:
+            roots.append(span)
+    start = min(span.start for span in spans)
+    total = max(max(span.end for span in spans) - start, 1)
+
+    lines = [
+        f"trace {spans[0].trace_id}  {total / NANOSECONDS:.3f}s",
+        f"{'span':<56}{'start (s)':>10}{'time (s)':>10}  timeline",
+    ]
+
+    def add(span: SpanRecord, depth: int) -> None:
+        offset = round((span.start - start) / total * width)
+        length = max(round((span.end - span.start) / total * width), 1)
+        label = ("  " * depth + span.get_label())[:54]
+        marker = "!" if span.failed else " "
+        links = ""
+        if 0 != len(span.links):
+            linked = [by_id[link].get_label() for link in span.links if link in by_id]
+            links = f"  -> {', '.join(linked)}"
+        lines.append(
+            f"{label:<55}{marker}{(span.start - start) / NANOSECONDS:>10.3f}"
+            f"{span.get_duration():>10.3f}  {' ' * offset}{'#' * length}{links}"
+        )
+        for child in span.children:
+            add(child, depth + 1)
+
+    for root in roots:
+        add(root, 0)
+    return lines
+
+
+def summarise(spans: list[SpanRecord], count: int) -> list[str]:
+    # Self time shows where the run actually waited, rather than what enclosed it
+    totals = {}
+    for span in spans:
+        children = sum(child.end - child.start for child in span.children)
+        self_time = max(span.end - span.start - children, 0) / NANOSECONDS
+        totals[span.get_label()] = totals.get(span.get_label(), 0.0) + self_time
+    lines = ["", f"{'slowest spans by self time':<56}{'time (s)':>20}"]
+    for label, self_time in sorted(totals.items(), key=lambda item: -item[1])[:count]:
+        lines.append(f"{label[:55]:<56}{self_time:>20.3f}")
+    return lines
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Render a waterfall of a traced Nexus run")
+    parser.add_argument("--file", default=TRACE_FILE)
+    parser.add_argument("--trace", default="", help="trace id or prefix, the latest by default")
+    parser.add_argument("--deployment", default="", help="latest run touching this name or domain")
+    parser.add_argument("--width", type=int, default=DEFAULT_WIDTH)
+    parser.add_argument("--slowest", type=int, default=DEFAULT_SLOWEST)
+    arguments = parser.parse_args()
+
+    exit_code = 0
+    spans = select_trace(read_spans(arguments.file), arguments.trace, arguments.deployment)
+    if 0 == len(spans):
+        print("No matching trace found")
+        exit_code = 1
+    else:
+        lines = render(spans, arguments.width) + summarise(spans, arguments.slowest)
+        print("\n".join(lines))
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    main()